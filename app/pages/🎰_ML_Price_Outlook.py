@@ -1,27 +1,46 @@
 import streamlit as st
 import utils
-import pandas as pd
 import seaborn as sns
 import matplotlib.pyplot as plt
-from sklearn.ensemble import RandomForestRegressor, GradientBoostingRegressor
-from sklearn.svm import SVR
-from sklearn.model_selection import train_test_split
-from sklearn.metrics import mean_squared_error
-from sklearn.preprocessing import OneHotEncoder, StandardScaler
-from sklearn.compose import ColumnTransformer
-from sklearn.pipeline import Pipeline
-from sklearn.impute import SimpleImputer
 import plotly.express as px
+from src.model_registry import MODELS
+
+# Listings drawn in the pairplot
+PAIRPLOT_LISTINGS = 5000
+
+@st.fragment(run_every=2)
+def training_status(model_choice):
+    # Polls the background job every 2 seconds without rerunning the rest of the page
+    job = utils.training_job(model_choice)
+    if job is None:
+        return
+    in_flight = st.session_state.setdefault('training_in_flight', set())
+    if job['status'] in ('queued', 'running'):
+        in_flight.add(job['job_id'])
+        st.progress(job['progress'], text=f"Training {model_choice}: {job['message']}")
+    elif job['status'] == 'failed':
+        st.warning(f"Training {model_choice} failed: {job['message']}")
+    if job['status'] == 'done' and job['job_id'] in in_flight:
+        # Rerun the whole page once so that the new model is shown
+        in_flight.discard(job['job_id'])
+        st.rerun()
 
 def machine_learning_outlook_page():
     st.title("🤖 Machine Learning Price Outlook")
 
-    # Fetch data using utils
-    df = utils.fetch_data()
+    # Prices with the listing details parsed into numbers, maintained by the ETL
+    df = utils.listing_features()
 
     # Model selection
     st.header("Choose a Machine Learning Model")
-    model_choice = st.selectbox("Select Model", ["Random Forest", "Gradient Boosting", "Support Vector Regressor"])
+    model_choice = st.selectbox("Select Model", list(MODELS))
+
+    # Training runs in a background worker process, the page only loads fitted models
+    entry = utils.latest_model(model_choice)
+    if entry is None or entry['version'] != utils.load_version():
+        if st.button("Train on Latest Data"):
+            utils.submit_training(model_choice)
+    training_status(model_choice)
 
     if st.button("Run Model"):
         # Show basic EDA
@@ -29,76 +48,47 @@ def machine_learning_outlook_page():
         
         # Correlation heatmap
         st.subheader("Correlation Heatmap")
-        corr_matrix = df[['price', 'shipping_price']].corr()
+        corr_matrix = df.corr()
         fig, ax = plt.subplots()
         sns.heatmap(corr_matrix, annot=True, cmap='coolwarm', ax=ax)
         st.pyplot(fig)
 
         # Pairplot for numerical features
         st.subheader("Pairplot for Numerical Features")
-        fig = sns.pairplot(df[['price', 'shipping_price']])
+        # A sample draws the same picture as every listing, in a fraction of the time
+        fig = sns.pairplot(df.sample(n=min(len(df), PAIRPLOT_LISTINGS), random_state=42))
         st.pyplot(fig)
 
-        # Define features
-        categorical_features = ['certification_status', 'condition', 'merchant_name', 'badge']
-        numerical_features = ['shipping_price']
-
-        # Define target variable
-        y = df['price']
-
-        # Preprocessing for categorical data
-        categorical_transformer = Pipeline(steps=[
-            ('imputer', SimpleImputer(strategy='constant', fill_value='missing')),
-            ('onehot', OneHotEncoder(handle_unknown='ignore'))
-        ])
-
-        # Preprocessing for numerical data
-        numerical_transformer = Pipeline(steps=[
-            ('imputer', SimpleImputer(strategy='mean')),
-            ('scaler', StandardScaler()) if model_choice == "Support Vector Regressor" else ('passthrough', 'passthrough')  # Scaling only for SVR
-        ])
-
-        # Combine preprocessing steps
-        preprocessor = ColumnTransformer(
-            transformers=[
-                ('num', numerical_transformer, numerical_features),
-                ('cat', categorical_transformer, categorical_features)
-            ])
-
-        # Select model based on user choice
-        if model_choice == "Random Forest":
-            model = RandomForestRegressor(n_estimators=100, random_state=42)
-        elif model_choice == "Gradient Boosting":
-            model = GradientBoostingRegressor(n_estimators=100, random_state=42)
-        elif model_choice == "Support Vector Regressor":
-            model = SVR(kernel='rbf', C=1.0, epsilon=0.2)
-
-        # Define the model pipeline
-        pipeline = Pipeline(steps=[
-            ('preprocessor', preprocessor),
-            ('regressor', model)
-        ])
-
-        # Split data into training and testing sets
-        X = df[categorical_features + numerical_features]
-        X_train, X_test, y_train, y_test = train_test_split(X, y, test_size=0.2, random_state=42)
-
-        # Fit the model
-        pipeline.fit(X_train, y_train)
-
-        # Predictions and evaluation
-        predictions = pipeline.predict(X_test)
-        mse = mean_squared_error(y_test, predictions)
-
-        st.write(f"Model Mean Squared Error: {mse}")
+        # Models are fitted offline (src/model_registry.py), only the latest one is loaded here
+        st.header("Model Results")
+        if entry is None:
+            st.info(f"{model_choice} has not been trained yet. Click Train on Latest Data, or set TRAIN_MODELS=1 "
+                    f"to train it after ETL loads.")
+            return
+
+        st.caption(f"Trained for ETL load {entry['version']} on {entry['rows']:,} listings ({entry['mode']}, "
+                   f"{entry['fit_seconds']:.1f} seconds) at {entry['trained_at']:%Y-%m-%d %H:%M} UTC")
+        if entry['version'] != utils.load_version():
+            st.caption("Newer listings have been loaded since, click Train on Latest Data to update the model.")
+        st.write(f"Model Mean Squared Error: {entry['mse']} (on {entry['test_rows']:,} "
+                 f"{entry.get('test_scope', 'held-out listings')})")
+
+        # Large-data fits try growing samples within the time budget, show what each size cost and gained
+        tradeoff = entry.get('tradeoff')
+        if tradeoff is not None:
+            st.header("Accuracy and Training Time")
+            st.write("The model was fitted on samples of growing size while the next one fitted in the training "
+                     "time budget. The model kept is the one fitted on the largest sample.")
+            fig = px.line(tradeoff, x='fit_seconds', y='mse', markers=True, hover_data=['rows'],
+                          labels={'fit_seconds': 'fit time (seconds)', 'mse': 'test mean squared error',
+                                  'rows': 'listings'})
+            st.plotly_chart(fig, use_container_width=True)
+            st.dataframe(tradeoff.rename(columns={'rows': 'Listings', 'fit_seconds': 'Fit seconds',
+                                                  'mse': 'Test MSE'}), hide_index=True)
 
         # Feature Importance (only for models that provide it)
-        if model_choice in ["Random Forest", "Gradient Boosting"] and hasattr(pipeline.named_steps['regressor'], 'feature_importances_'):
-            feature_importance = pd.DataFrame({
-                'feature': numerical_features + list(pipeline.named_steps['preprocessor'].transformers_[1][1]['onehot'].get_feature_names_out(categorical_features)),
-                'importance': pipeline.named_steps['regressor'].feature_importances_
-            }).sort_values(by='importance', ascending=False)
-
+        feature_importance = entry['feature_importance']
+        if feature_importance is not None:
             st.header("Feature Importance in Driving Price")
             fig = px.bar(feature_importance, x='importance', y='feature', title='Feature Importance')
             st.plotly_chart(fig, use_container_width=True)
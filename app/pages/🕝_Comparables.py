@@ -2,26 +2,25 @@ import streamlit as st
 import utils  # Import utility functions from utils.py
 import plotly.express as px
 import pandas as pd
+import time
 
 def comparison_tool_page():
     st.title("🆚 Watch Comparison Tool")
 
-    # Fetch data using utils
-    df = utils.fetch_data()
+    # Numerical columns to compare
+    numeric_cols = ['price', 'shipping_price']
 
-    # Exclude 'id' or any other unwanted columns from the numerical columns
-    numeric_cols = df.select_dtypes(include='number').columns.drop(['id'])
-
-    # User Inputs
+    # User Inputs, options come from cached DISTINCT queries
     st.sidebar.header("🔍 Select Watches to Compare")
-    brand_1 = st.sidebar.selectbox("Select Brand 1", df['brand'].unique())
-    model_1 = st.sidebar.selectbox("Select Model 1", df[df['brand'] == brand_1]['model'].unique())
-    brand_2 = st.sidebar.selectbox("Select Brand 2", df['brand'].unique())
-    model_2 = st.sidebar.selectbox("Select Model 2", df[df['brand'] == brand_2]['model'].unique())
+    brands = utils.brand_options()
+    brand_1 = st.sidebar.selectbox("Select Brand 1", brands)
+    model_1 = st.sidebar.selectbox("Select Model 1", utils.model_options(brand_1))
+    brand_2 = st.sidebar.selectbox("Select Brand 2", brands)
+    model_2 = st.sidebar.selectbox("Select Model 2", utils.model_options(brand_2))
 
-    # Filter data
-    watch_1 = df[(df['brand'] == brand_1) & (df['model'] == model_1)]
-    watch_2 = df[(df['brand'] == brand_2) & (df['model'] == model_2)]
+    # Fetch only the two selected watches
+    watch_1 = utils.fetch_listings(brand_1, model_1, columns=tuple(numeric_cols), priced=False)
+    watch_2 = utils.fetch_listings(brand_2, model_2, columns=tuple(numeric_cols), priced=False)
 
     # Select only numerical columns for comparison
     watch_1_mean = watch_1[numeric_cols].mean().rename(f'{brand_1} {model_1}')
@@ -35,5 +34,30 @@ def comparison_tool_page():
     fig = px.bar(comparison_df, x='index', y=[f'{brand_1} {model_1}', f'{brand_2} {model_2}'], barmode='group', title="Comparison of Key Metrics")
     st.plotly_chart(fig, use_container_width=True)
 
+    # Nearest listings by family, production year, case diameter, certification, box and papers and price
+    st.header("Find Comparables")
+    index = utils.comparables_index()
+    if index is None:
+        st.info("The comparables index has not been built yet, it is built after the next ETL run.")
+        return
+    listings = utils.fetch_listings(brand_1, model_1, columns=('listing_id', 'price', 'date_gathered'))
+    # The latest price of each listing of the first watch
+    listings = listings.sort_values('date_gathered').drop_duplicates('listing_id', keep='last').sort_values('price')
+    if listings.empty:
+        st.info(f"{model_1} has no priced listings.")
+        return
+    prices = dict(zip(listings['listing_id'], listings['price']))
+    listing_id = st.selectbox(f"Listing of {model_1}", list(prices),
+                              format_func=lambda listing: f"{listing} (${prices[listing]:,.0f})")
+    k = st.slider("Comparables", min_value=5, max_value=50, value=10, step=5)
+    start_time = time.perf_counter()
+    comparables = index.comparables(listing_id, k)
+    query_ms = (time.perf_counter() - start_time) * 1000
+    if comparables is None:
+        st.info(f"Listing {listing_id} was not seen recently enough to be in the comparables index.")
+        return
+    st.caption(f"{len(comparables)} nearest of {len(index.catalog):,} indexed listings, found in {query_ms:.1f} ms")
+    st.dataframe(comparables)
+
 if __name__ == "__main__":
     comparison_tool_page()
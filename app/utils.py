@@ -1,5 +1,4 @@
 import pandas as pd
-from sqlalchemy import create_engine
 import plotly.express as px
 import plotly.graph_objs as go
 import os
@@ -10,7 +9,17 @@ from sklearn.linear_model import LinearRegression
 import streamlit as st
 from dotenv import load_dotenv
 from scipy.stats import norm
+from sqlalchemy import text
 
+from src.comparables import INDEX_PATH as COMPARABLES_INDEX_PATH, ComparablesIndex
+from src.db_pool import create_pooled_engine
+from src.frame_cache import FrameCache
+from src.load_log import LATEST_LOAD_QUERY
+from src.model_registry import ModelRegistry
+from src.training_jobs import TrainingWorker, latest_job, submit
+from src.price_sketch import PriceSketch
+from src.price_stats import PriceMoments, price_outliers
+from src.snapshot import SNAPSHOT_COLUMNS, read_snapshot, snapshot_available, snapshot_dates
 
 load_dotenv()
 
@@ -36,49 +45,358 @@ def fetch_data_from_chrono24():
 @st.cache_resource
 def get_engine():
     """
-    Create and return a SQLAlchemy engine for PostgreSQL.
+    Create and return a pooled SQLAlchemy engine for PostgreSQL, shared by all sessions.
     """
-    engine_url = f'postgresql://{DB_USER}:{DB_PASSWORD}@{DB_HOST}:{DB_PORT}/{DB_NAME}'
-    return create_engine(engine_url)
+    return create_pooled_engine()
+
+# Cached frames are shared by every session, with copy-on-write a session's
+# in-place edits copy the columns they touch instead of changing the cache
+pd.set_option('mode.copy_on_write', True)
+
+# How often the ETL load version is checked, in seconds
+CACHE_TTL_SECONDS = int(os.getenv('CACHE_TTL_SECONDS', '60'))
+# Memory budget of the cached listing slices, least recently used slices are evicted first
+SLICE_CACHE_MB = int(os.getenv('SLICE_CACHE_MB', '256'))
+
+@st.cache_data(ttl=CACHE_TTL_SECONDS, show_spinner=False)
+def load_version():
+    """
+    Latest ETL load id, or None before the ETL has recorded a load. Every cache
+    below is keyed on it, so new loads show up within CACHE_TTL_SECONDS.
+    """
+    with get_engine().connect() as conn:
+        if conn.execute(text("SELECT to_regclass('chrono.etl_loads')")).scalar() is None:
+            return None
+        return conn.execute(text(LATEST_LOAD_QUERY)).scalar()
+
+@st.cache_resource
+def _slice_cache():
+    return FrameCache(SLICE_CACHE_MB * 2**20)
+
+# Columns of the listings shown for a selected brand and model
+LISTING_COLUMNS = tuple(SNAPSHOT_COLUMNS)
+
+def _predicates(brand=None, model=None, start_date=None, end_date=None, priced=True, below=None, family=None):
+    predicates = []
+    if brand is not None:
+        predicates.append(('brand', '=', brand))
+    if family is not None:
+        predicates.append(('reference_family', '=', family))
+    if model is not None:
+        predicates.append(('model', '=', model))
+    if start_date is not None:
+        predicates.append(('date_gathered', '>=', start_date))
+    if end_date is not None:
+        predicates.append(('date_gathered', '<=', end_date))
+    if priced:
+        predicates.append(('price', '>', 0))
+    if below is not None:
+        predicates.append(('price', '<', below))
+    return predicates
+
+def _query_database(columns, predicates, distinct=False, table='chrono.watch_prices', order_by=None, group_by=None,
+                    limit=None):
+    """
+    Runs a parameterized SELECT with the predicates as its WHERE clause.
+    Column names and operators come from this module, values are bound parameters.
+    """
+    conditions = [f"{column} {operator} :p{position}" for position, (column, operator, _) in enumerate(predicates)]
+    params = {f"p{position}": value for position, (_, _, value) in enumerate(predicates)}
+    query = f"SELECT {'DISTINCT ' if distinct else ''}{', '.join(columns)} FROM {table}"
+    if conditions:
+        query += " WHERE " + " AND ".join(conditions)
+    if group_by:
+        query += f" GROUP BY {', '.join(group_by)}"
+    order_by = order_by or (columns if distinct else None)
+    if order_by:
+        query += f" ORDER BY {', '.join(order_by)}"
+    if limit is not None:
+        query += f" LIMIT {int(limit)}"
+    return pd.read_sql(text(query), get_engine(), params=params)
+
+def _distinct(column, predicates):
+    if snapshot_available():
+        values = read_snapshot([column], predicates)[column].dropna().unique()
+        return sorted(values)
+    return _query_database([column], predicates, distinct=True)[column].dropna().tolist()
+
+@st.cache_data(show_spinner=False, max_entries=4)
+def _brand_options(version):
+    return _distinct('brand', _predicates())
+
+def brand_options():
+    """
+    Brands with priced listings, for the brand dropdowns.
+    """
+    return _brand_options(load_version())
+
+@st.cache_data(show_spinner=False, max_entries=256)
+def _family_options(brand, version):
+    return _distinct('reference_family', _predicates(brand=brand))
+
+def family_options(brand):
+    """
+    Reference families of a brand's priced listings, as stored by the ETL (see
+    src/title_index.py), empty for brands without families.
+    """
+    return _family_options(brand, load_version())
+
+@st.cache_data(show_spinner=False, max_entries=256)
+def _model_options(brand, family, version):
+    return _distinct('model', _predicates(brand=brand, family=family))
+
+def model_options(brand, family=None):
+    """
+    Models of a brand with priced listings, for the model dropdowns, only those
+    of a reference family when given.
+    """
+    return _model_options(brand, family, load_version())
+
+@st.cache_data(show_spinner=False, max_entries=4)
+def _date_bounds(version):
+    if snapshot_available():
+        dates = sorted(snapshot_dates())
+        return pd.to_datetime(dates[0]).date(), pd.to_datetime(dates[-1]).date()
+    bounds = _query_database(['min(date_gathered) AS first_date', 'max(date_gathered) AS last_date'], [])
+    return bounds['first_date'].iloc[0], bounds['last_date'].iloc[0]
+
+def date_bounds():
+    """
+    First and last date_gathered, or (None, None) when nothing is loaded yet.
+    """
+    return _date_bounds(load_version())
+
+def fetch_listings(brand=None, model=None, start_date=None, end_date=None, columns=LISTING_COLUMNS, priced=True,
+                   below=None, family=None):
+    """
+    Fetches only the listings of the given brand, reference family, model and date
+    range, with the predicates pushed down to the Parquet snapshot or to PostgreSQL.
+    priced=True leaves out listings without a positive price, below keeps only
+    listings priced under it. Slices are cached per load version and returned as
+    copy-on-write views.
+    """
+    predicates = _predicates(brand, model, start_date, end_date, priced, below, family)
+
+    def load():
+        if snapshot_available():
+            return read_snapshot(list(columns), predicates)
+        return _query_database(list(columns), predicates)
+
+    return _slice_cache().get(('listings', tuple(predicates), tuple(columns)), load_version(), load)
+
+# Columns of the daily aggregates maintained by the ETL in src/daily_stats.py
+DAILY_STATS_COLUMNS = ('listings', 'mean_price', 'median_price', 'p25_price', 'p75_price', 'min_price', 'max_price',
+                       'm2_price')
+
+def daily_price_stats(brand=None, model=None, start_date=None, end_date=None, family=None):
+    """
+    Daily listing count and price statistics of priced listings, read from the
+    aggregate tables: one row per day and brand, per day and model of brand, or,
+    with a family but no model, per day for the reference family of brand.
+    """
+    predicates = _predicates(brand, model, start_date, end_date, priced=False, family=family)
+    if brand is None:
+        keys, table = ['brand'], 'chrono.daily_brand_prices'
+    elif model is None and family is not None:
+        keys, table = ['brand', 'reference_family'], 'chrono.daily_family_prices'
+    else:
+        keys, table = ['brand', 'model'], 'chrono.daily_model_prices'
+
+    def load():
+        return _query_database(['date_gathered', *keys, *DAILY_STATS_COLUMNS], predicates, table=table,
+                               order_by=['date_gathered', *keys])
+
+    return _slice_cache().get(('daily_stats', table, tuple(predicates)), load_version(), load)
+
+def price_sketch(brand, model=None, start_date=None, end_date=None, family=None):
+    """
+    Quantile sketch of the brand's, reference family's or model's priced listings in the
+    date range, merged in SQL from the daily sketches. Its quantiles are within 1% of the exact ones.
+    """
+    predicates = _predicates(brand, model, start_date, end_date, priced=False, family=family)
+    if model is not None:
+        table = 'chrono.daily_model_price_sketches'
+    elif family is not None:
+        table = 'chrono.daily_family_price_sketches'
+    else:
+        table = 'chrono.daily_brand_price_sketches'
+
+    def load():
+        return _query_database(['bucket', 'sum(listings) AS listings'], predicates, table=table,
+                               group_by=['bucket'], order_by=['bucket'])
+
+    buckets = _slice_cache().get(('price_sketch', table, tuple(predicates)), load_version(), load)
+    return PriceSketch(buckets['bucket'], buckets['listings'])
+
+# Numeric columns of the typed feature table maintained by the ETL in src/listing_features.py
+FEATURE_NUMBER_COLUMNS = ('price', 'shipping_price', 'production_year', 'case_diameter_mm', 'merchant_rating')
+
+def listing_features(brand=None, model=None, columns=FEATURE_NUMBER_COLUMNS):
+    """
+    Priced listings with their details parsed into numbers, read from
+    chrono.listing_features without joining chrono.watch_details.
+    """
+    predicates = _predicates(brand, model)
+
+    def load():
+        return _query_database(list(columns), predicates, table='chrono.listing_features')
+
+    return _slice_cache().get(('features', tuple(predicates), tuple(columns)), load_version(), load)
+
+@st.cache_resource
+def _model_registry():
+    return ModelRegistry()
+
+@st.cache_resource(max_entries=4, show_spinner=False)
+def _load_model(path, modified):
+    return _model_registry().load(path)
+
+def latest_model(model_name):
+    """
+    The latest fitted pipeline of model_name with its test error and feature
+    importance, as trained offline by src/model_registry.py, or None when the model
+    was never trained. Loaded once per file.
+    """
+    path = _model_registry().latest_path(model_name)
+    if path is None:
+        return None
+    return _load_model(path, os.stat(path).st_mtime_ns)
 
 @st.cache_resource
-def fetch_data():
+def _training_worker():
+    return TrainingWorker().start()
+
+def submit_training(model_name):
     """
-    Fetches watch data from the PostgreSQL database.
+    Queues training of model_name on the latest loaded data in the background
+    worker and returns the job id. A request already in flight is not queued twice.
     """
-    engine = get_engine()
-    query = "SELECT * FROM chrono.watch_prices"
-    return pd.read_sql(query, engine)
+    _training_worker()
+    return submit(model_name, version=load_version())
 
-def plot_avg_price_trend(df):
-    df['date'] = pd.to_datetime(df['date_gathered']).dt.date  # Convert to date to keep it daily
-    avg_price_trend = df.groupby(['date', 'brand'])['price'].mean().reset_index()
-    fig = px.line(avg_price_trend, x='date', y='price', color='brand')
+def training_job(model_name):
+    """
+    Status, progress and message of the latest training job of model_name, or None.
+    Starts the worker, so jobs queued before a restart run once the page is open.
+    """
+    _training_worker()
+    return latest_job(model_name)
+
+def plot_avg_price_trend(stats):
+    fig = px.line(stats, x='date_gathered', y='mean_price', color='brand',
+                  labels={'date_gathered': 'date', 'mean_price': 'price'})
     return fig
 
-def z_score_outliers(df):
-    df['z_score'] = (df['price'] - df['price'].mean()) / df['price'].std()
-    return df[df['z_score'] < -2]
+@st.cache_data(ttl=CACHE_TTL_SECONDS, show_spinner=False)
+def _deals_version():
+    with get_engine().connect() as conn:
+        if conn.execute(text("SELECT to_regclass('chrono.deal_score_loads')")).scalar() is None:
+            return None
+        return conn.execute(text("SELECT max(load_id) FROM chrono.deal_score_loads")).scalar()
+
+@st.cache_data(show_spinner=False, max_entries=4)
+def _best_deals(limit, version):
+    return _query_database(['brand', 'model', 'price', 'market_price', 'predicted_price', 'deal_score', 'reason',
+                            'date_gathered', 'url'], [], table='chrono.deal_scores',
+                           order_by=['deal_score DESC'], limit=limit)
+
+def best_deals(limit=50):
+    """
+    The listings priced furthest below their market and model estimate, across all
+    brands, as scored by the ETL in src/deal_scores.py. None before the first scoring.
+    """
+    version = _deals_version()
+    if version is None:
+        return None
+    return _best_deals(limit, version)
 
-def percentile_filtering(df, percentile=20):
-    threshold = np.percentile(df['price'], percentile)
-    return df[df['price'] < threshold]
+@st.cache_resource(max_entries=1)
+def _comparables_index(modified):
+    return ComparablesIndex.load(COMPARABLES_INDEX_PATH)
+
+def comparables_index():
+    """
+    The nearest-neighbour index of the listing catalog kept up to date by the ETL
+    (src/comparables.py), loaded again whenever the ETL saves it. None before it is built.
+    """
+    if not os.path.exists(COMPARABLES_INDEX_PATH):
+        return None
+    return _comparables_index(os.path.getmtime(COMPARABLES_INDEX_PATH))
+
+def price_moments(brand, model, start_date=None, end_date=None, family=None):
+    """
+    Count, mean and standard deviation of the model's, or with model None the reference
+    family's, priced listings in the date range, merged from the daily aggregates
+    without reading the listings.
+    """
+    return PriceMoments.from_daily(daily_price_stats(brand, model, start_date, end_date, family))
+
+def z_score_outliers(brand, model, start_date=None, end_date=None, threshold=-2, family=None):
+    """
+    Listings priced more than -threshold standard deviations below the mean of the
+    model, or of the reference family. The cutoff price comes from price_moments(),
+    so only the outliers are fetched.
+    """
+    moments = price_moments(brand, model, start_date, end_date, family)
+    cutoff = moments.mean + threshold * moments.std
+    if np.isnan(cutoff):
+        # Fewer than two listings, none of them is an outlier
+        cutoff = 0
+    df = fetch_listings(brand, model, start_date, end_date, below=cutoff, family=family)
+    return df.assign(z_score=moments.z_score(df['price']))
+
+def percentile_filtering(brand, model, start_date=None, end_date=None, percentile=20, family=None):
+    """
+    Listings priced under the percentile of the model, or of the reference family,
+    in the date range. The cutoff price comes from price_sketch(), so only the
+    listings under it are fetched.
+    """
+    cutoff = price_sketch(brand, model, start_date, end_date, family).quantile(percentile / 100)
+    if np.isnan(cutoff):
+        # No priced listings
+        cutoff = 0
+    return fetch_listings(brand, model, start_date, end_date, below=float(cutoff), family=family)
 
 def regression_residuals(df):
-    X = df[['condition', 'certification_status']].copy()
-    X = pd.get_dummies(X, drop_first=True)
-    y = df['price']
-    model = LinearRegression().fit(X, y)
-    df['predicted_price'] = model.predict(X)
-    df['residuals'] = df['predicted_price'] - df['price']
-    return df[df['residuals'] < 0]
-
-def plot_box_plot(df):
+    """
+    Listings priced under the price predicted from their condition and
+    certification, as a new frame with predicted_price and residuals columns.
+    """
+    X = pd.get_dummies(df[['condition', 'certification_status']], drop_first=True)
+    if df.empty or X.shape[1] == 0:
+        return df.iloc[:0].assign(predicted_price=pd.Series(dtype='float64'), residuals=pd.Series(dtype='float64'))
+    predicted = LinearRegression().fit(X, df['price']).predict(X)
+    residuals = predicted - df['price'].to_numpy()
+    undervalued = residuals > 0
+    return df[undervalued].assign(predicted_price=predicted[undervalued], residuals=residuals[undervalued])
+
+# Columns shown next to the outlier scores of market_outliers()
+OUTLIER_DETAIL_COLUMNS = ['model', 'certification_status', 'condition', 'date_gathered', 'url']
+
+def market_outliers(start_date=None, end_date=None):
+    """
+    Listings of every brand in the date range priced below their market by z-score,
+    robust MAD score or interquartile range, scored in one grouped pass
+    (src/price_stats.py). The market of a listing is its reference family, or its
+    title when it has none.
+    """
+    columns = ('brand', 'reference_family', 'price', *OUTLIER_DETAIL_COLUMNS)
+
+    def load():
+        listings = fetch_listings(start_date=start_date, end_date=end_date, columns=columns)
+        markets = listings.assign(market=listings['reference_family'].astype('string').fillna(
+            listings['model'].astype('string')))
+        outliers = price_outliers(markets, keys=('brand', 'market'))
+        return outliers.join(listings[OUTLIER_DETAIL_COLUMNS]).sort_values('z_score')
+
+    return _slice_cache().get(('outliers', start_date, end_date), load_version(), load)
+
+def plot_box_plot(df, x='model'):
     box_fig = px.box(df, 
-                     x='model', 
+                     x=x, 
                      y='price', 
                      color='certification_status', 
-                     title=f"Price Distribution for {df['model'].iloc[0]}")
+                     title=f"Price Distribution for {df[x].iloc[0]}")
     return box_fig
 
 def plot_normal_distribution(df):
@@ -6,33 +6,58 @@ def home_page():
     st.title("⌚️ Watch Market Overview")
     # st.image("market_overview_image.jpg")  # Replace with your image file path
 
-    # Fetch data using utils
-    df = utils.fetch_data()
-
-    # Exclude rows where price is 0
-    df = df[df['price'] > 0]
-
-    # User input for watch selection
+    # User input for watch selection, options come from cached DISTINCT queries
     st.sidebar.header("🔍 Find Watches")
-    selected_brand = st.sidebar.selectbox("Select Brand", df['brand'].unique())
-    selected_model = st.sidebar.selectbox("Select Model", df[df['brand'] == selected_brand]['model'].unique())
+    first_date, last_date = utils.date_bounds()
+    if first_date is None:
+        st.info("No listings have been loaded yet.")
+        return
+    selected_brand = st.sidebar.selectbox("Select Brand", utils.brand_options())
+    # Free-text titles are narrowed down by their reference family first
+    families = utils.family_options(selected_brand)
+    selected_family = st.sidebar.selectbox("Select Reference Family", ["All Families"] + families) if families else None
+    family = None if selected_family in (None, "All Families") else selected_family
+    models = utils.model_options(selected_brand, family)
+    if family is None:
+        selected_model = st.sidebar.selectbox("Select Model", models)
+    else:
+        # A family's listings are one market, its titles are mostly spelling variants
+        selected_model = st.sidebar.selectbox("Select Model", ["All Models"] + models)
+        selected_model = None if selected_model == "All Models" else selected_model
+    label = selected_model or family
+    date_range = st.sidebar.date_input("Date Range", (first_date, last_date), min_value=first_date, max_value=last_date)
+    # The second date is missing while the user is still picking the range
+    start_date, end_date = date_range if len(date_range) == 2 else (date_range[0], last_date)
 
     # Visualization: Market Overview
     st.header("Market Price Trends")
-    fig = utils.plot_avg_price_trend(df)
+    # Daily averages come pre-aggregated from the ETL, so this does not grow with the history
+    trend_df = utils.daily_price_stats(start_date=start_date, end_date=end_date)
+    fig = utils.plot_avg_price_trend(trend_df)
     st.plotly_chart(fig, use_container_width=True)
 
-    # Filter data for the selected brand and model
-    df = df[(df['brand'] == selected_brand) & (df['model'] == selected_model)]
+    # Summary statistics of the selected model, or family, on the last day it was listed
+    model_stats = utils.daily_price_stats(selected_brand, selected_model, start_date, end_date, family=family)
+    if not model_stats.empty:
+        latest = model_stats.iloc[-1]
+        st.subheader(f"{label} on {latest['date_gathered']}")
+        col1, col2, col3, col4 = st.columns(4)
+        col1.metric("Listings", f"{latest['listings']:,}")
+        col2.metric("Median Price", f"${latest['median_price']:,.0f}")
+        col3.metric("Middle 50%", f"${latest['p25_price']:,.0f} - ${latest['p75_price']:,.0f}")
+        col4.metric("Range", f"${latest['min_price']:,.0f} - ${latest['max_price']:,.0f}")
+
+    # Only the selected brand and model, or family, are fetched, rows where price is 0 are excluded
+    df = utils.fetch_listings(selected_brand, selected_model, start_date, end_date, family=family)
 
     # Tabs for additional analysis
-    tab1, tab2, tab3 = st.tabs(["📈 Below Market", "📉 Undervalued", "📊 Price Distribution"])
+    tab1, tab2, tab3, tab4 = st.tabs(["📈 Below Market", "📉 Undervalued", "📊 Price Distribution", "💎 Best Deals"])
 
     with tab1:
-        st.subheader(f"{selected_model} Watches Below Market Price")
-        below_market_df = df[(df['brand'] == selected_brand) & 
-                             (df['model'] == selected_model) & 
-                             (df['price'] < df['price'].quantile(0.25))]
+        st.subheader(f"{label} Watches Below Market Price")
+        # The 25th percentile comes from the daily quantile sketches, only cheaper listings are fetched
+        below_market_df = utils.percentile_filtering(selected_brand, selected_model, start_date, end_date, percentile=25,
+                                                     family=family)
         st.dataframe(below_market_df[['model', 'price', 'certification_status', 'url', 'date_gathered']])
     
     with tab2:
@@ -41,17 +66,19 @@ def home_page():
         # Dropdown for selecting analysis method
         analysis_method = st.selectbox(
             "Choose an analysis method:",
-            ["Z-Score Analysis", "Percentile Filtering", "Regression Residuals"]
+            ["Z-Score Analysis", "Percentile Filtering", "Regression Residuals", "All Models"]
         )
 
         if analysis_method == "Z-Score Analysis":
             st.write("### Z-Score Outliers")
-            z_outliers = utils.z_score_outliers(df)
+            # Mean and standard deviation come from the daily aggregates, only outliers are fetched
+            z_outliers = utils.z_score_outliers(selected_brand, selected_model, start_date, end_date, family=family)
             st.dataframe(z_outliers)
 
         elif analysis_method == "Percentile Filtering":
             st.write("### Percentile Filtering (20th Percentile)")
-            percentile_outliers = utils.percentile_filtering(df, percentile=20)
+            percentile_outliers = utils.percentile_filtering(selected_brand, selected_model, start_date, end_date,
+                                                             percentile=20, family=family)
             st.dataframe(percentile_outliers)
 
         elif analysis_method == "Regression Residuals":
@@ -59,16 +86,32 @@ def home_page():
             regression_outliers = utils.regression_residuals(df)
             st.dataframe(regression_outliers)
 
+        elif analysis_method == "All Models":
+            st.write("### Below-Market Listings of Every Model")
+            # Z-scores, MAD scores and IQR bounds of every reference family in one grouped pass
+            st.dataframe(utils.market_outliers(start_date, end_date))
+
     with tab3:
         st.subheader("Price Distribution Analysis")
         plot_type = st.radio("Select Plot Type", ["Box Plot", "Normal Distribution"])
 
         if plot_type == "Box Plot":
-            st.plotly_chart(utils.plot_box_plot(df), use_container_width=True)
+            box_x = 'model' if selected_model is not None else 'reference_family'
+            st.plotly_chart(utils.plot_box_plot(df, x=box_x), use_container_width=True)
         
         elif plot_type == "Normal Distribution":
             norm_fig = utils.plot_normal_distribution(df)
             st.plotly_chart(norm_fig, use_container_width=True)
 
+    with tab4:
+        st.subheader("Best Deals Across All Brands")
+        # Scored by the ETL after every load, ranked by a single indexed query
+        deals = utils.best_deals(limit=50)
+        if deals is None:
+            st.info("Deals are scored after the next ETL load, or run python -m src.deal_scores.")
+        else:
+            st.caption("deal_score: standard deviations below the model's recent average price and the price model's estimate.")
+            st.dataframe(deals, hide_index=True)
+
 if __name__ == "__main__":
     home_page()
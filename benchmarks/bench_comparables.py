@@ -0,0 +1,100 @@
+"""
+Measures the comparables index of src/comparables.py on a synthetic catalog with
+the families of notebooks/watch_type_titles.json: the time to build it, to update
+it with a share of listings added or repriced as after an ETL run, and the latency
+of comparables() queries, against a brute-force scan of the vectors of the
+listing's brand. Checks that both find the same distances.
+
+    python -m benchmarks.bench_comparables --listings 1000000 --changed 0.01 --queries 1000
+"""
+import argparse
+import json
+import time
+
+import numpy as np
+import pandas as pd
+
+from src.comparables import ComparablesIndex
+from src.title_index import VOCABULARY_PATH
+
+
+def synthetic_catalog(listings, seed=0, first_id=0):
+    rng = np.random.default_rng(seed)
+    with open(VOCABULARY_PATH, encoding='utf-8') as vocabulary_file:
+        families = [(brand, family) for brand, names in json.load(vocabulary_file).items() for family in names]
+    # A few families account for most listings, as on chrono24
+    picks = np.minimum(rng.zipf(1.3, listings), len(families)) - 1
+    brands, family_names = (np.array(values, dtype=object) for values in zip(*(families[pick] for pick in picks)))
+    base_price = np.exp(rng.uniform(7, 12, len(families)))
+    scopes = np.array(['Original box, original papers', 'Original box, no original papers',
+                       'No original box, no original papers', None], dtype=object)
+    return pd.DataFrame({
+        'id': np.arange(first_id, first_id + listings),
+        'listing_id': pd.Series(np.arange(first_id, first_id + listings)).astype(str),
+        'date_gathered': pd.Timestamp('2024-06-30') - pd.to_timedelta(rng.integers(0, 90, listings), unit='D'),
+        'brand': brands,
+        'model': family_names + ' Ref',
+        'reference_family': family_names,
+        'price': base_price[picks] * rng.lognormal(0, 0.4, listings),
+        'certification_status': rng.choice(['Chrono24 Certified', 'null'], listings, p=[0.1, 0.9]),
+        'url': '',
+        'production_year': np.where(rng.random(listings) < 0.6, rng.integers(1970, 2025, listings).astype(str), 'Unknown'),
+        'case_diameter': np.where(rng.random(listings) < 0.7, np.char.add(rng.integers(28, 47, listings).astype(str), ' mm'), 'null'),
+        'delivery_scope': rng.choice(scopes, listings),
+    })
+
+
+def brute_force(index, listing_id, k):
+    # Every listing of the brand is scored, the family's first
+    position = index.catalog.index.get_loc(listing_id)
+    brands, families = index.catalog['brand'].to_numpy(), index.catalog['reference_family'].to_numpy()
+    of_brand = np.flatnonzero(brands == brands[position])
+    distances = np.sqrt(((index.vectors[of_brand] - index.vectors[position]) ** 2).sum(axis=1))
+    order = np.lexsort((distances, families[of_brand] != families[position]))
+    order = order[of_brand[order] != position][:k]
+    return distances[order]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--listings', type=int, default=1000000)
+    parser.add_argument('--changed', type=float, default=0.01)
+    parser.add_argument('--queries', type=int, default=1000)
+    parser.add_argument('--k', type=int, default=10)
+    args = parser.parse_args()
+
+    catalog = synthetic_catalog(args.listings)
+    index = ComparablesIndex()
+    start_time = time.perf_counter()
+    index.update(catalog)
+    print(f"Built the index of {len(index.catalog)} listings in {len(index.family_trees)} families "
+          f"in {time.perf_counter() - start_time:.2f} s")
+
+    # Listings repriced and new listings, as after an ETL run
+    rng = np.random.default_rng(1)
+    changed = catalog.sample(int(args.listings * args.changed) // 2, random_state=1)
+    changed = changed.assign(price=changed['price'] * rng.uniform(0.9, 1.0, len(changed)),
+                             date_gathered=pd.Timestamp('2024-07-01'))
+    added = synthetic_catalog(int(args.listings * args.changed) // 2, seed=2, first_id=args.listings)
+    start_time = time.perf_counter()
+    trees = index.update(pd.concat([changed, added]), expire_before=pd.Timestamp('2024-04-03'))
+    print(f"Updated {len(changed) + len(added)} listings, rebuilt {trees} of "
+          f"{len(index.family_trees) + len(index.brand_trees)} trees in {time.perf_counter() - start_time:.2f} s")
+
+    listing_ids = index.catalog.index.to_numpy()[rng.integers(0, len(index.catalog), args.queries)]
+    for name, query in [('KD-tree index', lambda listing_id: index.comparables(listing_id, args.k)['distance'].to_numpy()),
+                        ('brute force', lambda listing_id: brute_force(index, listing_id, args.k))]:
+        latencies, results = [], []
+        for listing_id in listing_ids:
+            start_time = time.perf_counter()
+            results.append(query(listing_id))
+            latencies.append((time.perf_counter() - start_time) * 1000)
+        if name == 'KD-tree index':
+            expected = results
+        same = all(np.allclose(result, reference) for result, reference in zip(results, expected))
+        print(f"{name:>14}: median {np.median(latencies):7.2f} ms, p99 {np.percentile(latencies, 99):7.2f} ms "
+              f"per query, {'same' if same else 'DIFFERENT'} distances as the index")
+
+
+if __name__ == "__main__":
+    main()
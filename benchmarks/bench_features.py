@@ -0,0 +1,77 @@
+"""
+Compares the encodings of src/features.py on synthetic listings with thousands of
+merchants and tens of thousands of titles: the time to fit the preprocessor, the
+width and memory of its output (and what the same matrix would take dense), the
+peak memory allocated while encoding, and the time to fit a Ridge regression on it.
+
+    python -m benchmarks.bench_features --rows 300000 --merchants 5000 --titles 30000
+"""
+import argparse
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+from sklearn.linear_model import Ridge
+
+from src.features import ENCODINGS, build_preprocessor, matrix_bytes
+
+
+def synthetic_listings(rows, merchants, titles, seed=0):
+    rng = np.random.default_rng(seed)
+    # A few merchants and models account for most listings, as on chrono24
+    merchant = np.minimum(rng.zipf(1.3, rows), merchants) - 1
+    title = np.minimum(rng.zipf(1.2, rows), titles) - 1
+    price = 5000 + 20000 * rng.random(titles)[title] + 3000 * rng.standard_normal(rows)
+    listings = pd.DataFrame({
+        'certification_status': rng.choice(['Unknown', 'Chrono24 Certified'], rows),
+        'condition': rng.choice(['Unknown', 'New', 'Used'], rows),
+        'badge': rng.choice(['null', 'Top Seller', 'Professional Seller'], rows),
+        'merchant_name': pd.Series(merchant).map('Dealer {}'.format),
+        'model': pd.Series(title).map('Reference {}'.format),
+        'delivery_scope': rng.choice(['Original box, original papers', 'No original box, no original papers'], rows),
+        'shipping_price': rng.choice([0.0, 150.0, np.nan], rows),
+        # Only detailed listings have their production year, case diameter and merchant rating
+        'production_year': np.where(rng.random(rows) < 0.6, rng.integers(1970, 2025, rows), np.nan),
+        'case_diameter_mm': np.where(rng.random(rows) < 0.6, rng.integers(28, 47, rows), np.nan),
+        'merchant_rating': np.where(rng.random(rows) < 0.6, rng.uniform(3.5, 5.0, rows).round(1), np.nan),
+    })
+    return listings, price
+
+
+def measure(encoding, listings, price):
+    preprocessor = build_preprocessor(encoding)
+    tracemalloc.start()
+    start_time = time.perf_counter()
+    features = preprocessor.fit_transform(listings, price)
+    encode_seconds = time.perf_counter() - start_time
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    start_time = time.perf_counter()
+    Ridge(alpha=1.0, solver='sparse_cg' if hasattr(features, 'indptr') else 'auto').fit(features, price)
+    fit_seconds = time.perf_counter() - start_time
+
+    dense_bytes = features.shape[0] * features.shape[1] * 8
+    print(f"{encoding:>14}: {features.shape[1]:>6} columns, {'sparse' if hasattr(features, 'indptr') else 'dense':>6}, "
+          f"{matrix_bytes(features) / 2 ** 20:7.1f} MB ({dense_bytes / 2 ** 20:9.1f} MB dense), "
+          f"encoded in {encode_seconds:5.2f} s with {peak / 2 ** 20:7.1f} MB peak, Ridge fit {fit_seconds:5.2f} s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--rows', type=int, default=300000)
+    parser.add_argument('--merchants', type=int, default=5000)
+    parser.add_argument('--titles', type=int, default=30000)
+    parser.add_argument('--encodings', nargs='+', default=ENCODINGS, choices=ENCODINGS)
+    args = parser.parse_args()
+
+    listings, price = synthetic_listings(args.rows, args.merchants, args.titles)
+    print(f"{args.rows} listings, {listings['merchant_name'].nunique()} merchants, "
+          f"{listings['model'].nunique()} titles")
+    for encoding in args.encodings:
+        measure(encoding, listings, price)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,116 @@
+"""
+Compares reading the training features of chrono.watch_prices with their latest
+chrono.watch_details, joined and parsed at request time, with reading the same
+rows from chrono.listing_features (src/listing_features.py), for every listing
+and for the model with the most listings. Checks that both read the same values,
+and times the ETL refresh of the last day against a full rebuild, both rolled back.
+
+    python -m benchmarks.bench_listing_features --repeat 3
+"""
+import argparse
+import time
+
+import numpy as np
+import pandas as pd
+
+from src.db_pool import get_pool
+from src.features import FEATURE_COLUMNS
+from src.listing_features import PARSED_DETAILS, refresh_listing_features
+from src.normalize import parse_column
+
+DETAIL_COLUMNS = ['delivery_scope'] + [column for column, _ in PARSED_DETAILS.values()]
+LISTING_COLUMNS = [column for column in ['id', 'price', 'brand', *FEATURE_COLUMNS]
+                   if column not in PARSED_DETAILS and column != 'delivery_scope']
+
+# The join the training and the ML page would otherwise run
+JOIN_QUERY = f"""
+    WITH listings AS (
+        SELECT {', '.join(LISTING_COLUMNS)}, listing_id FROM chrono.watch_prices
+        WHERE price IS NOT NULL AND {{scope}}
+    ), details AS (
+        SELECT DISTINCT ON (listing_id) listing_id, {', '.join(DETAIL_COLUMNS)}
+        FROM chrono.watch_details
+        WHERE listing_id IN (SELECT listing_id FROM listings)
+        ORDER BY listing_id, date_gathered DESC, id DESC
+    )
+    SELECT * FROM listings LEFT JOIN details USING (listing_id)
+"""
+
+FEATURES_QUERY = f"""
+    SELECT id, price, brand, {', '.join(FEATURE_COLUMNS)} FROM chrono.listing_features
+    WHERE price IS NOT NULL AND {{scope}}
+"""
+
+
+def _frame(cursor, query, params):
+    cursor.execute(query, params)
+    return pd.DataFrame(cursor.fetchall(), columns=[column.name for column in cursor.description])
+
+
+def joined_features(cursor, scope, params):
+    listings = _frame(cursor, JOIN_QUERY.format(scope=scope), params)
+    listings['price'] = listings['price'].astype('float64')
+    listings['shipping_price'] = listings['shipping_price'].astype('float64')
+    for column, (source, field) in PARSED_DETAILS.items():
+        listings[column] = parse_column(listings.pop(source), field).to_numpy(zero_copy_only=False)
+    return listings
+
+
+def table_features(cursor, scope, params):
+    return _frame(cursor, FEATURES_QUERY.format(scope=scope), params)
+
+
+def same_values(joined, table):
+    joined, table = (frame.set_index('id').sort_index() for frame in (joined, table))
+    columns = ['price', 'brand', *FEATURE_COLUMNS]
+    numbers = [column for column in columns if column in PARSED_DETAILS or column in ('price', 'shipping_price')]
+    return (joined.index.equals(table.index)
+            and all(np.allclose(joined[column].astype('float64'), table[column].astype('float64'), equal_nan=True)
+                    for column in numbers)
+            and joined[[column for column in columns if column not in numbers]].fillna('').equals(
+                table[[column for column in columns if column not in numbers]].fillna('')))
+
+
+def best_of(repeat, read):
+    seconds = []
+    for _ in range(repeat):
+        start_time = time.perf_counter()
+        frame = read()
+        seconds.append(time.perf_counter() - start_time)
+    return min(seconds), frame
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    with get_pool().connection() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute("SELECT to_regclass('chrono.listing_features') IS NOT NULL")
+            if not cursor.fetchone()[0]:
+                print("No chrono.listing_features yet, run the ETL or python -m src.listing_features first")
+                return
+            cursor.execute("SELECT brand, model, count(*) FROM chrono.watch_prices WHERE price IS NOT NULL "
+                           "GROUP BY brand, model ORDER BY count(*) DESC LIMIT 1")
+            brand, model, _ = cursor.fetchone()
+            for label, scope, params in [('every listing', 'TRUE', {}),
+                                         (f'{brand} {model}', 'brand = %(brand)s AND model = %(model)s',
+                                          {'brand': brand, 'model': model})]:
+                join_seconds, joined = best_of(args.repeat, lambda: joined_features(cursor, scope, params))
+                table_seconds, table = best_of(args.repeat, lambda: table_features(cursor, scope, params))
+                print(f"{label}: {len(table)} rows, join and parse {join_seconds * 1000:.1f} ms, "
+                      f"feature table {table_seconds * 1000:.1f} ms, "
+                      f"{'same' if same_values(joined, table) else 'DIFFERENT'} values")
+
+            cursor.execute("SELECT max(date_gathered)::text FROM chrono.watch_prices")
+            last_date = cursor.fetchone()[0]
+            for label, dates in [(f'refresh of {last_date}', [last_date]), ('full rebuild', None)]:
+                start_time = time.perf_counter()
+                rows = refresh_listing_features(cursor, dates)
+                print(f"{label:>24}: {rows} rows changed in {time.perf_counter() - start_time:.2f} s")
+        conn.rollback()
+
+
+if __name__ == "__main__":
+    main()
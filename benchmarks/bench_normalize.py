@@ -0,0 +1,139 @@
+"""
+Compares the per-listing normalization loop the ETL used to run with the
+vectorized normalize_listings() on synthetic chrono24 search_detail results,
+both on their own and up to the buffer that BulkLoader hands to COPY.
+
+    python -m benchmarks.bench_normalize --rows 50000
+"""
+import argparse
+import io
+import random
+import time
+
+import pyarrow.csv as pa_csv
+
+from src.bulk_loader import WATCH_DETAILS_COLUMNS, WATCH_PRICES_COLUMNS, _copy_value
+from src.normalize import normalize_listings, to_rows
+
+
+def synthetic_listings(count, seed=0):
+    rng = random.Random(seed)
+    listings = []
+    for i in range(count):
+        listings.append({
+            'id': 10000000 + i, 'url': f'https://www.chrono24.com/rolex/id{i}.htm', 'manufacturer': 'Rolex',
+            'certification_status': 'Unknown', 'title': 'Rolex Submariner Date 126610LN',
+            'description': 'Steel, 41 mm', 'price': rng.choice([f'${rng.randint(3000, 90000):,}', 'Price on request']),
+            'shipping_price': rng.choice(['$150', 'null']), 'location': 'United States of America',
+            'merchant_name': 'Dealer', 'badge': 'null', 'image_urls': ['https://img.chrono24.com/1.jpg'],
+            'year_of_production': rng.choice(['2021', 'Unknown', '1995 (Approximation)']),
+            'scope_of_delivery': 'Original box, original papers', 'availability': 'Item is in stock',
+            'case_diameter': rng.choice(['41 mm', '40 x 40 mm', 'null']), 'bracelet_color': 'Steel',
+            'anticipated_delivery': '2-8 days', 'merchant_rating': rng.choice(['4.8', 'null']),
+            'merchant_reviews': f'{rng.randint(1, 5000):,}',
+        })
+    return listings
+
+
+def _number(value):
+    try:
+        return float(value.replace('$', '').replace(',', ''))
+    except (AttributeError, ValueError):
+        return 0.0
+
+
+def loop_normalize(listings, category, current_date):
+    """
+    The row-at-a-time conversion previously inlined in the ETL scripts.
+    """
+    prices, details = [], []
+    for watch in listings:
+        image_urls = watch.get('image_urls', [])
+        prices.append((
+            str(watch.get('id', '0')), category, watch.get('manufacturer', 'Unknown'), watch.get('title', 'Unknown'),
+            _number(watch.get('price', '0')), _number(watch.get('shipping_price', '0')),
+            watch.get('certification_status', 'Unknown'), 'USD', 'Unknown',
+            watch.get('description', 'No description available'), watch.get('url', ''),
+            watch.get('merchant_name', 'Unknown'), watch.get('location', 'Unknown'), watch.get('badge', 'Unknown'),
+            image_urls[0] if image_urls else '', current_date
+        ))
+        details.append((
+            str(watch.get('id', '0')), watch.get('year_of_production', 'Unknown'),
+            watch.get('scope_of_delivery', 'Unknown'), watch.get('availability', 'Unknown'),
+            watch.get('case_diameter', 'Unknown'), watch.get('bracelet_color', 'Unknown'),
+            watch.get('anticipated_delivery', 'Unknown'), _number(watch.get('merchant_rating', '0')),
+            _number(watch.get('merchant_reviews', '0')), current_date
+        ))
+    return prices, details
+
+
+def vectorized_normalize(listings, category, current_date):
+    return normalize_listings(listings, category, current_date)
+
+
+def vectorized_rows(listings, category, current_date):
+    normalized = normalize_listings(listings, category, current_date)
+    return to_rows(normalized, WATCH_PRICES_COLUMNS), to_rows(normalized, WATCH_DETAILS_COLUMNS)
+
+
+def loop_copy_buffers(listings, category, current_date):
+    # BulkLoader's COPY text format for tuples
+    buffers = []
+    for rows in loop_normalize(listings, category, current_date):
+        buffer = io.StringIO()
+        for row in rows:
+            buffer.write('\t'.join(map(_copy_value, row)))
+            buffer.write('\n')
+        buffers.append(buffer)
+    return buffers
+
+
+def vectorized_copy_buffers(listings, category, current_date):
+    # BulkLoader's CSV COPY for Arrow tables
+    normalized = normalize_listings(listings, category, current_date)
+    buffers = []
+    for columns in (WATCH_PRICES_COLUMNS, WATCH_DETAILS_COLUMNS):
+        buffer = io.BytesIO()
+        pa_csv.write_csv(normalized.select(columns), buffer, pa_csv.WriteOptions(include_header=False))
+        buffers.append(buffer)
+    return buffers
+
+
+def best_rate(function, listings, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        start_time = time.perf_counter()
+        function(listings, 'Rolex', '2024-01-01')
+        best = min(best, time.perf_counter() - start_time)
+    return len(listings) / best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--rows', type=int, default=50000)
+    parser.add_argument('--chunk-size', type=int, default=500, help="listings per call, as written by the pipeline")
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    listings = synthetic_listings(args.rows)
+    chunks = [listings[start:start + args.chunk_size] for start in range(0, len(listings), args.chunk_size)]
+
+    def per_chunk(function):
+        return lambda data, category, current_date: [function(chunk, category, current_date) for chunk in chunks]
+
+    print(f"{args.rows} listings, rows/sec in one batch and in chunks of {args.chunk_size}")
+    cases = (
+        ('loop to tuples', loop_normalize),
+        ('vectorized to table', vectorized_normalize),
+        ('vectorized to tuples', vectorized_rows),
+        ('loop to COPY buffer', loop_copy_buffers),
+        ('vectorized to COPY buffer', vectorized_copy_buffers),
+    )
+    for name, function in cases:
+        whole = best_rate(function, listings, args.repeat)
+        chunked = best_rate(per_chunk(function), listings, args.repeat)
+        print(f"{name:>26}: {whole:>10,.0f} {chunked:>10,.0f}")
+
+
+if __name__ == "__main__":
+    main()
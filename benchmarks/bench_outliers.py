@@ -0,0 +1,89 @@
+"""
+Compares ways of finding the below-market listings of every model by z-score,
+MAD score and interquartile range on synthetic listings: the previous loop over
+models, each scored on its own pre-filtered slice, pandas groupby aggregations
+joined back to the rows, and the one-pass price_outliers() of src/price_stats.py.
+Reports the time of each and checks that they flag the same listings.
+
+    python -m benchmarks.bench_outliers --rows 1000000 --models 2000
+"""
+import argparse
+import time
+
+import numpy as np
+import pandas as pd
+
+from src.price_stats import MAD_SCALE, price_outliers
+
+Z_THRESHOLD, MAD_THRESHOLD, IQR_FACTOR = -2.0, -3.5, 1.5
+
+
+def synthetic_listings(rows, models, seed=0):
+    rng = np.random.default_rng(seed)
+    model = np.minimum(rng.zipf(1.3, rows), models) - 1
+    base_price = np.exp(rng.uniform(7, 12, models))
+    prices = base_price[model] * rng.lognormal(0, 0.3, rows)
+    # A few listings far under their model's price
+    cheap = rng.random(rows) < 0.01
+    prices[cheap] *= rng.uniform(0.1, 0.5, cheap.sum())
+    return pd.DataFrame({
+        'brand': pd.Categorical(pd.Series(model % 40).map('Brand {}'.format)),
+        'model': pd.Series(model).map('Model {}'.format),
+        'price': prices,
+    })
+
+
+def _flag(prices, mean, std, median, mad, p25, p75):
+    with np.errstate(divide='ignore', invalid='ignore'):
+        z_scores = (prices - mean) / std
+        mad_scores = np.where(mad > 0, MAD_SCALE * (prices - median) / mad, np.nan)
+    return (z_scores <= Z_THRESHOLD) | (mad_scores <= MAD_THRESHOLD) | (prices < p25 - IQR_FACTOR * (p75 - p25))
+
+
+def per_model_loop(listings):
+    flagged = []
+    for brand, model in listings[['brand', 'model']].drop_duplicates().itertuples(index=False):
+        prices = listings[(listings['brand'] == brand) & (listings['model'] == model)]['price']
+        median = prices.median()
+        mask = _flag(prices.to_numpy(), prices.mean(), prices.std(), median, (prices - median).abs().median(),
+                     prices.quantile(0.25), prices.quantile(0.75))
+        flagged.append(prices.index[mask])
+    return np.concatenate(flagged)
+
+
+def groupby_join(listings):
+    groups = listings.groupby(['brand', 'model'], observed=True)['price']
+    stats = groups.agg(['mean', 'std', 'median'])
+    stats['p25'], stats['p75'] = groups.quantile(0.25), groups.quantile(0.75)
+    rows = listings[['brand', 'model', 'price']].join(stats, on=['brand', 'model'])
+    stats['mad'] = (rows['price'] - rows['median']).abs().groupby([rows['brand'], rows['model']], observed=True).median()
+    rows = rows.join(stats['mad'], on=['brand', 'model'])
+    mask = _flag(*(rows[column].to_numpy() for column in ['price', 'mean', 'std', 'median', 'mad', 'p25', 'p75']))
+    return listings.index[mask].to_numpy()
+
+
+def one_pass(listings):
+    return price_outliers(listings).index.to_numpy()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--rows', type=int, default=1000000)
+    parser.add_argument('--models', type=int, default=2000)
+    args = parser.parse_args()
+
+    listings = synthetic_listings(args.rows, args.models)
+    print(f"{len(listings)} listings, {listings.groupby(['brand', 'model'], observed=True).ngroups} models")
+    expected = None
+    for name, method in [('per-model loop', per_model_loop), ('groupby and join', groupby_join),
+                         ('one pass', one_pass)]:
+        start_time = time.perf_counter()
+        flagged = np.sort(method(listings))
+        seconds = time.perf_counter() - start_time
+        expected = flagged if expected is None else expected
+        print(f"{name:>16}: {seconds:7.3f} s, {len(flagged)} below-market listings, "
+              f"{'same' if np.array_equal(flagged, expected) else 'DIFFERENT'} as the per-model loop")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+"""
+Compares the quantiles of the merged daily price sketches with exact pandas
+quantiles for every model in chrono.watch_prices, over the full history and the
+last days, reporting the largest relative error and the time each takes.
+
+    python -m benchmarks.bench_price_sketch --days 7
+"""
+import argparse
+import time
+
+import numpy as np
+import pandas as pd
+
+from src.db_pool import get_pool
+from src.price_sketch import RELATIVE_ACCURACY, PriceSketch
+
+QUANTILES = (0.01, 0.05, 0.2, 0.25, 0.5, 0.75, 0.95, 0.99)
+
+SKETCH_QUERY = """
+    SELECT bucket, sum(listings) FROM chrono.daily_model_price_sketches
+    WHERE brand = %s AND model = %s AND date_gathered >= coalesce(%s, '-infinity'::date)
+    GROUP BY bucket
+"""
+
+
+def compare(conn, listings, start_date=None):
+    worst, exact_seconds, sketch_seconds = 0.0, 0.0, 0.0
+    for (brand, model), prices in listings.groupby(['brand', 'model'])[['price', 'date_gathered']]:
+        if start_date is not None:
+            prices = prices[prices['date_gathered'] >= start_date]
+        if prices.empty:
+            continue
+        start_time = time.perf_counter()
+        exact = prices['price'].quantile(list(QUANTILES)).to_numpy()
+        exact_seconds += time.perf_counter() - start_time
+
+        start_time = time.perf_counter()
+        with conn.cursor() as cursor:
+            cursor.execute(SKETCH_QUERY, (brand, model, start_date))
+            buckets = np.array(cursor.fetchall(), dtype='int64').reshape(-1, 2)
+        estimate = PriceSketch(buckets[:, 0], buckets[:, 1]).quantile(QUANTILES)
+        sketch_seconds += time.perf_counter() - start_time
+        worst = max(worst, float(np.max(np.abs(estimate - exact) / exact)))
+    return worst, exact_seconds, sketch_seconds
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--days', type=int, default=7, help="length of the recent date range")
+    args = parser.parse_args()
+
+    with get_pool().connection() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute("SELECT max(date_gathered) FROM chrono.daily_model_price_sketches")
+            last_date = cursor.fetchone()[0]
+            cursor.execute("SELECT brand, model, price::float8, date_gathered FROM chrono.watch_prices "
+                           "WHERE price > 0 AND brand IS NOT NULL AND model IS NOT NULL")
+            listings = pd.DataFrame(cursor.fetchall(), columns=['brand', 'model', 'price', 'date_gathered'])
+        if last_date is None or listings.empty:
+            print("No sketches or priced listings to compare, run the ETL or python -m src.daily_stats first")
+            return
+
+        print(f"{len(listings)} priced listings, {listings.groupby(['brand', 'model']).ngroups} models")
+        for label, start_date in [('full history', None),
+                                  (f'last {args.days} days', last_date - pd.Timedelta(days=args.days - 1))]:
+            worst, exact_seconds, sketch_seconds = compare(conn, listings, start_date)
+            print(f"{label:>14}: max relative error {worst:.4%} (bound {RELATIVE_ACCURACY:.0%}), "
+                  f"pandas {exact_seconds * 1000:.1f} ms on prices already in memory, "
+                  f"sketches {sketch_seconds * 1000:.1f} ms including the queries")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,51 @@
+"""
+Measures the dashboard's cold-start data load from PostgreSQL (the previous
+SELECT * through pd.read_sql) and from the Parquet snapshot. Each source is
+loaded in a fresh interpreter, reporting load time and the peak RSS added by
+the load.
+
+    python -m benchmarks.bench_snapshot
+"""
+import argparse
+import resource
+import subprocess
+import sys
+import time
+
+
+def _peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def load(source):
+    import pandas as pd
+    from src.db_pool import create_pooled_engine
+    from src.snapshot import ANALYTIC_COLUMNS, read_snapshot
+
+    engine = create_pooled_engine() if source == 'postgres' else None
+    baseline = _peak_rss_mb()
+    start_time = time.perf_counter()
+    if source == 'postgres':
+        df = pd.read_sql("SELECT * FROM chrono.watch_prices", engine)
+    else:
+        df = read_snapshot(ANALYTIC_COLUMNS)
+    elapsed = time.perf_counter() - start_time
+    print(f"{source:>9}: {len(df)} rows in {elapsed:.2f} seconds, "
+          f"+{_peak_rss_mb() - baseline:.0f} MB peak RSS, {df.memory_usage(deep=True).sum() / 1024 ** 2:.0f} MB frame")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--source', choices=('postgres', 'snapshot'), help="load one source in this process")
+    args = parser.parse_args()
+
+    if args.source:
+        load(args.source)
+        return
+    for source in ('postgres', 'snapshot'):
+        subprocess.run([sys.executable, '-m', 'benchmarks.bench_snapshot', '--source', source], check=False)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+"""
+Measures how many listing titles per second src/title_index.py maps to their
+reference family, on synthetic titles built from notebooks/watch_type_titles.json
+with reference numbers, years, sizes and mixed case added: a scan testing every
+family name of the brand against each title, the Aho-Corasick TitleIndex per
+title, and TitleIndex.families_of(), which matches each distinct title once as the
+ETL does. Checks that all three find the same families.
+
+    python -m benchmarks.bench_title_index --titles 1000000 --distinct 50000
+"""
+import argparse
+import json
+import time
+
+import numpy as np
+
+from src.title_index import VOCABULARY_PATH, TitleIndex, title_words
+
+
+def synthetic_titles(vocabulary, titles, distinct, seed=0):
+    rng = np.random.default_rng(seed)
+    families = [(brand, family) for brand, names in vocabulary.items() for family in names]
+    extras = ['Automatic', 'Steel', 'Box & Papers', 'LC100', 'Full Set', 'Unworn', '2021', 'B&P', 'Gold', 'Ceramic']
+    pool = []
+    for _ in range(distinct):
+        brand, family = families[rng.integers(len(families))]
+        words = family.split()
+        if rng.random() < 0.3:
+            words = [word.upper() if rng.random() < 0.5 else word.lower() for word in words]
+        if rng.random() < 0.2:
+            # Titles that name no family at all
+            words = [brand]
+        words += [f"{rng.integers(1000, 999999)}{rng.choice(['', 'LN', 'A', '/1A'])}", f"{rng.integers(28, 47)}mm"]
+        words += list(rng.choice(extras, rng.integers(0, 3), replace=False))
+        pool.append((brand, ' '.join(words)))
+    # A few titles account for most listings, as on chrono24
+    picks = np.minimum(rng.zipf(1.2, titles), distinct) - 1
+    return [pool[pick] for pick in picks]
+
+
+class FamilyScan:
+    """
+    The same matching without an automaton: every family name of the title's brand is searched for in the title.
+    """
+    def __init__(self, vocabulary):
+        self._families = {}
+        self._catch_all = {}
+        for brand, names in vocabulary.items():
+            brand_words = title_words(brand)
+            brand_key = ' '.join(brand_words)
+            patterns = []
+            for name in names:
+                words = title_words(name)
+                if words[:len(brand_words)] == brand_words:
+                    words = words[len(brand_words):]
+                if words:
+                    patterns.append((f" {' '.join(words)} ", len(words), name))
+                else:
+                    self._catch_all.setdefault(brand_key, name)
+            self._families[brand_key] = patterns
+
+    def family(self, brand, title):
+        brand_key = ' '.join(title_words(brand))
+        if brand_key not in self._families:
+            return None
+        text = f" {' '.join(title_words(title))} "
+        best = None
+        for pattern, length, name in self._families[brand_key]:
+            position = text.find(pattern)
+            if position >= 0 and (best is None or (-length, position) < (-best[0], best[1])):
+                best = (length, position, name)
+        return best[2] if best is not None else self._catch_all.get(brand_key)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--titles', type=int, default=1000000)
+    parser.add_argument('--distinct', type=int, default=50000)
+    args = parser.parse_args()
+
+    with open(VOCABULARY_PATH, encoding='utf-8') as vocabulary_file:
+        vocabulary = json.load(vocabulary_file)
+    start_time = time.perf_counter()
+    index = TitleIndex(vocabulary)
+    print(f"Built the index of {index.families} families of {len(vocabulary)} brands "
+          f"in {(time.perf_counter() - start_time) * 1000:.1f} ms")
+
+    titles = synthetic_titles(vocabulary, args.titles, args.distinct)
+    brands, texts = zip(*titles)
+    print(f"{len(titles)} titles, {len(set(titles))} distinct")
+
+    scan = FamilyScan(vocabulary)
+    methods = [
+        ('family scan', lambda: [scan.family(brand, text) for brand, text in titles]),
+        ('automaton', lambda: [index.family(brand, text) for brand, text in titles]),
+        ('distinct titles', lambda: index.families_of(brands, texts)),
+    ]
+    expected = None
+    for name, method in methods:
+        start_time = time.perf_counter()
+        families = method()
+        seconds = time.perf_counter() - start_time
+        expected = families if expected is None else expected
+        matched = sum(family is not None for family in families)
+        print(f"{name:>16}: {seconds:7.3f} s, {len(titles) / seconds:12,.0f} titles/s, {matched} with a family, "
+              f"{'same' if families == expected else 'DIFFERENT'} as the family scan")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,107 +1,97 @@
 import chrono24
-import psycopg2
-from psycopg2 import sql
 from dotenv import load_dotenv
 import os
 import time
+import pyarrow as pa
+import pyarrow.compute as pc
+from src.db_pool import get_pool
+from src.bulk_loader import BulkLoader, WATCH_PRICES_COLUMNS
+from src.daily_stats import refresh_daily_stats
+from src.comparables import update_after_load
+from src.deal_scores import score_after_load
+from src.model_registry import train_after_load
+from src.listing_index import ListingIndex
+from src.normalize import normalize_chunk
+from src.pipeline import run_pipeline
+from src.snapshot import snapshot_writer
 
 # Load environment variables from a .env file
 load_dotenv()
 
-# Configuration for the PostgreSQL database connection
-DB_CONFIG = {
-    'dbname': os.getenv('DB_NAME'),
-    'user': os.getenv('DB_USER'),
-    'password': os.getenv('DB_PASSWORD'),
-    'host': os.getenv('DB_HOST'),
-    'port': os.getenv('DB_PORT')
-}
-
 # Categories to query from the Chrono24 API
 CATEGORIES = ["Rolex", "Richard Mille", "Seiko", "Omega", "Patek Philippe", "Panerai", "Breitling", "Audemars Piguet"]
 
+BULK_LOADER = BulkLoader(os.getenv('LOAD_STRATEGY', 'auto'))
+
 def get_watch_prices(category):
-    # Query the Chrono24 API using the category
-    listings = list(chrono24.query(category).search(40000))  # Convert the generator to a list
-    return listings
+    # Query the Chrono24 API using the category, listings are yielded as they are scraped
+    yield from chrono24.query(category).search(40000)
 
-def insert_watch_data(watch_data, category):
+def insert_watch_data(watch_data, category, listing_index):
+    conn = None
     try:
-        # Establish database connection
-        conn = psycopg2.connect(**DB_CONFIG)
-        cursor = conn.cursor()
+        # Borrow a connection from the shared pool
+        conn = get_pool().getconn()
         
         # Get the current date for the date_gathered field
         current_date = time.strftime('%Y-%m-%d')
         
-        # SQL insert query with schema name
-        insert_query = """
-            INSERT INTO chrono.watch_prices (
-                listing_id, category, brand, model, price, shipping_price, certification_status, 
-                currency, condition, description, url, merchant_name, location, badge, image_url, date_gathered
-            ) 
-            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-        """
-        # SQL query to check if the listing_id already exists in the database
-        check_query = "SELECT 1 FROM chrono.watch_prices WHERE listing_id = %s"
-
-        for watch in watch_data:
-            # Extract and convert listing_id to an integer
-            listing_id = int(watch.get('id', '0'))  # Convert the id from string to int
-            brand = watch.get('manufacturer', 'Unknown')
-            model = watch.get('title', 'Unknown')
-
-            # Ensure the price and shipping price are numeric
-            try:
-                price = float(watch.get('price', '0').replace('$', '').replace(',', ''))
-            except ValueError:
-                price = 0.0
+        inserted = 0
+        brands = set()
 
-            try:
-                shipping_price = float(watch.get('shipping_price', '0').replace('$', '').replace(',', ''))
-            except ValueError:
-                shipping_price = 0.0
+        def write_chunk(chunk):
+            nonlocal inserted
+            listings = normalize_chunk(chunk, category, current_date)
 
-            certification_status = watch.get('certification_status', 'Unknown')
-            currency = 'USD'  # Assuming USD as default
-            condition = 'Unknown'
-            description = watch.get('description', 'No description available')
-            url = watch.get('url', '')
-            merchant_name = watch.get('merchant_name', 'Unknown')
-            location = watch.get('location', 'Unknown')
-            badge = watch.get('badge', 'Unknown')
+            # listing_id is stored as an integer
+            listing_ids = pc.cast(listings['listing_id'], pa.int64())
+            listings = listings.set_column(0, 'listing_id', listing_ids)
 
-            # Just grab the first image
-            image_urls = watch.get('image_urls', [])
-            single_image_url = image_urls[0] if image_urls else ''
+            # check if the listing_id already exists in the database or earlier in the chunk
+            batch_ids = set()
+            is_new = []
+            for listing_id in listing_ids.to_pylist():
+                is_new.append(listing_id not in listing_index and listing_id not in batch_ids)
+                batch_ids.add(listing_id)
+            new_listings = listings.filter(pa.array(is_new, pa.bool_()))
 
-            # check if the listing_id already exists in the database
-            cursor.execute(check_query, (listing_id,))
-            exists = cursor.fetchone()
+            # Insert the new listings and commit the chunk
+            BULK_LOADER.load(conn, 'chrono.watch_prices', WATCH_PRICES_COLUMNS, new_listings)
+            conn.commit()
+            snapshot.write(new_listings)
+            brands.update(pc.unique(new_listings['brand']).to_pylist())
+            for listing_id in new_listings['listing_id'].to_pylist():
+                listing_index.add(listing_id)
+            inserted += new_listings.num_rows
 
-            if not exists:
-                # Execute the insert query with the current date for date_gathered
-                cursor.execute(insert_query, (
-                    listing_id, category, brand, model, price, shipping_price, certification_status, 
-                    currency, condition, description, url, merchant_name, location, badge, single_image_url, current_date
-                ))
-        
-        # Commit the transaction
-        conn.commit()
-        cursor.close()
-        conn.close()
-        print(f"Inserted {len(watch_data)} records for category {category}")
+        # Rows are written chunk by chunk while the category is still being scraped
+        with snapshot_writer(category, current_date, replace=False) as snapshot:
+            count = run_pipeline(watch_data, write_chunk)
+        # Recompute today's aggregates of the brands this category loaded
+        refresh_daily_stats(conn, [current_date], brands)
+        print(f"Inserted {inserted} new of {count} records for category {category}")
     
     except Exception as e:
         print(f"Error inserting data: {e}")
+    finally:
+        if conn:
+            get_pool().putconn(conn)
 
 # Main function to gather data and insert it into the database
 def main():
+    # Load the known listing_ids once instead of probing the table per listing
+    with get_pool().connection() as conn:
+        listing_index = ListingIndex.from_database(conn)
+    print(f"Listing index: {listing_index.summary()}")
+
     for category in CATEGORIES:
-        watch_data = get_watch_prices(category)
-        if watch_data:
-            insert_watch_data(watch_data, category)
-            time.sleep(5)  # Sleep for 5 seconds after processing each category
+        insert_watch_data(get_watch_prices(category), category, listing_index)
+        time.sleep(5)  # Sleep for 5 seconds after processing each category
+    score_after_load()
+    update_after_load()
+    train_after_load()
+
+    print(f"Listing index: {listing_index.summary()}")
 
 if __name__ == "__main__":
     main()
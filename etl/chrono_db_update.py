@@ -1,69 +1,56 @@
 import chrono24
-import psycopg2
-from psycopg2 import sql
 from dotenv import load_dotenv
 import os
 import time
+import pyarrow.compute as pc
 from tqdm import tqdm
+from src.db_pool import get_pool
+from src.bulk_loader import BulkLoader, WATCH_PRICES_COLUMNS
+from src.daily_stats import refresh_daily_stats
+from src.comparables import update_after_load
+from src.deal_scores import score_after_load
+from src.model_registry import train_after_load
+from src.normalize import normalize_chunk, to_rows, with_price
+from src.pipeline import run_pipeline
+from src.snapshot import snapshot_writer
+from src.upsert import ensure_unique_index, merge_watch_prices
 
 # Load environment variables from a .env file
 load_dotenv()
 
-# Configuration for the PostgreSQL database connection
-DB_CONFIG = {
-    'dbname': os.getenv('DB_NAME'),
-    'user': os.getenv('DB_USER'),
-    'password': os.getenv('DB_PASSWORD'),
-    'host': os.getenv('DB_HOST'),
-    'port': os.getenv('DB_PORT')
-}
-
 # Categories to query from the Chrono24 API
 CATEGORIES = ["Rolex", "Richard Mille", "Seiko", "Omega", "Patek Philippe", "Panerai", "Breitling", "Audemars Piguet"]
 
+# merge: stage each category and apply it with one INSERT ... ON CONFLICT
+# row: look up, update or insert every listing individually
+UPDATE_MODE = os.getenv('UPDATE_MODE', 'merge')
+BULK_LOADER = BulkLoader(os.getenv('LOAD_STRATEGY', 'auto'))
+
 def get_watch_prices(category):
-    listings = list(chrono24.query(category).search(40000))  # Convert the generator to a list
-    return listings
+    # Listings are yielded as they are scraped
+    yield from chrono24.query(category).search(40000)
+
+def priced_listings(watch_data, category, current_date):
+    """
+    Normalizes a chunk of listings, dropping listings without a positive price.
+    """
+    return with_price(normalize_chunk(watch_data, category, current_date))
 
 def insert_or_update_watch_data(watch_data, category):
+    conn = None
     try:
-        # Establish database connection
-        conn = psycopg2.connect(**DB_CONFIG)
+        # Borrow a connection from the shared pool
+        conn = get_pool().getconn()
         cursor = conn.cursor()
         
         # Get the current date for the date_gathered field
         current_date = time.strftime('%Y-%m-%d')
+        brands = set()
 
-        # Wrap the loop with tqdm for a progress bar
-        for watch in tqdm(watch_data, desc=f"Processing {category}", unit="watch"):
-            # Extract and convert listing_id to a string
-            listing_id = str(watch.get('id', '0'))
-            brand = watch.get('manufacturer', 'Unknown')
-            model = watch.get('title', 'Unknown')
-
-            try:
-                price = float(watch.get('price', '0').replace('$', '').replace(',', ''))
-            except ValueError:
-                price = 0.0
-
-            try:
-                shipping_price = float(watch.get('shipping_price', '0').replace('$', '').replace(',', ''))
-            except ValueError:
-                shipping_price = 0.0
-
-            if price > 0:
-                certification_status = watch.get('certification_status', 'Unknown')
-                currency = 'USD'  # Assuming USD as default
-                condition = 'Unknown'
-                description = watch.get('description', 'No description available')
-                url = watch.get('url', '')
-                merchant_name = watch.get('merchant_name', 'Unknown')
-                location = watch.get('location', 'Unknown')
-                badge = watch.get('badge', 'Unknown')
-
-                # Just grab the first image
-                image_urls = watch.get('image_urls', [])
-                single_image_url = image_urls[0] if image_urls else ''
+        def write_chunk(chunk):
+            listings = priced_listings(chunk, category, current_date)
+            for row in to_rows(listings, WATCH_PRICES_COLUMNS):
+                listing_id, price = row[0], row[4]
 
                 # Check if the listing already exists in the database for today's date
                 cursor.execute("""
@@ -89,30 +76,76 @@ def insert_or_update_watch_data(watch_data, category):
                             currency, condition, description, url, merchant_name, location, badge, image_url, date_gathered
                         ) 
                         VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-                    """, (
-                        listing_id, category, brand, model, price, shipping_price, certification_status, 
-                        currency, condition, description, url, merchant_name, location, badge, single_image_url, current_date
-                    ))
-        
-        # Commit the transaction
-        conn.commit()
+                    """, row)
+            conn.commit()
+            snapshot.write(listings)
+            brands.update(pc.unique(listings['brand']).to_pylist())
+
+        # Wrap the listings with tqdm for a progress bar, each chunk is committed as it is scraped
+        # The day's rows are upserted, so the snapshot keeps the latest run of each category
+        with snapshot_writer(category, current_date) as snapshot:
+            count = run_pipeline(tqdm(watch_data, desc=f"Processing {category}", unit="watch"), write_chunk)
+
         cursor.close()
-        conn.close()
-        print(f"Processed {len(watch_data)} records for category {category}")
+        # Recompute today's aggregates of the brands this category loaded
+        refresh_daily_stats(conn, [current_date], brands)
+        print(f"Processed {count} records for category {category}")
     
     except Exception as e:
         print(f"Error processing data: {e}")
+    finally:
+        if conn:
+            get_pool().putconn(conn)
+
+def merge_watch_data(watch_data, category):
+    conn = None
+    try:
+        # Borrow a connection from the shared pool
+        conn = get_pool().getconn()
+        current_date = time.strftime('%Y-%m-%d')
+
+        counts = {'inserted': 0, 'updated': 0, 'unchanged': 0}
+        brands = set()
+
+        def merge_chunk(chunk):
+            listings = priced_listings(chunk, category, current_date)
+            chunk_counts = merge_watch_prices(conn, to_rows(listings, WATCH_PRICES_COLUMNS), BULK_LOADER)
+            conn.commit()
+            snapshot.write(listings)
+            brands.update(pc.unique(listings['brand']).to_pylist())
+            for key, value in chunk_counts.items():
+                counts[key] += value
+
+        # The day's rows are upserted, so the snapshot keeps the latest run of each category
+        with snapshot_writer(category, current_date) as snapshot:
+            count = run_pipeline(tqdm(watch_data, desc=f"Processing {category}", unit="watch"), merge_chunk)
+        # Recompute today's aggregates of the brands this category loaded
+        refresh_daily_stats(conn, [current_date], brands)
+        print(f"Processed {count} records for category {category}: "
+              f"{counts['inserted']} inserted, {counts['updated']} updated, {counts['unchanged']} unchanged")
+
+    except Exception as e:
+        print(f"Error processing data: {e}")
+    finally:
+        if conn:
+            get_pool().putconn(conn)
 
 # Main function to gather data and process it
 def main():
     start_time = time.time()  # Capture start time
 
+    if UPDATE_MODE == 'merge':
+        with get_pool().connection() as conn:
+            ensure_unique_index(conn)
+    process_watch_data = merge_watch_data if UPDATE_MODE == 'merge' else insert_or_update_watch_data
+
     # Wrap the outer loop with tqdm for a progress bar for categories
     for category in tqdm(CATEGORIES, desc="Categories"):
-        watch_data = get_watch_prices(category)
-        if watch_data:
-            insert_or_update_watch_data(watch_data, category)
-            time.sleep(5)  # Sleep for 5 seconds after processing each category
+        process_watch_data(get_watch_prices(category), category)
+        time.sleep(5)  # Sleep for 5 seconds after processing each category
+    score_after_load()
+    update_after_load()
+    train_after_load()
 
     end_time = time.time()  # Capture end time
     total_runtime = end_time - start_time  # Calculate total runtime
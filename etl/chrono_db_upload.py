@@ -1,34 +1,33 @@
 import chrono24
-import psycopg2
-from psycopg2 import sql
 from dotenv import load_dotenv
-import os
 import time
+import pyarrow as pa
+import pyarrow.compute as pc
+from src.db_pool import get_pool
+from src.bulk_loader import WATCH_PRICES_COLUMNS
+from src.daily_stats import refresh_daily_stats
+from src.comparables import update_after_load
+from src.deal_scores import score_after_load
+from src.model_registry import train_after_load
+from src.normalize import normalize_chunk, to_rows, with_price
+from src.pipeline import run_pipeline
+from src.snapshot import snapshot_writer
 
 # Load environment variables from a .env file
 load_dotenv()
 
-# Configuration for the PostgreSQL database connection
-DB_CONFIG = {
-    'dbname': os.getenv('DB_NAME'),
-    'user': os.getenv('DB_USER'),
-    'password': os.getenv('DB_PASSWORD'),
-    'host': os.getenv('DB_HOST'),
-    'port': os.getenv('DB_PORT')
-}
-
 # Categories to query from the Chrono24 API
 CATEGORIES = ["Rolex", "Richard Mille", "Seiko", "Omega", "Patek Philippe", "Panerai", "Breitling", "Audemars Piguet"]
 
 def get_watch_prices(category):
-    # Query the Chrono24 API using the category
-    listings = list(chrono24.query(category).search(40000))  # Convert the generator to a list
-    return listings
+    # Query the Chrono24 API using the category, listings are yielded as they are scraped
+    yield from chrono24.query(category).search(40000)
 
 def insert_watch_data(watch_data, category):
+    conn = None
     try:
-        # Establish database connection
-        conn = psycopg2.connect(**DB_CONFIG)
+        # Borrow a connection from the shared pool
+        conn = get_pool().getconn()
         cursor = conn.cursor()
         
         # Get the current date for the date_gathered field
@@ -43,62 +42,45 @@ def insert_watch_data(watch_data, category):
             VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
         """
         
-        for watch in watch_data:
-            # Extract and convert listing_id to an integer
-            listing_id = int(watch.get('id', '0'))  # Convert the id from string to int
-            brand = watch.get('manufacturer', 'Unknown')
-            model = watch.get('title', 'Unknown')
-
-            # Ensure the price and shipping price are numeric
-            try:
-                price = float(watch.get('price', '0').replace('$', '').replace(',', ''))
-            except ValueError:
-                price = 0.0
-
-            try:
-                shipping_price = float(watch.get('shipping_price', '0').replace('$', '').replace(',', ''))
-            except ValueError:
+        brands = set()
 
-                shipping_price = 0.0
+        def write_chunk(chunk):
+            listings = normalize_chunk(chunk, category, current_date)
+            # listing_id is stored as an integer
+            listings = listings.set_column(0, 'listing_id', pc.cast(listings['listing_id'], pa.int64()))
 
-            if price > 0:
-
-                certification_status = watch.get('certification_status', 'Unknown')
-                currency = 'USD'  # Assuming USD as default
-                condition = 'Unknown'
-                description = watch.get('description', 'No description available')
-                url = watch.get('url', '')
-                merchant_name = watch.get('merchant_name', 'Unknown')
-                location = watch.get('location', 'Unknown')
-                badge = watch.get('badge', 'Unknown')
+            listings = with_price(listings)
+            for row in to_rows(listings, WATCH_PRICES_COLUMNS):
+                # Execute the insert query with the current date for date_gathered
+                cursor.execute(insert_query, row)
+            conn.commit()
+            snapshot.write(listings)
+            brands.update(pc.unique(listings['brand']).to_pylist())
 
-                # Just grab the first image
-                image_urls = watch.get('image_urls', [])
-                single_image_url = image_urls[0] if image_urls else ''
+        # Each chunk is inserted and committed while the category is still being scraped
+        with snapshot_writer(category, current_date, replace=False) as snapshot:
+            count = run_pipeline(watch_data, write_chunk)
 
-                # Execute the insert query with the current date for date_gathered
-                cursor.execute(insert_query, (
-                    listing_id, category, brand, model, price, shipping_price, certification_status, 
-                    currency, condition, description, url, merchant_name, location, badge, single_image_url, current_date
-                ))
-            
-        # Commit the transaction
-        conn.commit()
         cursor.close()
-        conn.close()
-        print(f"Inserted {len(watch_data)} records for category {category}")
+        # Recompute today's aggregates of the brands this category loaded
+        refresh_daily_stats(conn, [current_date], brands)
+        print(f"Inserted {count} records for category {category}")
     
     except Exception as e:
         print(f"Error inserting data: {e}")
+    finally:
+        if conn:
+            get_pool().putconn(conn)
 
 # Main function to gather data and insert it into the database
 def main():
     start_time = time.time()  # Capture
     for category in CATEGORIES:
-        watch_data = get_watch_prices(category)
-        if watch_data:
-            insert_watch_data(watch_data, category)
-            time.sleep(5)  # Sleep for 5 seconds after processing each category
+        insert_watch_data(get_watch_prices(category), category)
+        time.sleep(5)  # Sleep for 5 seconds after processing each category
+    score_after_load()
+    update_after_load()
+    train_after_load()
     end_time = time.time()  # Capture end time
     total_runtime = end_time - start_time  # Calculate total runtime
     print(f"Total runtime: {total_runtime:.2f} seconds")
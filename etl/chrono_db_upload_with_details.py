@@ -1,34 +1,28 @@
 import chrono24
-import psycopg2
-from psycopg2 import sql
 from dotenv import load_dotenv
-import os
 import time
+import pyarrow as pa
+import pyarrow.compute as pc
+from src.db_pool import get_pool
+from src.bulk_loader import WATCH_DETAILS_COLUMNS
+from src.normalize import normalize_chunk, to_rows
+from src.pipeline import run_pipeline
 
 # Load environment variables from a .env file
 load_dotenv()
 
-# Configuration for the PostgreSQL database connection
-DB_CONFIG = {
-    'dbname': os.getenv('DB_NAME'),
-    'user': os.getenv('DB_USER'),
-    'password': os.getenv('DB_PASSWORD'),
-    'host': os.getenv('DB_HOST'),
-    'port': os.getenv('DB_PORT')
-}
-
 # Categories to query from the Chrono24 API
 CATEGORIES = ["Rolex", "Richard Mille", "Seiko", "Omega", "Patek Philippe", "Panerai", "Breitling", "Audemars Piguet"]
 
 def get_watch_prices(category):
-    # Query the Chrono24 API using the category
-    listings = list(chrono24.query(category).search_detail(40000))  # Convert the generator to a list
-    return listings
+    # Query the Chrono24 API using the category, listings are yielded as they are scraped
+    yield from chrono24.query(category).search_detail(40000)
 
 def insert_watch_data(watch_data, category):
+    conn = None
     try:
-        # Establish database connection
-        conn = psycopg2.connect(**DB_CONFIG)
+        # Borrow a connection from the shared pool
+        conn = get_pool().getconn()
         cursor = conn.cursor()
         
         # Get the current date for the date_gathered field
@@ -43,50 +37,33 @@ def insert_watch_data(watch_data, category):
         
         
 
-        for watch in watch_data:
-            # Extract and convert listing_id to an integer
-            listing_id = int(watch.get('id', '0'))  # Convert the id from string to int
-            production_year = watch.get('year_of_production', 'Unknown')
-            delivery_scope = watch.get('scope_of_delivery', 'Unknown')
-            availability = watch.get('availability', 'Unknown')
-            case_diameter = watch.get('case_diameter', 'Unknown')
-            bracelet_color = watch.get('bracelet_color', 'Unknown')
-            anticipated_delivery = watch.get('anticipated_delivery', 'Unknown')
+        def write_chunk(chunk):
+            listings = normalize_chunk(chunk, category, current_date)
+            # listing_id is stored as an integer
+            listings = listings.set_column(0, 'listing_id', pc.cast(listings['listing_id'], pa.int64()))
 
-            # Ensure the merchant rating  are numeric
-            try:
-                merchant_rating = float(watch.get('merchant_rating', '0').replace('$', '').replace(',', ''))
-            except ValueError:
-                merchant_rating = 0.0
+            for row in to_rows(listings, WATCH_DETAILS_COLUMNS):
+                # Execute the insert query with the current date for date_gathered
+                cursor.execute(insert_query, row)
+            conn.commit()
 
-            try:
-                merchant_reviews = float(watch.get('merchant_reviews', '0').replace('$', '').replace(',', ''))
-            except ValueError:
-                merchant_reviews = 0
+        # Each chunk is inserted and committed while the category is still being scraped
+        count = run_pipeline(watch_data, write_chunk)
 
-            # Check if the listing_id already exists in the database
-            
-            # Execute the insert query with the current date for date_gathered
-            cursor.execute(insert_query, (
-                    listing_id, production_year, delivery_scope, availability, case_diameter, bracelet_color, anticipated_delivery, merchant_rating, merchant_reviews, current_date
-                ))
-        
-        # Commit the transaction
-        conn.commit()
         cursor.close()
-        conn.close()
-        print(f"Inserted {len(watch_data)} records for category {category}")
+        print(f"Inserted {count} records for category {category}")
     
     except Exception as e:
         print(f"Error inserting data: {e}")
+    finally:
+        if conn:
+            get_pool().putconn(conn)
 
 # Main function to gather data and insert it into the database
 def main():
     for category in CATEGORIES:
-        watch_data = get_watch_prices(category)
-        if watch_data:
-            insert_watch_data(watch_data, category)
-            time.sleep(5)  # Sleep for 5 seconds after processing each category
+        insert_watch_data(get_watch_prices(category), category)
+        time.sleep(5)  # Sleep for 5 seconds after processing each category
 
 if __name__ == "__main__":
     main()
@@ -1,29 +1,33 @@
 import chrono24
-import psycopg2
-from psycopg2 import sql
+from chrono24.api import DetailedListing
+from chrono24.session import get_html
 from dotenv import load_dotenv
 import os
 import time
 from tqdm import tqdm
-import concurrent.futures
+import contextlib
+import functools
+from src.bulk_loader import BulkLoader, WATCH_DETAILS_COLUMNS
+from src.pipeline import run_pipeline
+from src.snapshot import snapshot_writer
+from src.normalize import normalize_chunk, normalize_listings
+from src.change_cache import ChangeCache
+from src.daily_stats import refresh_daily_stats
+from src.comparables import update_after_load
+from src.deal_scores import score_after_load
+from src.model_registry import train_after_load
+from src.db_pool import get_pool
+from src.scheduler import CategoryScheduler
 
 # Load environment variables from a .env file
 load_dotenv()
 
 # Database Connection Manager
 class DatabaseManager:
-    def __init__(self):
-        self.db_config = {
-            'dbname': os.getenv('DB_NAME'),
-            'user': os.getenv('DB_USER'),
-            'password': os.getenv('DB_PASSWORD'),
-            'host': os.getenv('DB_HOST'),
-            'port': os.getenv('DB_PORT')
-        }
-
+    # Connections come from the process-wide pool, which outlives a single run on a warm worker
     def get_connection(self):
         try:
-            return psycopg2.connect(**self.db_config)
+            return get_pool().getconn()
         except Exception as e:
             print(f"Error connecting to the database: {e}")
             return None
@@ -32,137 +36,266 @@ class DatabaseManager:
         if cursor:
             cursor.close()
         if conn:
-            conn.close()
+            get_pool().putconn(conn)
 
 # Watch Data Fetcher
 class WatchDataFetcher:
+    # Both fetchers are lazy generators: nothing is requested until the pipeline pulls listings
     @staticmethod
     def get_basic_watch_prices(category):
         try:
-            return list(chrono24.query(category).search(10000))  # Convert generator to list
+            yield from chrono24.query(category).search(10000)
         except Exception as e:
             print(f"Error fetching basic data for {category}: {e}")
-            return []
 
     @staticmethod
     def get_detailed_watch_prices(category):
         try:
-            return list(chrono24.query(category).search_detail(10000))  # Convert generator to list
+            yield from chrono24.query(category).search_detail(10000)
         except Exception as e:
             print(f"Error fetching detailed data for {category}: {e}")
-            return []
+
+    @staticmethod
+    def get_listing_details(watch):
+        """
+        Fetches the detail page of a single listing from the basic search, as search_detail would.
+        """
+        try:
+            return {**watch, **DetailedListing(get_html(watch['url'])).json}
+        except Exception as e:
+            print(f"Error fetching details for listing {watch.get('id')}: {e}")
+            return None
 
 # Data Inserter
 class DataInserter:
-    def __init__(self):
+    BASIC_COLUMNS = [
+        'listing_id', 'category', 'brand', 'model', 'price', 'shipping_price', 'certification_status', 'description',
+        'url', 'merchant_name', 'location', 'image_url', 'date_gathered'
+    ]
+    DETAILED_COLUMNS = WATCH_DETAILS_COLUMNS
+
+    def __init__(self, load_strategy=None, load_slots=None, change_cache=None):
         self.db_manager = DatabaseManager()
+        # 'auto' (COPY with execute_values fallback), 'copy' or 'execute_values'
+        self.bulk_loader = BulkLoader(load_strategy or os.getenv('LOAD_STRATEGY', 'auto'))
+        # Optional semaphore held while a chunk is written, shared by concurrent streams
+        self.load_slots = load_slots or contextlib.nullcontext()
+        # Optional ChangeCache told about every listing once its chunk is committed
+        self.change_cache = change_cache
 
-    def insert_basic_watch_data(self, watch_data, category):
+    def _in_transaction(self, work):
+        """
+        Runs work(conn) on a pooled connection, commits and returns its result.
+        """
         conn = self.db_manager.get_connection()
         if not conn:
-            return
-        cursor = conn.cursor()
-        current_date = time.strftime('%Y-%m-%d')
-
+            raise RuntimeError("No database connection")
         try:
-            for watch in tqdm(watch_data, desc=f"Processing Basic {category}", unit="watch"):
-                listing_id = str(watch.get('id', '0'))
-                brand = watch.get('manufacturer', 'Unknown')
-                model = watch.get('title', 'Unknown')
-                price = float(watch.get('price', '0').replace('$', '').replace(',', '')) if watch.get('price') else 0.0
-                shipping_price = float(watch.get('shipping_price', '0').replace('$', '').replace(',', '')) if watch.get('shipping_price') else 0.0
-                certification_status = watch.get('certification_status', 'Unknown')
-                description = watch.get('description', 'No description available')
-                url = watch.get('url', '')
-                merchant_name = watch.get('merchant_name', 'Unknown')
-                location = watch.get('location', 'Unknown')
-                image_urls = watch.get('image_urls', [])
-                single_image_url = image_urls[0] if image_urls else ''
-
-                cursor.execute("""
-                    INSERT INTO chrono.watch_prices (
-                        listing_id, category, brand, model, price, shipping_price, certification_status, description, 
-                        url, merchant_name, location, image_url, date_gathered
-                    ) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-                """, (
-                    listing_id, category, brand, model, price, shipping_price, certification_status, description,
-                    url, merchant_name, location, single_image_url, current_date
-                ))
-
+            result = work(conn)
             conn.commit()
-            print(f"Processed {len(watch_data)} basic records for category {category}")
+            return result
+        finally:
+            self.db_manager.close_connection(conn, None)
+
+    def _stream_into(self, table, columns, normalize, watch_data, desc, kind, snapshot=None):
+        """
+        Streams listings into table chunk by chunk, committing each chunk as it is scraped.
+        A pooled connection is only held while a chunk is written.
+        Committed chunks are also added to snapshot when one is given.
+        """
+        def write_chunk(chunk):
+            listings = normalize(chunk)
+            with self.load_slots:
+                self._in_transaction(lambda conn: self.bulk_loader.load(conn, table, columns, listings))
+            if snapshot:
+                snapshot.write(listings)
+            if self.change_cache:
+                self.change_cache.record(chunk, kind)
+
+        return run_pipeline(tqdm(watch_data, desc=desc, unit="watch"), write_chunk)
+
+    def insert_basic_watch_data(self, watch_data, category):
+        current_date = time.strftime('%Y-%m-%d')
+        try:
+            # Every run inserts its rows, so every run adds its own snapshot file
+            with snapshot_writer(category, current_date, replace=False) as snapshot:
+                count = self._stream_into('chrono.watch_prices', self.BASIC_COLUMNS,
+                                          lambda chunk: normalize_chunk(chunk, category, current_date),
+                                          watch_data, f"Processing Basic {category}", 'basic', snapshot)
+            print(f"Processed {count} basic records for category {category}")
+            return count
         except Exception as e:
             print(f"Error inserting basic data: {e}")
-        finally:
-            self.db_manager.close_connection(conn, cursor)
 
     def insert_detailed_watch_data(self, watch_data, category):
-        conn = self.db_manager.get_connection()
-        if not conn:
-            return
-        cursor = conn.cursor()
         current_date = time.strftime('%Y-%m-%d')
-
         try:
-            for watch in tqdm(watch_data, desc=f"Processing Detailed {category}", unit="watch"):
-                listing_id = str(watch.get('id', '0'))
-                production_year = watch.get('year_of_production', 'Unknown')
-                delivery_scope = watch.get('scope_of_delivery', 'Unknown')
-                availability = watch.get('availability', 'Unknown')
-                case_diameter = watch.get('case_diameter', 'Unknown')
-                bracelet_color = watch.get('bracelet_color', 'Unknown')
-                anticipated_delivery = watch.get('anticipated_delivery', 'Unknown')
-                merchant_rating = watch.get('merchant_rating', '0').replace(',', '') if watch.get('merchant_rating') else '0'
-                merchant_reviews = watch.get('merchant_reviews', '0').replace(',', '') if watch.get('merchant_reviews') else '0'
-
-                cursor.execute("""
-                    INSERT INTO chrono.watch_details (
-                        listing_id, production_year, delivery_scope, availability, case_diameter, bracelet_color, 
-                        anticipated_delivery, merchant_rating, merchant_reviews, date_gathered
-                    ) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-                """, (
-                    listing_id, production_year, delivery_scope, availability, case_diameter, bracelet_color,
-                    anticipated_delivery, merchant_rating, merchant_reviews, current_date
-                ))
-
-            conn.commit()
-            print(f"Processed {len(watch_data)} detailed records for category {category}")
+            count = self._stream_into('chrono.watch_details', self.DETAILED_COLUMNS,
+                                      lambda chunk: normalize_chunk(chunk, None, current_date),
+                                      watch_data, f"Processing Detailed {category}", 'detailed')
+            print(f"Processed {count} detailed records for category {category}")
+            return count
         except Exception as e:
             print(f"Error inserting detailed data: {e}")
-        finally:
-            self.db_manager.close_connection(conn, cursor)
+
+    def new_or_repriced(self, conn, watch_data):
+        """
+        Returns the listings that are not in chrono.watch_prices yet or whose price
+        differs from the last one stored.
+        """
+        listing_ids = tuple({str(watch.get('id', '0')) for watch in watch_data})
+        if not listing_ids:
+            return []
+        with conn.cursor() as cursor:
+            cursor.execute("""
+                SELECT DISTINCT ON (listing_id) listing_id, price FROM chrono.watch_prices
+                WHERE listing_id IN %s
+                ORDER BY listing_id, date_gathered DESC
+            """, (listing_ids,))
+            last_prices = {str(listing_id): price for listing_id, price in cursor.fetchall()}
+
+        changed = []
+        prices = normalize_listings(watch_data)['price'].to_pylist()
+        for watch, price in zip(watch_data, prices):
+            listing_id = str(watch.get('id', '0'))
+            if listing_id not in last_prices or last_prices[listing_id] is None:
+                changed.append(watch)
+            elif float(last_prices[listing_id]) != price:
+                changed.append(watch)
+        return changed
+
+    def insert_combined_watch_data(self, watch_data, category, get_details=None):
+        """
+        Fills chrono.watch_prices and chrono.watch_details from a single stream.
+        Without get_details, watch_data is the detailed search and every listing gets
+        both rows. With get_details, watch_data is the basic search and only new or
+        repriced listings are fetched in detail.
+        Note that detail pages carry the merchant's real name, so merchant_name in the
+        derived basic rows is that name rather than 'Dealer' or 'Private Seller'.
+        """
+        current_date = time.strftime('%Y-%m-%d')
+        detailed_count = 0
+
+        def write_chunk(chunk):
+            nonlocal detailed_count
+            detailed = chunk
+            if get_details:
+                repriced = self._in_transaction(lambda conn: self.new_or_repriced(conn, chunk))
+                # Detail pages are fetched without holding a connection
+                detailed = [watch for watch in map(get_details, repriced) if watch]
+            listings = normalize_chunk(chunk, category, current_date)
+            # Without get_details every listing is detailed and one table serves both
+            detailed_listings = normalize_chunk(detailed, category, current_date) if get_details else listings
+
+            def load(conn):
+                self.bulk_loader.load(conn, 'chrono.watch_prices', self.BASIC_COLUMNS, listings)
+                self.bulk_loader.load(conn, 'chrono.watch_details', self.DETAILED_COLUMNS, detailed_listings)
+
+            with self.load_slots:
+                self._in_transaction(load)
+            snapshot.write(listings)
+            if self.change_cache:
+                self.change_cache.record(chunk, 'combined')
+            detailed_count += detailed_listings.num_rows
+
+        try:
+            with snapshot_writer(category, current_date, replace=False) as snapshot:
+                count = run_pipeline(tqdm(watch_data, desc=f"Processing {category}", unit="watch"), write_chunk)
+            print(f"Processed {count} basic and {detailed_count} detailed records for category {category}")
+            return count
+        except Exception as e:
+            print(f"Error inserting combined data: {e}")
 
 # Main Update Runner
 class WatchPriceUpdater:
-    def __init__(self):
+    # split: separate basic and detailed scrapes of every category
+    # detail: one detailed scrape fills both tables
+    # hybrid: basic scrape, detail pages only for new or repriced listings
+    SCRAPE_MODES = ('split', 'detail', 'hybrid')
+
+    def __init__(self, fetch_workers=None, load_workers=None, requests_per_second=None, scrape_mode=None, incremental=None):
+        self.scrape_mode = scrape_mode or os.getenv('SCRAPE_MODE', 'split')
+        if self.scrape_mode not in self.SCRAPE_MODES:
+            raise ValueError(f"Unknown scrape mode {self.scrape_mode!r}, expected one of {self.SCRAPE_MODES}")
         self.categories = ["Rolex", "Richard Mille", "Seiko", "Omega", "Patek Philippe", "Panerai", "Breitling", "Audemars Piguet"]
+        # Several categories are scraped at once under one shared chrono24 request budget
+        self.scheduler = CategoryScheduler(
+            fetch_workers=fetch_workers or int(os.getenv('FETCH_WORKERS', '4')),
+            load_workers=load_workers or int(os.getenv('LOAD_WORKERS', '2')),
+            requests_per_second=requests_per_second or float(os.getenv('REQUESTS_PER_SECOND', '2'))
+        )
+        # Incremental runs skip listings unchanged since the last run and stop a brand
+        # after UNCHANGED_RUN_LIMIT unchanged listings in a row
+        if incremental is None:
+            incremental = os.getenv('INCREMENTAL', '0') == '1'
+        self.change_cache = ChangeCache() if incremental else None
+        self.unchanged_run_limit = int(os.getenv('UNCHANGED_RUN_LIMIT', '500')) or None
         self.data_fetcher = WatchDataFetcher()
-        self.data_inserter = DataInserter()
+        self.data_inserter = DataInserter(load_slots=self.scheduler.load_slots, change_cache=self.change_cache)
 
     def update_watch_prices(self):
         start_time = time.time()
+        start_date = time.strftime('%Y-%m-%d')
 
-        for category in tqdm(self.categories, desc="Categories"):
-            with concurrent.futures.ThreadPoolExecutor() as executor:
-                # Fetch and process both basic and detailed data in parallel
-                basic_future = executor.submit(self.data_fetcher.get_basic_watch_prices, category)
-                detailed_future = executor.submit(self.data_fetcher.get_detailed_watch_prices, category)
-
-                # Wait for both to complete
-                basic_watch_data = basic_future.result()
-                detailed_watch_data = detailed_future.result()
-
-                # Insert data into respective tables
-                if basic_watch_data:
-                    self.data_inserter.insert_basic_watch_data(basic_watch_data, category)
-                if detailed_watch_data:
-                    self.data_inserter.insert_detailed_watch_data(detailed_watch_data, category)
+        jobs = []
+        if self.scrape_mode == 'split':
+            # Detailed streams make a request per listing and take longest, so they are queued first
+            for category in self.categories:
+                detailed_watch_data = self._source(self.data_fetcher.get_detailed_watch_prices(category), 'detailed', f"Detailed {category}")
+                jobs.append((f"Detailed {category}", functools.partial(self.data_inserter.insert_detailed_watch_data, detailed_watch_data, category)))
+            for category in self.categories:
+                basic_watch_data = self._source(self.data_fetcher.get_basic_watch_prices(category), 'basic', f"Basic {category}")
+                jobs.append((f"Basic {category}", functools.partial(self.data_inserter.insert_basic_watch_data, basic_watch_data, category)))
+        elif self.scrape_mode == 'detail':
+            for category in self.categories:
+                detailed_watch_data = self._source(self.data_fetcher.get_detailed_watch_prices(category), 'combined', f"Detailed {category}")
+                jobs.append((f"Detailed {category}", functools.partial(self.data_inserter.insert_combined_watch_data, detailed_watch_data, category)))
+        else:
+            for category in self.categories:
+                basic_watch_data = self._source(self.data_fetcher.get_basic_watch_prices(category), 'combined', f"Hybrid {category}")
+                jobs.append((f"Hybrid {category}", functools.partial(self.data_inserter.insert_combined_watch_data, basic_watch_data, category,
+                                                                     get_details=self.get_listing_details)))
 
-                time.sleep(5)  # Sleep for 5 seconds between category queries
+        self.scheduler.run(jobs)
+        self.refresh_daily_stats({start_date, time.strftime('%Y-%m-%d')})
+        score_after_load()
+        update_after_load()
+        train_after_load()
+        if self.change_cache:
+            print(f"Change cache: {self.change_cache.summary()}")
+        print(f"Connection pool: {get_pool().summary()}")
 
         total_runtime = time.time() - start_time
         print(f"Total runtime: {total_runtime:.2f} seconds")
 
+    def refresh_daily_stats(self, dates):
+        """
+        Recomputes the daily price aggregates of the dates loaded by this run, once all
+        categories are written so concurrent jobs do not refresh the same brands.
+        """
+        try:
+            with get_pool().connection() as conn:
+                rows = refresh_daily_stats(conn, sorted(dates))
+            print(f"Refreshed {rows} daily aggregate rows")
+        except Exception as e:
+            print(f"Error refreshing daily aggregates: {e}")
+
+    def _source(self, listings, kind, name):
+        """
+        Throttles a listing generator and, on incremental runs, drops unchanged listings.
+        Only detailed searches make a request per listing.
+        """
+        detailed = kind == 'detailed' or (kind == 'combined' and self.scrape_mode == 'detail')
+        listings = self.scheduler.throttle(listings, requests_per_listing=1 if detailed else 0)
+        if self.change_cache:
+            listings = self.change_cache.changed_only(listings, kind, name, stop_after=self.unchanged_run_limit)
+        return listings
+
+    def get_listing_details(self, watch):
+        # Every detail page fetched in hybrid mode is paid for from the shared request budget
+        self.scheduler.bucket.acquire()
+        return self.data_fetcher.get_listing_details(watch)
+
 # Final callable function
 def run_update():
     updater = WatchPriceUpdater()
@@ -0,0 +1,136 @@
+"""
+Bulk loading of normalized listing rows into the chrono tables.
+
+Rows are streamed into Postgres with COPY FROM STDIN through an in-memory buffer.
+Normalized Arrow tables are written to that buffer as CSV by Arrow itself, without
+building a Python tuple per row. When COPY isn't available the loader falls back
+to batched execute_values.
+"""
+import io
+import datetime
+
+import psycopg2
+import pyarrow as pa
+import pyarrow.csv as pa_csv
+from psycopg2 import sql
+from psycopg2.extras import execute_values
+
+from src.normalize import to_rows
+
+# Column order of the rows handed to the loader for each table
+WATCH_PRICES_COLUMNS = [
+    'listing_id', 'category', 'brand', 'model', 'price', 'shipping_price', 'certification_status',
+    'currency', 'condition', 'description', 'url', 'merchant_name', 'location', 'badge', 'image_url', 'date_gathered'
+]
+WATCH_DETAILS_COLUMNS = [
+    'listing_id', 'production_year', 'delivery_scope', 'availability', 'case_diameter', 'bracelet_color',
+    'anticipated_delivery', 'merchant_rating', 'merchant_reviews', 'date_gathered'
+]
+
+# auto: try COPY and fall back to execute_values if the server refuses it
+STRATEGIES = ('auto', 'copy', 'execute_values')
+
+# Errors that mean COPY FROM STDIN is unsupported, as opposed to bad data
+_COPY_UNAVAILABLE_ERRORS = (psycopg2.NotSupportedError, psycopg2.errors.InsufficientPrivilege)
+
+
+def _copy_value(value):
+    """
+    Formats a single value for the COPY text format.
+    """
+    if value is None:
+        return '\\N'
+    if isinstance(value, (datetime.date, datetime.datetime)):
+        return value.isoformat()
+    text = str(value)
+    if '\\' in text or '\t' in text or '\n' in text or '\r' in text:
+        text = text.replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+    return text
+
+
+def _table_identifier(table):
+    """
+    Turns 'schema.table' into a quoted SQL identifier.
+    """
+    return sql.Identifier(*table.split('.'))
+
+
+class BulkLoader:
+    def __init__(self, strategy='auto', page_size=5000):
+        if strategy not in STRATEGIES:
+            raise ValueError(f"Unknown load strategy {strategy!r}, expected one of {STRATEGIES}")
+        self.strategy = strategy
+        self.page_size = page_size
+        self.copy_available = strategy != 'execute_values'
+
+    def load(self, conn, table, columns, rows):
+        """
+        Loads rows (sequences ordered like columns, or an Arrow table with those columns)
+        into table and returns the row count.
+        The caller owns the transaction and is expected to commit.
+        """
+        if isinstance(rows, pa.Table):
+            rows = rows.select(columns)
+        elif not isinstance(rows, list):
+            rows = list(rows)
+        if not len(rows):
+            return 0
+
+        with conn.cursor() as cursor:
+            if self.copy_available:
+                if self.strategy == 'copy':
+                    self._copy(cursor, table, columns, rows)
+                    return len(rows)
+
+                # Keep the fallback inside the caller's transaction
+                cursor.execute("SAVEPOINT bulk_loader_copy")
+                try:
+                    self._copy(cursor, table, columns, rows)
+                    cursor.execute("RELEASE SAVEPOINT bulk_loader_copy")
+                    return len(rows)
+                except _COPY_UNAVAILABLE_ERRORS as e:
+                    cursor.execute("ROLLBACK TO SAVEPOINT bulk_loader_copy")
+                    print(f"COPY unavailable ({e.__class__.__name__}), falling back to execute_values")
+                    self.copy_available = False
+
+            if isinstance(rows, pa.Table):
+                rows = to_rows(rows, columns)
+            self._execute_values(cursor, table, columns, rows)
+        return len(rows)
+
+    def _copy(self, cursor, table, columns, rows):
+        if isinstance(rows, pa.Table):
+            self._copy_table(cursor, table, columns, rows)
+            return
+
+        statement = sql.SQL("COPY {} ({}) FROM STDIN").format(
+            _table_identifier(table),
+            sql.SQL(', ').join(map(sql.Identifier, columns))
+        ).as_string(cursor)
+
+        for start in range(0, len(rows), self.page_size):
+            buffer = io.StringIO()
+            for row in rows[start:start + self.page_size]:
+                buffer.write('\t'.join(map(_copy_value, row)))
+                buffer.write('\n')
+            buffer.seek(0)
+            cursor.copy_expert(statement, buffer)
+
+    def _copy_table(self, cursor, table, columns, rows):
+        # Arrow quotes every string and leaves NULLs unquoted and empty, as CSV COPY expects
+        statement = sql.SQL("COPY {} ({}) FROM STDIN WITH (FORMAT csv)").format(
+            _table_identifier(table),
+            sql.SQL(', ').join(map(sql.Identifier, columns))
+        ).as_string(cursor)
+
+        buffer = io.BytesIO()
+        pa_csv.write_csv(rows, buffer, pa_csv.WriteOptions(include_header=False, batch_size=self.page_size))
+        buffer.seek(0)
+        cursor.copy_expert(statement, buffer)
+
+    def _execute_values(self, cursor, table, columns, rows):
+        statement = sql.SQL("INSERT INTO {} ({}) VALUES %s").format(
+            _table_identifier(table),
+            sql.SQL(', ').join(map(sql.Identifier, columns))
+        ).as_string(cursor)
+        execute_values(cursor, statement, rows, page_size=self.page_size)
@@ -0,0 +1,144 @@
+"""
+On-disk cache of what each listing looked like the last time it was loaded.
+
+Every listing is keyed by listing_id and stream kind ('basic', 'detailed' or
+'combined') and stores a hash of its search-result fields and its last price.
+Incremental runs drop listings whose hash did not change and stop paginating a
+brand once a long run of consecutive listings is unchanged: chrono24 results
+are sorted newest first, so the rest of the brand has been seen before.
+"""
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from src.paths import CHANGE_CACHE_PATH
+
+# Fields of a chrono24 search result, shared by basic and detailed listings
+HASHED_FIELDS = (
+    'url', 'manufacturer', 'certification_status', 'title', 'description', 'price', 'shipping_price',
+    'location', 'badge', 'image_urls'
+)
+
+# SQLite limits the number of bound parameters per statement
+_LOOKUP_BATCH = 500
+
+
+def content_hash(watch):
+    payload = json.dumps([watch.get(field) for field in HASHED_FIELDS], default=str)
+    return hashlib.blake2b(payload.encode('utf-8'), digest_size=16).hexdigest()
+
+
+def _price(watch):
+    try:
+        return float(watch.get('price', '0').replace('$', '').replace(',', ''))
+    except (AttributeError, ValueError):
+        return None
+
+
+class ChangeCache:
+    def __init__(self, path=CHANGE_CACHE_PATH):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        # Shared by the category threads, every access goes through the lock
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock, self._conn:
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS listings (
+                    listing_id TEXT NOT NULL,
+                    kind TEXT NOT NULL,
+                    content_hash TEXT NOT NULL,
+                    price REAL,
+                    last_changed TEXT NOT NULL,
+                    PRIMARY KEY (listing_id, kind)
+                )
+            """)
+        self.hits = 0
+        self.misses = 0
+        self.stopped_early = []
+
+    def _known_hashes(self, listing_ids, kind):
+        known = {}
+        with self._lock:
+            for start in range(0, len(listing_ids), _LOOKUP_BATCH):
+                batch = listing_ids[start:start + _LOOKUP_BATCH]
+                placeholders = ', '.join('?' * len(batch))
+                rows = self._conn.execute(
+                    f"SELECT listing_id, content_hash FROM listings WHERE kind = ? AND listing_id IN ({placeholders})",
+                    [kind, *batch]
+                )
+                known.update(rows)
+        return known
+
+    def changed_only(self, listings, kind, name, stop_after=500, lookahead=120):
+        """
+        Yields the listings that are new or changed since they were last recorded.
+        Listings are looked up lookahead at a time (one chrono24 results page).
+        Stops pulling from the source after stop_after consecutive unchanged listings;
+        stop_after=None scans everything.
+        """
+        streak = 0
+        batch = []
+        iterator = iter(listings)
+        exhausted = False
+        while not exhausted:
+            batch.clear()
+            for watch in iterator:
+                batch.append(watch)
+                if len(batch) >= lookahead:
+                    break
+            else:
+                exhausted = True
+
+            known = self._known_hashes([str(watch.get('id', '0')) for watch in batch], kind)
+            changed = []
+            unchanged = 0
+            for watch in batch:
+                if known.get(str(watch.get('id', '0'))) == content_hash(watch):
+                    unchanged += 1
+                    streak += 1
+                    if stop_after and streak >= stop_after:
+                        break
+                else:
+                    streak = 0
+                    changed.append(watch)
+
+            with self._lock:
+                self.hits += unchanged
+                self.misses += len(changed)
+            yield from changed
+
+            if stop_after and streak >= stop_after:
+                print(f"Stopping {name} after {streak} unchanged listings in a row")
+                self.stopped_early.append(name)
+                if hasattr(iterator, 'close'):
+                    iterator.close()
+                return
+
+    def record(self, watch_data, kind):
+        """
+        Stores the current hash and price of listings that were written to the database.
+        """
+        changed_on = time.strftime('%Y-%m-%d')
+        rows = [(str(watch.get('id', '0')), kind, content_hash(watch), _price(watch), changed_on) for watch in watch_data]
+        with self._lock, self._conn:
+            self._conn.executemany("""
+                INSERT INTO listings (listing_id, kind, content_hash, price, last_changed) VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT (listing_id, kind) DO UPDATE SET
+                    content_hash = excluded.content_hash, price = excluded.price, last_changed = excluded.last_changed
+            """, rows)
+
+    @property
+    def hit_rate(self):
+        seen = self.hits + self.misses
+        return self.hits / seen if seen else 0.0
+
+    def summary(self):
+        return (f"{self.hits} unchanged and {self.misses} new or changed listings "
+                f"(hit rate {self.hit_rate:.1%}), {len(self.stopped_early)} streams stopped early")
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,427 @@
+"""
+Comparable listings found by nearest-neighbour search.
+
+The catalog is the latest row of every listing_id seen in the last
+COMPARABLES_WINDOW_DAYS days, joined with the latest chrono.watch_details row of
+the listing. Each listing is encoded as a vector of FEATURES divided by
+FEATURE_SCALES, so that one unit of distance is about
+
+    log_price         a 25% difference in price
+    production_year   5 years
+    case_diameter_mm  2 mm
+    certified         certified by chrono24 or not
+    has_box           with or without the original box
+    has_papers        with or without the original papers
+
+Missing values are replaced by the median of the listing's reference family
+(src/title_index.py), or of its brand. Listings are partitioned by brand and
+reference family, with scikit-learn KDTrees per partition and per brand.
+comparables() returns the k nearest listings of the same family. When the family
+has fewer listings, the nearest listings of the brand's other families fill the
+rest. A query searches a few low-dimensional trees, so it takes a few
+milliseconds whatever the size of the catalog.
+
+The index is saved with joblib under COMPARABLES_DIR. After every ETL run
+update_after_load() reads only the listings added or repriced since the load
+the index was built at, from the chrono.etl_loads marks. Every partition and
+brand has a main tree and a small delta tree, queried together. The listings
+added or repriced, and those whose missing features are filled with a median
+that moved, go to the delta tree. Their rows in the main tree, and the rows of
+listings that aged out of the window, are skipped by queries until the main
+tree is rebuilt, once the delta and the skipped rows pass MERGE_FRACTION of it.
+A change of the title vocabulary rebuilds the whole index, as every family may
+change. python -m src.comparables rebuilds it from scratch.
+python -m benchmarks.bench_comparables measures builds, updates and queries.
+"""
+import math
+import os
+import time
+import uuid
+
+import joblib
+import numpy as np
+import pandas as pd
+from sklearn.neighbors import KDTree
+
+from src.load_log import CHANGED_ROWS_SCOPE, LATEST_LOAD_QUERY, changed_rows_params, watermarks
+from src.normalize import parse_column
+from src.paths import COMPARABLES_DIR
+from src.title_index import default_index
+
+# Days a listing stays in the catalog after it was last seen
+COMPARABLES_WINDOW_DAYS = int(os.getenv('COMPARABLES_WINDOW_DAYS', '90'))
+
+FEATURE_SCALES = {
+    'log_price': math.log(1.25),
+    'production_year': 5.0,
+    'case_diameter_mm': 2.0,
+    'certified': 1.0,
+    'has_box': 1.0,
+    'has_papers': 1.0,
+}
+FEATURES = list(FEATURE_SCALES)
+
+# Share of a main tree that its delta tree and its superseded rows may reach before it is rebuilt
+MERGE_FRACTION = 0.25
+
+# Columns of the listings returned by queries
+LISTING_COLUMNS = ['brand', 'reference_family', 'model', 'price', 'production_year', 'case_diameter_mm',
+                   'certification_status', 'delivery_scope', 'date_gathered', 'url']
+
+INDEX_PATH = os.path.join(COMPARABLES_DIR, 'index.joblib')
+# Saved indexes of another layout are rebuilt
+INDEX_FORMAT = 2
+
+CATALOG_QUERY = """
+    WITH latest AS (
+        SELECT DISTINCT ON (listing_id) id, listing_id, date_gathered, brand, model, reference_family,
+               price::float8 AS price, certification_status, url
+        FROM chrono.watch_prices
+        WHERE price > 0 AND listing_id IS NOT NULL AND brand IS NOT NULL AND model IS NOT NULL AND ({scope})
+        ORDER BY listing_id, date_gathered DESC, id DESC
+    ), details AS (
+        SELECT DISTINCT ON (listing_id) listing_id, production_year, case_diameter, delivery_scope
+        FROM chrono.watch_details
+        WHERE listing_id IN (SELECT listing_id FROM latest)
+        ORDER BY listing_id, date_gathered DESC, id DESC
+    )
+    SELECT latest.*, details.production_year, details.case_diameter, details.delivery_scope
+    FROM latest LEFT JOIN details USING (listing_id)
+"""
+WINDOW_SCOPE = "date_gathered > (SELECT max(date_gathered) FROM chrono.watch_prices) - %(window)s"
+
+
+def _per_value(values, parse):
+    # Text columns with few distinct values are parsed once per value
+    codes, uniques = pd.factorize(values)
+    parsed = np.append(parse(pd.Series(uniques, dtype=object).str.lower()).to_numpy(dtype='float64'), np.nan)
+    return parsed[codes]
+
+
+def _flag(text, present, absent):
+    # NaN when the text says neither
+    return pd.Series(np.nan, index=text.index).mask(text.str.contains(present, regex=False), 1.0) \
+        .mask(text.str.contains(absent, regex=False), 0.0)
+
+
+def prepare_listings(rows):
+    """
+    Adds the parsed production year, case diameter and the certified, has_box and
+    has_papers flags to catalog rows and indexes them by listing_id.
+    """
+    listings = rows.copy()
+    listings['production_year'] = parse_column(listings['production_year'], 'production_year_value').to_numpy(
+        zero_copy_only=False)
+    listings['case_diameter_mm'] = parse_column(listings['case_diameter'], 'case_diameter_mm').to_numpy(
+        zero_copy_only=False)
+    listings['certified'] = np.nan_to_num(_per_value(
+        listings['certification_status'], lambda text: text.str.contains('certified', regex=False)))
+    listings['has_box'] = _per_value(listings['delivery_scope'],
+                                     lambda text: _flag(text, 'original box', 'no original box'))
+    listings['has_papers'] = _per_value(listings['delivery_scope'],
+                                        lambda text: _flag(text, 'original papers', 'no original papers'))
+    listings['reference_family'] = listings['reference_family'].fillna('')
+    listings['partition'] = partition_key(listings['brand'], listings['reference_family'])
+    listings['date_gathered'] = pd.to_datetime(listings['date_gathered'])
+    return listings.set_index('listing_id')[LISTING_COLUMNS + ['certified', 'has_box', 'has_papers', 'partition']]
+
+
+def partition_key(brand, family):
+    """
+    Key of the tree of a brand and reference family, for strings or Series of them.
+    """
+    return brand + '\x1f' + family
+
+
+def _groups(values):
+    """
+    Positions of each distinct value, as {value: positions}.
+    """
+    codes, uniques = pd.factorize(values)
+    order = np.argsort(codes, kind='stable')
+    bounds = np.flatnonzero(np.diff(codes[order])) + 1
+    return dict(zip(uniques, np.split(order, bounds))) if len(codes) else {}
+
+
+class _PartitionTree:
+    """
+    The KD-trees of one partition or brand: a main tree rebuilt only by merge(),
+    and a delta tree of the listings added or re-encoded since. superseded holds
+    the listing_ids whose row in the main tree was removed or re-encoded.
+    """
+
+    def __init__(self):
+        self.main, self.main_ids = None, np.empty(0, dtype=object)
+        self.delta, self.delta_ids = None, np.empty(0, dtype=object)
+        self.superseded = set()
+
+    def current_ids(self):
+        """
+        listing_ids of the current rows of the trees.
+        """
+        return np.concatenate([self.main_ids[~pd.Index(self.main_ids).isin(self.superseded)], self.delta_ids])
+
+    def merge(self, vectors, listing_ids):
+        self.main, self.main_ids = KDTree(vectors), listing_ids
+        self.delta, self.delta_ids = None, np.empty(0, dtype=object)
+        self.superseded = set()
+
+    def set_delta(self, vectors, listing_ids):
+        self.delta, self.delta_ids = (KDTree(vectors) if len(listing_ids) else None), listing_ids
+
+    def needs_merge(self, delta_size):
+        return delta_size + len(self.superseded) > MERGE_FRACTION * len(self.main_ids)
+
+    def query(self, vector, count, skip):
+        """
+        (distance, listing_id) of the count nearest current listings not in skip, nearest first.
+        """
+        nearest = []
+        for tree, listing_ids, superseded in ((self.main, self.main_ids, self.superseded),
+                                              (self.delta, self.delta_ids, ())):
+            if tree is None:
+                continue
+            # Superseded rows are rare, the search is widened only when they crowd out the nearest
+            wanted = count + len(skip)
+            while True:
+                tree_distances, positions = tree.query(vector.reshape(1, -1), k=min(wanted, len(listing_ids)))
+                found = [(distance, listing_id)
+                         for distance, listing_id in zip(tree_distances[0], listing_ids[positions[0]])
+                         if listing_id not in superseded and listing_id not in skip]
+                if len(found) >= count or wanted >= len(listing_ids):
+                    break
+                wanted *= 2
+            nearest.extend(found[:count])
+        return sorted(nearest, key=lambda pair: pair[0])[:count]
+
+
+class ComparablesIndex:
+    def __init__(self):
+        self.catalog = prepare_listings(pd.DataFrame(columns=[
+            'listing_id', 'brand', 'model', 'reference_family', 'price', 'certification_status', 'url',
+            'date_gathered', 'production_year', 'case_diameter', 'delivery_scope']))
+        # Scaled feature vectors, row for row with the catalog
+        self.vectors = np.empty((0, len(FEATURES)))
+        # Values that replace missing features, per partition key and per brand
+        self.partition_fill = pd.DataFrame(columns=FEATURES[1:], dtype='float64')
+        self.brand_fill = pd.DataFrame(columns=FEATURES[1:], dtype='float64')
+        # Partition key -> its _PartitionTree, and brand -> the same
+        self.family_trees = {}
+        self.brand_trees = {}
+        self.load_id = None
+        self.format = INDEX_FORMAT
+        # Digest of the title vocabulary the catalog's reference families were matched with
+        self.vocabulary = default_index().digest
+
+    @staticmethod
+    def _encode(listings, fill_values):
+        """
+        Scaled feature vectors of listings, missing values replaced by fill_values.
+        """
+        features = pd.DataFrame({
+            'log_price': np.log(listings['price'].astype('float64')),
+            **{column: listings[column].astype('float64') for column in FEATURES[1:]},
+        })
+        return (features.fillna(fill_values).fillna(0.0) / pd.Series(FEATURE_SCALES)).to_numpy()
+
+    def update(self, rows, expire_before=None):
+        """
+        Adds or replaces catalog rows (as read by CATALOG_QUERY) and drops listings
+        last seen before expire_before. The listings added, and those whose vector
+        moved with their medians, go to the delta trees of their partition and brand,
+        and main trees are rebuilt once they need a merge. Returns the number of
+        partition and brand trees rebuilt.
+        """
+        listings = prepare_listings(rows)
+        listings = listings[~listings.index.duplicated(keep='last')]
+        removed = self.catalog.index.isin(listings.index)
+        if expire_before is not None:
+            removed |= (self.catalog['date_gathered'] < expire_before).to_numpy()
+        previous_catalog, previous_vectors, previous_fill = self.catalog, self.vectors, self.partition_fill
+        kept = previous_catalog[~removed]
+        kept_vectors = previous_vectors[~removed]
+        self.catalog = pd.concat([kept, listings]) if len(kept) else listings
+
+        # A brand's medians fill the gaps of its partitions' medians
+        features = self.catalog[FEATURES[1:]].astype('float64')
+        self.brand_fill = features.groupby(self.catalog['brand']).median()
+        partition_fill = features.groupby(self.catalog['partition']).median()
+        partition_brands = [key.partition('\x1f')[0] for key in partition_fill.index]
+        brand_fill = self.brand_fill.loc[partition_brands].set_axis(partition_fill.index)
+        self.partition_fill = partition_fill.fillna(brand_fill)
+
+        # New listings are encoded, and the listings with missing features in partitions whose medians moved
+        previous_fill = previous_fill.reindex(self.partition_fill.index)
+        refilled = ~((previous_fill == self.partition_fill) | (previous_fill.isna() & self.partition_fill.isna()))
+        encoded = (self.catalog['partition'].isin(self.partition_fill.index[refilled.any(axis=1)]).to_numpy()
+                   & features.isna().any(axis=1).to_numpy())
+        encoded[len(kept):] = True
+        rows = self.catalog[encoded]
+        vectors = np.empty((len(self.catalog), len(FEATURES)))
+        vectors[:len(kept)] = kept_vectors
+        vectors[encoded] = self._encode(rows, self.partition_fill.loc[rows['partition']].set_axis(rows.index))
+        self.vectors = vectors
+        # Listings whose vector moved are indexed again like new ones
+        moved = np.ones(len(self.catalog), dtype=bool)
+        moved[:len(kept)] = (vectors[:len(kept)] != kept_vectors).any(axis=1)
+        superseded = removed.copy()
+        superseded[np.flatnonzero(~removed)[moved[:len(kept)]]] = True
+
+        rebuilt = 0
+        listing_ids = self.catalog.index.to_numpy()
+        superseded_ids = previous_catalog.index.to_numpy()[superseded]
+        moved_ids = listing_ids[moved]
+        for trees, column in ((self.family_trees, 'partition'), (self.brand_trees, 'brand')):
+            gone = _groups(previous_catalog[column].to_numpy()[superseded])
+            added = _groups(self.catalog[column].to_numpy()[moved])
+            for key in set(gone) | set(added):
+                tree = trees.setdefault(key, _PartitionTree())
+                gone_ids = superseded_ids[gone[key]] if key in gone else []
+                tree.superseded.update(gone_ids)
+                delta_ids = tree.delta_ids[~pd.Index(tree.delta_ids).isin(gone_ids)]
+                if key in added:
+                    delta_ids = np.concatenate([delta_ids, moved_ids[added[key]]])
+                if not tree.needs_merge(len(delta_ids)):
+                    tree.set_delta(vectors[self.catalog.index.get_indexer(delta_ids)], delta_ids)
+                    continue
+                tree.delta_ids = delta_ids
+                current_ids = tree.current_ids()
+                if len(current_ids):
+                    tree.merge(vectors[self.catalog.index.get_indexer(current_ids)], current_ids)
+                    rebuilt += 1
+                else:
+                    del trees[key]
+        return rebuilt
+
+    def _nearest(self, brand, family, vector, k, exclude=()):
+        """
+        listing_ids and distances of the k nearest listings of the family, then of the brand.
+        """
+        found, distances = [], []
+        for tree in (self.family_trees.get(partition_key(brand, family)), self.brand_trees.get(brand)):
+            if tree is None or len(found) >= k:
+                continue
+            for distance, listing_id in tree.query(vector, k - len(found), {*exclude, *found}):
+                found.append(listing_id)
+                distances.append(distance)
+        return found, distances
+
+    def _result(self, brand, family, vector, k, exclude=()):
+        found, distances = self._nearest(brand, family, vector, k, exclude)
+        result = self.catalog.iloc[self.catalog.index.get_indexer(found)][LISTING_COLUMNS]
+        return result.assign(distance=distances, same_family=result['reference_family'] == family)
+
+    def comparables(self, listing_id, k=10):
+        """
+        The k listings most like listing_id, nearest first, with their distance.
+        None when the listing is not in the catalog.
+        """
+        position = self.catalog.index.get_indexer([listing_id])[0]
+        if position < 0:
+            return None
+        brand, family = self.catalog['brand'].iat[position], self.catalog['reference_family'].iat[position]
+        return self._result(brand, family, self.vectors[position], k, exclude={listing_id})
+
+    def similar(self, brand, model, price, production_year=None, case_diameter=None, certification_status=None,
+                delivery_scope=None, k=10):
+        """
+        The k listings most like a watch described by its fields, as scraped
+        (e.g. case_diameter '41 mm'), nearest first. Empty when the brand has no listings.
+        """
+        family = default_index().family(brand, model) or ''
+        listing = prepare_listings(pd.DataFrame([{
+            'listing_id': None, 'brand': brand, 'model': model, 'reference_family': family, 'price': price,
+            'certification_status': certification_status, 'url': None, 'date_gathered': None,
+            'production_year': production_year, 'case_diameter': case_diameter, 'delivery_scope': delivery_scope,
+        }]))
+        key = partition_key(brand, family)
+        if key in self.partition_fill.index:
+            fill_values = self.partition_fill.loc[key]
+        else:
+            fill_values = self.brand_fill.loc[brand] if brand in self.brand_fill.index else 0.0
+        return self._result(brand, family, self._encode(listing, fill_values)[0], k)
+
+    def save(self, path=INDEX_PATH):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temporary_path = os.path.join(os.path.dirname(path), f'.{uuid.uuid4().hex[:8]}.tmp')
+        joblib.dump(self, temporary_path)
+        os.replace(temporary_path, path)
+
+    @staticmethod
+    def load(path=INDEX_PATH):
+        """
+        The saved index, None before the first build.
+        """
+        return joblib.load(path) if os.path.exists(path) else None
+
+
+def _catalog_rows(cursor, scope, params):
+    cursor.execute(CATALOG_QUERY.format(scope=scope), params)
+    return pd.DataFrame(cursor.fetchall(), columns=[column.name for column in cursor.description])
+
+
+def update_index(conn, rebuild=False, path=INDEX_PATH):
+    """
+    Brings the saved index up to the latest load, reading only the listings added
+    or repriced since the load it was built at, or the whole window when there is
+    no index, rebuild=True, the title vocabulary changed or the index was saved in
+    another layout. Returns (listings read, trees rebuilt, catalog size).
+    """
+    index = None if rebuild else ComparablesIndex.load(path)
+    if index is not None and (getattr(index, 'format', None) != INDEX_FORMAT
+                              or getattr(index, 'vocabulary', None) != default_index().digest):
+        index = None
+    with conn.cursor() as cursor:
+        cursor.execute("SELECT to_regclass('chrono.etl_loads') IS NOT NULL")
+        load_id = None
+        if cursor.fetchone()[0]:
+            cursor.execute(LATEST_LOAD_QUERY)
+            load_id = cursor.fetchone()[0]
+        previous = watermarks(cursor, index.load_id) if index is not None and index.load_id is not None else None
+        if previous is None or previous.get('max_row_id') is None or load_id is None:
+            index = ComparablesIndex()
+            rows = _catalog_rows(cursor, WINDOW_SCOPE, {'window': COMPARABLES_WINDOW_DAYS})
+        elif load_id == index.load_id:
+            conn.commit()
+            return 0, 0, len(index.catalog)
+        else:
+            rows = _catalog_rows(cursor, CHANGED_ROWS_SCOPE, changed_rows_params(previous, watermarks(cursor, load_id)))
+        cursor.execute("SELECT max(date_gathered) FROM chrono.watch_prices")
+        last_date = cursor.fetchone()[0]
+    conn.commit()
+
+    expire_before = pd.Timestamp(last_date) - pd.Timedelta(days=COMPARABLES_WINDOW_DAYS - 1) if last_date else None
+    trees = index.update(rows, expire_before)
+    index.load_id = load_id
+    index.save(path)
+    return len(rows), trees, len(index.catalog)
+
+
+def update_after_load():
+    """
+    Called at the end of ETL runs, after the deals are scored, unless BUILD_COMPARABLES=0.
+    """
+    if os.getenv('BUILD_COMPARABLES', '1') == '0':
+        return
+    from src.db_pool import get_pool
+
+    try:
+        start_time = time.time()
+        with get_pool().connection() as conn:
+            rows, trees, listings = update_index(conn)
+        print(f"Comparables index: read {rows} listings, rebuilt {trees} trees, "
+              f"{listings} listings indexed, in {time.time() - start_time:.2f} seconds")
+    except Exception as e:
+        print(f"Error updating the comparables index: {e}")
+
+
+if __name__ == "__main__":
+    from src.db_pool import get_pool
+    # Pickled through the importable module, so that the ETL and the app can load the index
+    from src.comparables import update_index as rebuild_index
+
+    start_time = time.time()
+    with get_pool().connection() as conn:
+        rows, trees, listings = rebuild_index(conn, rebuild=True)
+    print(f"Indexed {listings} listings of the last {COMPARABLES_WINDOW_DAYS} days in {trees} trees "
+          f"in {time.time() - start_time:.2f} seconds")
@@ -0,0 +1,198 @@
+"""
+Daily price aggregates of chrono.watch_prices for the dashboard.
+
+chrono.daily_brand_prices, chrono.daily_family_prices and chrono.daily_model_prices
+hold, for every date_gathered and brand (and brand and reference family, and brand
+and model title), the number of priced listings and their mean, median, 25th and
+75th percentile, min and max price, and m2_price, the sum of squared deviations
+from the mean, so that days can be merged into the mean and standard deviation
+of any date range (see src/price_stats.py). The matching *_price_sketches tables
+hold their quantile sketches, for percentiles of any date range (see
+src/price_sketch.py). The ETL refreshes only the day and brands it has just
+loaded, so the market trend chart and summary statistics read a few rows per day
+instead of grouping the full history. Each refresh also records the load in
+chrono.etl_loads, in the same transaction, so the dashboard sees new listings and
+their aggregates together.
+"""
+import time
+
+from psycopg2 import sql
+
+from src.listing_features import refresh_listing_features
+from src.load_log import record_load
+from src.price_sketch import LOG_GAMMA
+from src.title_index import families_outdated, fill_reference_families
+
+# Aggregate table -> the watch_prices columns it is grouped by, besides date_gathered
+STATS_TABLES = {
+    'daily_brand_prices': ('brand',),
+    'daily_family_prices': ('brand', 'reference_family'),
+    'daily_model_prices': ('brand', 'model'),
+}
+# Sketch table -> its keys, besides date_gathered and bucket
+SKETCH_TABLES = {
+    'daily_brand_price_sketches': ('brand',),
+    'daily_family_price_sketches': ('brand', 'reference_family'),
+    'daily_model_price_sketches': ('brand', 'model'),
+}
+STATS_COLUMNS = ['listings', 'mean_price', 'median_price', 'p25_price', 'p75_price', 'min_price', 'max_price', 'm2_price']
+
+CREATE_QUERY = """
+    CREATE TABLE IF NOT EXISTS chrono.{table} (
+        date_gathered date NOT NULL,
+        {keys},
+        listings integer NOT NULL,
+        mean_price double precision,
+        median_price double precision,
+        p25_price double precision,
+        p75_price double precision,
+        min_price double precision,
+        max_price double precision,
+        m2_price double precision,
+        PRIMARY KEY (date_gathered, {key_names})
+    )
+"""
+
+CREATE_SKETCH_QUERY = """
+    CREATE TABLE IF NOT EXISTS chrono.{table} (
+        date_gathered date NOT NULL,
+        {keys},
+        bucket integer NOT NULL,
+        listings integer NOT NULL,
+        PRIMARY KEY (date_gathered, {key_names}, bucket)
+    )
+"""
+
+# Columns added after the tables were first created, existing rows are rebuilt
+ADDED_COLUMNS = {'m2_price': 'double precision'}
+
+# Lets a refresh read only the day and brands it recomputes
+SOURCE_INDEX = 'watch_prices_date_gathered_brand_idx'
+
+DELETE_QUERY = "DELETE FROM chrono.{table} WHERE {scope}"
+
+# Listings without a positive price are left out, as on the dashboard
+INSERT_QUERY = """
+    INSERT INTO chrono.{table} (date_gathered, {key_names}, {stats})
+    SELECT date_gathered, {key_names},
+           count(*),
+           avg(price)::float8,
+           percentile_cont(0.5) WITHIN GROUP (ORDER BY price::float8),
+           percentile_cont(0.25) WITHIN GROUP (ORDER BY price::float8),
+           percentile_cont(0.75) WITHIN GROUP (ORDER BY price::float8),
+           min(price)::float8,
+           max(price)::float8,
+           var_pop(price::float8) * count(*)
+    FROM chrono.watch_prices
+    WHERE price > 0 AND {not_null} AND {scope}
+    GROUP BY date_gathered, {key_names}
+"""
+
+# The bucket of a price as computed by src.price_sketch.bucket_of()
+INSERT_SKETCH_QUERY = """
+    INSERT INTO chrono.{table} (date_gathered, {key_names}, bucket, listings)
+    SELECT date_gathered, {key_names}, ceil(ln(price::float8) / %(log_gamma)s)::integer AS bucket, count(*)
+    FROM chrono.watch_prices
+    WHERE price > 0 AND {not_null} AND {scope}
+    GROUP BY date_gathered, {key_names}, bucket
+"""
+
+def _ensure_tables(cursor):
+    """
+    Creates the aggregate and sketch tables, adds missing columns and creates the
+    index refreshes read through. Returns True when a table or column did not exist yet.
+    """
+    cursor.execute("""
+        SELECT count(*) FROM information_schema.columns
+        WHERE table_schema = 'chrono' AND table_name = ANY(%s) AND column_name = ANY(%s)
+    """, (list(STATS_TABLES), list(ADDED_COLUMNS)))
+    missing = cursor.fetchone()[0] < len(STATS_TABLES) * len(ADDED_COLUMNS)
+    cursor.execute("SELECT count(to_regclass('chrono.' || name)) FROM unnest(%s::text[]) AS name", (list(SKETCH_TABLES),))
+    missing = missing or cursor.fetchone()[0] < len(SKETCH_TABLES)
+    for table, keys in SKETCH_TABLES.items():
+        cursor.execute(sql.SQL(CREATE_SKETCH_QUERY).format(
+            table=sql.Identifier(table),
+            keys=sql.SQL(', ').join(sql.SQL("{} varchar NOT NULL").format(sql.Identifier(key)) for key in keys),
+            key_names=sql.SQL(', ').join(map(sql.Identifier, keys)),
+        ))
+    for table, keys in STATS_TABLES.items():
+        cursor.execute(sql.SQL(CREATE_QUERY).format(
+            table=sql.Identifier(table),
+            keys=sql.SQL(', ').join(sql.SQL("{} varchar NOT NULL").format(sql.Identifier(key)) for key in keys),
+            key_names=sql.SQL(', ').join(map(sql.Identifier, keys)),
+        ))
+        for column, column_type in ADDED_COLUMNS.items():
+            cursor.execute(sql.SQL("ALTER TABLE chrono.{} ADD COLUMN IF NOT EXISTS {} {}")
+                           .format(sql.Identifier(table), sql.Identifier(column), sql.SQL(column_type)))
+    # CREATE INDEX IF NOT EXISTS share-locks watch_prices until commit even when the
+    # index exists, which would block loaders for the whole refresh
+    cursor.execute("SELECT to_regclass(%s) IS NULL", (f'chrono.{SOURCE_INDEX}',))
+    if cursor.fetchone()[0]:
+        cursor.execute(sql.SQL("CREATE INDEX {} ON chrono.watch_prices (date_gathered, brand)")
+                       .format(sql.Identifier(SOURCE_INDEX)))
+    return missing
+
+
+def refresh_daily_stats(conn, dates=None, brands=None):
+    """
+    Recomputes the aggregates of dates ('YYYY-MM-DD' strings) from chrono.watch_prices,
+    only for brands when given, and records the load of dates. dates=None, and the
+    first refresh after the tables are created, rebuild every date. Also sets the
+    reference family of those listings (see src/title_index.py) and upserts their
+    rows of chrono.listing_features (see src/listing_features.py). Commits the refresh.
+    """
+    with conn.cursor() as cursor:
+        if _ensure_tables(cursor):
+            print("Created or extended the daily price aggregates, building them from the full history")
+            dates = brands = None
+        elif families_outdated(cursor):
+            # Every listing may change family, and so every family aggregate
+            print("The title vocabulary changed, rebuilding the daily price aggregates from the full history")
+            dates = brands = None
+        # Concurrent refreshes of the same brand would insert the same keys, readers are not blocked
+        cursor.execute(sql.SQL("LOCK TABLE {} IN SHARE ROW EXCLUSIVE MODE").format(sql.SQL(', ').join(
+            sql.Identifier('chrono', table) for table in [*STATS_TABLES, *SKETCH_TABLES])))
+
+        conditions = [sql.SQL("TRUE")]
+        if dates is not None:
+            conditions.append(sql.SQL("date_gathered = ANY(%(dates)s::date[])"))
+        if brands is not None:
+            conditions.append(sql.SQL("brand = ANY(%(brands)s)"))
+        scope = sql.SQL(' AND ').join(conditions)
+        params = {'dates': list(dates or []), 'brands': list(brands or []), 'log_gamma': LOG_GAMMA}
+
+        # Listings get their reference family and typed features in the transaction that records their load
+        fill_reference_families(cursor, dates, brands)
+        refresh_listing_features(cursor, dates, brands)
+
+        rows = 0
+        for table, keys in STATS_TABLES.items():
+            cursor.execute(sql.SQL(DELETE_QUERY).format(table=sql.Identifier(table), scope=scope), params)
+            cursor.execute(sql.SQL(INSERT_QUERY).format(
+                table=sql.Identifier(table),
+                key_names=sql.SQL(', ').join(map(sql.Identifier, keys)),
+                stats=sql.SQL(', ').join(map(sql.Identifier, STATS_COLUMNS)),
+                not_null=sql.SQL(' AND ').join(sql.SQL("{} IS NOT NULL").format(sql.Identifier(key)) for key in keys),
+                scope=scope,
+            ), params)
+            rows += cursor.rowcount
+        for table, keys in SKETCH_TABLES.items():
+            cursor.execute(sql.SQL(DELETE_QUERY).format(table=sql.Identifier(table), scope=scope), params)
+            cursor.execute(sql.SQL(INSERT_SKETCH_QUERY).format(
+                table=sql.Identifier(table),
+                key_names=sql.SQL(', ').join(map(sql.Identifier, keys)),
+                not_null=sql.SQL(' AND ').join(sql.SQL("{} IS NOT NULL").format(sql.Identifier(key)) for key in keys),
+                scope=scope,
+            ), params)
+        record_load(cursor, dates)
+    conn.commit()
+    return rows
+
+
+if __name__ == "__main__":
+    from src.db_pool import get_pool
+
+    start_time = time.time()
+    with get_pool().connection() as conn:
+        rows = refresh_daily_stats(conn)
+    print(f"Rebuilt {rows} daily aggregate rows in {time.time() - start_time:.2f} seconds")
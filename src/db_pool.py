@@ -0,0 +1,187 @@
+"""
+Shared PostgreSQL connection pooling for the ETL and the dashboard.
+
+get_pool() returns a process-wide psycopg2 pool, so ETL classes and scripts reuse
+TLS connections across categories and, because module state survives between
+Azure Function invocations on a warm worker, across runs. create_pooled_engine()
+builds the SQLAlchemy engine used by the Streamlit app with the same sizing and
+health checks. Both count checkouts, the time spent waiting for them and reconnects.
+"""
+import contextlib
+import os
+import threading
+import time
+
+import psycopg2
+from psycopg2 import extensions, pool
+from dotenv import load_dotenv
+
+load_dotenv()
+
+POOL_MIN_SIZE = int(os.getenv('DB_POOL_MIN_SIZE', '1'))
+POOL_MAX_SIZE = int(os.getenv('DB_POOL_MAX_SIZE', '8'))
+# Connections idle longer than this are pinged before they are handed out again
+HEALTH_CHECK_AFTER_SECONDS = float(os.getenv('DB_POOL_HEALTH_CHECK_AFTER', '30'))
+
+
+def db_config():
+    return {
+        'dbname': os.getenv('DB_NAME'),
+        'user': os.getenv('DB_USER'),
+        'password': os.getenv('DB_PASSWORD'),
+        'host': os.getenv('DB_HOST'),
+        'port': os.getenv('DB_PORT')
+    }
+
+
+class ConnectionPool:
+    def __init__(self, min_size=POOL_MIN_SIZE, max_size=POOL_MAX_SIZE,
+                 health_check_after=HEALTH_CHECK_AFTER_SECONDS, **config):
+        self._pool = pool.ThreadedConnectionPool(min_size, max_size, **(config or db_config()))
+        # ThreadedConnectionPool raises when exhausted, the semaphore makes callers wait instead
+        self._slots = threading.BoundedSemaphore(max_size)
+        self._last_used = {}
+        self._lock = threading.Lock()
+        self.health_check_after = health_check_after
+        self.stats = {'checkouts': 0, 'wait_seconds': 0.0, 'max_wait_seconds': 0.0, 'reconnects': 0}
+
+    def getconn(self, timeout=None):
+        start_time = time.perf_counter()
+        if not self._slots.acquire(timeout=timeout):
+            raise pool.PoolError(f"No database connection available after {timeout} seconds")
+        waited = time.perf_counter() - start_time
+
+        try:
+            conn = self._checkout_healthy()
+        except Exception:
+            self._slots.release()
+            raise
+
+        with self._lock:
+            self.stats['checkouts'] += 1
+            self.stats['wait_seconds'] += waited
+            self.stats['max_wait_seconds'] = max(self.stats['max_wait_seconds'], waited)
+        return conn
+
+    def _checkout_healthy(self):
+        # After a server restart every idle connection is dead, so up to all of them
+        # are dropped before a new one is opened
+        for _ in range(self._pool.maxconn + 1):
+            conn = self._pool.getconn()
+            if self._is_healthy(conn):
+                return conn
+            self._forget(conn)
+            self._pool.putconn(conn, close=True)
+            with self._lock:
+                self.stats['reconnects'] += 1
+        raise pool.PoolError("No healthy database connection after reconnecting")
+
+    def putconn(self, conn, close=False):
+        try:
+            if not conn.closed and conn.get_transaction_status() != extensions.TRANSACTION_STATUS_IDLE:
+                conn.rollback()
+        except psycopg2.Error:
+            close = True
+        close = close or bool(conn.closed)
+        if close:
+            self._forget(conn)
+        else:
+            with self._lock:
+                self._last_used[id(conn)] = time.monotonic()
+        self._pool.putconn(conn, close=close)
+        self._slots.release()
+
+    def _forget(self, conn):
+        with self._lock:
+            self._last_used.pop(id(conn), None)
+
+    @contextlib.contextmanager
+    def connection(self, timeout=None):
+        conn = self.getconn(timeout)
+        try:
+            yield conn
+        finally:
+            self.putconn(conn)
+
+    def _is_healthy(self, conn):
+        if conn.closed:
+            return False
+        with self._lock:
+            last_used = self._last_used.get(id(conn))
+        if last_used is not None and time.monotonic() - last_used < self.health_check_after:
+            return True
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT 1")
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def summary(self):
+        checkouts = self.stats['checkouts']
+        average_wait = self.stats['wait_seconds'] / checkouts if checkouts else 0.0
+        return (f"{checkouts} checkouts, {average_wait * 1000:.1f} ms average wait, "
+                f"{self.stats['max_wait_seconds'] * 1000:.1f} ms max wait, {self.stats['reconnects']} reconnects")
+
+    def closeall(self):
+        self._pool.closeall()
+
+
+_shared_pool = None
+_shared_pool_lock = threading.Lock()
+
+
+def get_pool():
+    """
+    Returns the process-wide pool, creating it on first use.
+    """
+    global _shared_pool
+    with _shared_pool_lock:
+        if _shared_pool is None or _shared_pool._pool.closed:
+            _shared_pool = ConnectionPool()
+        return _shared_pool
+
+
+def create_pooled_engine(min_size=POOL_MIN_SIZE, max_size=POOL_MAX_SIZE):
+    """
+    Creates a SQLAlchemy engine sized like the shared pool, with pre-ping health
+    checks. engine.pool_stats counts checkouts, the seconds spent in them (waiting
+    for a free connection, opening one and the pre-ping) and newly opened
+    connections; engine.pool.status() shows the current pool occupancy.
+    """
+    from sqlalchemy import URL, create_engine, event
+    from sqlalchemy.pool import QueuePool
+
+    stats = {'checkouts': 0, 'wait_seconds': 0.0, 'max_wait_seconds': 0.0, 'connects': 0}
+    lock = threading.Lock()
+
+    class TimedQueuePool(QueuePool):
+        def connect(self):
+            start_time = time.perf_counter()
+            connection = super().connect()
+            waited = time.perf_counter() - start_time
+            with lock:
+                stats['wait_seconds'] += waited
+                stats['max_wait_seconds'] = max(stats['max_wait_seconds'], waited)
+            return connection
+
+    config = db_config()
+    engine_url = URL.create('postgresql', username=config['user'], password=config['password'], host=config['host'],
+                            port=int(config['port']) if config['port'] else None, database=config['dbname'])
+    # engine.dispose() recreates the pool with the same class, so the timing survives it
+    engine = create_engine(engine_url, poolclass=TimedQueuePool, pool_size=min_size,
+                           max_overflow=max(max_size - min_size, 0), pool_pre_ping=True, pool_recycle=1800)
+
+    @event.listens_for(engine.pool, 'checkout')
+    def _count_checkout(dbapi_connection, connection_record, connection_proxy):
+        with lock:
+            stats['checkouts'] += 1
+
+    @event.listens_for(engine.pool, 'connect')
+    def _count_connect(dbapi_connection, connection_record):
+        with lock:
+            stats['connects'] += 1
+
+    engine.pool_stats = stats
+    return engine
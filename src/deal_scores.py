@@ -0,0 +1,307 @@
+"""
+Deal scores of the listings in chrono.watch_prices, computed after every ETL run.
+
+Every listing added or repriced since the last scoring is compared with two
+expected prices:
+
+    market  the mean and standard deviation of its model over the DEAL_WINDOW_DAYS
+            days up to the batch, merged from chrono.daily_model_prices as
+            PriceMoments.from_daily() does, and its percentile in the model's
+            merged daily price sketches, both without the listing's own price
+    model   the price predicted from its features by the latest fitted DEAL_MODEL
+            of the model registry, with the model's test RMSE as its spread
+
+The percentile counts the prices of lower sketch buckets and, of the prices
+sharing the listing's 2% bucket, the share below its position in the bucket as
+if they were spread evenly. Its error is at most the share of the model's
+listings in that bucket, a few points for models whose prices cluster.
+
+deal_score is how many standard deviations below those expectations the listing
+is priced, averaged over the ones available, the percentile read as the
+standard normal quantile it falls at. The whole batch is scored with a
+handful of grouped pandas operations and one predict() call, not per listing.
+Listings scoring at least DEAL_SCORE_THRESHOLD are written to chrono.deal_scores
+with a reason, one row per listing_id for its latest scored date, so the
+dashboard ranks the best deals across all brands with one indexed query.
+
+Scoring runs before the models are retrained, so new listings are scored by a
+model that has not seen them. The first scoring, and python -m src.deal_scores,
+score every listing of the last DEAL_WINDOW_DAYS days.
+"""
+import math
+import os
+import time
+
+import numpy as np
+import pandas as pd
+from psycopg2 import sql
+from psycopg2.extras import execute_values
+from scipy.stats import norm
+
+from src.features import FEATURE_COLUMNS
+from src.load_log import CHANGED_ROWS_SCOPE, LATEST_LOAD_QUERY, changed_rows_params, watermarks
+from src.model_registry import ModelRegistry
+from src.price_sketch import LOG_GAMMA, bucket_of
+
+DEAL_MODEL = os.getenv('DEAL_MODEL', 'Histogram Gradient Boosting')
+# Days of a model's listings its market price is computed over
+DEAL_WINDOW_DAYS = int(os.getenv('DEAL_WINDOW_DAYS', '30'))
+# Standard deviations below the expected price from which a listing is stored as a deal
+DEAL_SCORE_THRESHOLD = 1.5
+# Models with fewer listings in the window have no market score
+MIN_MODEL_LISTINGS = 10
+
+DEAL_COLUMNS = ['id', 'listing_id', 'date_gathered', 'brand', 'model', 'price', 'url', 'market_price',
+                'percentile', 'z_score', 'predicted_price', 'residual_score', 'deal_score', 'reason', 'load_id']
+
+CREATE_QUERIES = [
+    """
+    CREATE TABLE IF NOT EXISTS chrono.deal_scores (
+        listing_id varchar PRIMARY KEY,
+        id integer NOT NULL,
+        date_gathered date NOT NULL,
+        brand varchar NOT NULL,
+        model text NOT NULL,
+        price double precision NOT NULL,
+        url text,
+        market_price double precision,
+        percentile double precision,
+        z_score double precision,
+        predicted_price double precision,
+        residual_score double precision,
+        deal_score double precision NOT NULL,
+        reason text NOT NULL,
+        load_id bigint NOT NULL
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS deal_scores_rank_idx ON chrono.deal_scores (deal_score DESC)",
+    """
+    CREATE TABLE IF NOT EXISTS chrono.deal_score_loads (
+        load_id bigint PRIMARY KEY,
+        scored_at timestamptz NOT NULL DEFAULT now(),
+        listings integer NOT NULL,
+        deals integer NOT NULL
+    )
+    """,
+]
+
+# The features with their typed details, the url from the price row sharing the id
+BATCH_QUERY = f"""
+    SELECT id, listing_id, date_gathered, brand, price,
+           (SELECT url FROM chrono.watch_prices AS wp WHERE wp.id = features.id) AS url, {', '.join(FEATURE_COLUMNS)}
+    FROM chrono.listing_features AS features
+    WHERE price > 0 AND brand IS NOT NULL AND model IS NOT NULL AND ({{scope}})
+"""
+
+WINDOW_SCOPE = "date_gathered > (SELECT max(date_gathered) FROM chrono.watch_prices) - %(window)s"
+
+MARKET_QUERY = """
+    SELECT brand, model, {columns} FROM chrono.{table}
+    WHERE date_gathered > %(end)s::date - %(window)s AND date_gathered <= %(end)s
+      AND (brand, model) IN (SELECT * FROM unnest(%(brands)s::varchar[], %(models)s::text[]))
+    {group_by}
+"""
+
+
+def _ensure_tables(cursor):
+    """
+    Creates the score tables and returns the last scored load_id, None before the first scoring.
+    """
+    for query in CREATE_QUERIES:
+        cursor.execute(query)
+    cursor.execute("SELECT max(load_id) FROM chrono.deal_score_loads")
+    return cursor.fetchone()[0]
+
+
+def _frame(cursor, query, params):
+    cursor.execute(query, params)
+    return pd.DataFrame(cursor.fetchall(), columns=[column.name for column in cursor.description])
+
+
+def _read_batch(cursor, scored_load, load):
+    """
+    Listings added or repriced after scored_load up to load, the last window's
+    listings when nothing was scored yet. Keeps the latest row of each listing_id.
+    """
+    previous = watermarks(cursor, scored_load) if scored_load is not None else None
+    if previous is None or previous.get('max_row_id') is None:
+        batch = _frame(cursor, BATCH_QUERY.format(scope=WINDOW_SCOPE), {'window': DEAL_WINDOW_DAYS})
+    else:
+        batch = _frame(cursor, BATCH_QUERY.format(scope=CHANGED_ROWS_SCOPE), changed_rows_params(previous, load))
+    return batch.sort_values(['date_gathered', 'id']).drop_duplicates('listing_id', keep='last')
+
+
+def _market(cursor, batch):
+    """
+    Per model of the batch: listings, mean and M2 of the prices over the window,
+    and its merged sketch (bucket, listings, cumulative listings through the bucket).
+    """
+    params = {'end': batch['date_gathered'].max(), 'window': DEAL_WINDOW_DAYS}
+    keys = batch[['brand', 'model']].drop_duplicates()
+    params.update(brands=keys['brand'].tolist(), models=keys['model'].tolist())
+
+    daily = _frame(cursor, MARKET_QUERY.format(table='daily_model_prices', group_by='',
+                                               columns='listings, mean_price, m2_price'), params)
+    daily = daily[daily['listings'] > 0]
+    grouped = daily.assign(total=daily['listings'] * daily['mean_price']).groupby(['brand', 'model'])
+    moments = pd.DataFrame({'market_listings': grouped['listings'].sum()})
+    moments['market_price'] = grouped['total'].sum() / moments['market_listings']
+    # Chan's merge of the days, as PriceMoments.from_daily() for one model
+    daily = daily.join(moments['market_price'], on=['brand', 'model'])
+    m2 = (daily['m2_price'] + daily['listings'] * (daily['mean_price'] - daily['market_price']) ** 2)
+    moments['market_m2'] = m2.groupby([daily['brand'], daily['model']]).sum()
+
+    sketches = _frame(cursor, MARKET_QUERY.format(table='daily_model_price_sketches',
+                                                  columns='bucket, sum(listings)::bigint AS bucket_listings',
+                                                  group_by='GROUP BY brand, model, bucket'), params)
+    sketches = sketches.sort_values(['brand', 'model', 'bucket']).assign(sketch_bucket=sketches['bucket'])
+    sketches['through'] = sketches.groupby(['brand', 'model'])['bucket_listings'].cumsum()
+    return moments.reset_index(), sketches
+
+
+def _percentiles(batch, sketches):
+    """
+    Share of the other sketched prices of each listing's model that are below its
+    price. The listing's own price is one of those sketched in its bucket.
+    """
+    if sketches.empty:
+        return np.full(len(batch), np.nan)
+    listings = batch[['brand', 'model', 'price']].assign(bucket=bucket_of(batch['price']), position=np.arange(len(batch)))
+    matched = pd.merge_asof(listings.sort_values('bucket'), sketches.sort_values('bucket'),
+                            on='bucket', by=['brand', 'model'], direction='backward')
+    matched = matched.sort_values('position')
+    totals = sketches.groupby(['brand', 'model'])['bucket_listings'].sum().rename('total')
+    matched = matched.join(totals, on=['brand', 'model'])
+    same_bucket = matched['bucket_listings'].where(matched['sketch_bucket'] == matched['bucket'], 0).fillna(0)
+    below = matched['through'].fillna(0) - same_bucket
+    # Where the price lies between its bucket's bounds on the log scale the buckets are even on
+    position = np.log(matched['price']) / LOG_GAMMA - (matched['bucket'] - 1)
+    others = matched['total'] - 1
+    return ((below + (same_bucket - 1).clip(lower=0) * position) / others.where(others > 0)).to_numpy()
+
+
+def _predictions(batch):
+    """
+    Prices predicted by the latest DEAL_MODEL and its test RMSE, (None, None)
+    when it has not been trained.
+    """
+    registry = ModelRegistry()
+    path = registry.latest_path(DEAL_MODEL)
+    if path is None:
+        return None, None
+    entry = registry.load(path)
+    if entry['pipeline'] is None or not entry['mse']:
+        return None, None
+    # Models fitted before FEATURE_COLUMNS changed take the columns they were fitted on
+    return entry['pipeline'].predict(batch[entry['pipeline'].feature_names_in_]), math.sqrt(entry['mse'])
+
+
+def _dollars(values):
+    return '$' + values.map('{:,.0f}'.format)
+
+
+def score_listings(batch, moments, sketches, predicted=None, rmse=None):
+    """
+    Adds market_price, percentile, z_score, percentile_score, predicted_price,
+    residual_score, deal_score and reason columns to a batch of listings, scored
+    against moments and sketches that include their own prices.
+    """
+    scored = batch.merge(moments, on=['brand', 'model'], how='left')
+    # The listing's own price is one of the window's, its expectations are those of the other listings
+    listings, mean = scored['market_listings'].fillna(0), scored['market_price']
+    others = listings - 1
+    scored['market_price'] = ((listings * mean - scored['price']) / others).where(others > 0)
+    m2 = (scored['market_m2'] - (scored['price'] - mean) * (scored['price'] - scored['market_price'])).clip(lower=0)
+    known = others >= MIN_MODEL_LISTINGS
+    scored['z_score'] = ((scored['price'] - scored['market_price']) / np.sqrt(m2 / (others - 1))).where(known)
+    scored['percentile'] = pd.Series(_percentiles(scored, sketches), index=scored.index).where(known)
+    # As standard deviations, the cheapest and dearest listings at half a listing from the ends
+    ends = 0.5 / others.where(others > 0)
+    scored['percentile_score'] = norm.ppf(scored['percentile'].clip(lower=ends, upper=1 - ends))
+    scored['predicted_price'] = predicted if predicted is not None else np.nan
+    scored['residual_score'] = (scored['price'] - scored['predicted_price']) / rmse if rmse else np.nan
+    scored['deal_score'] = -scored[['z_score', 'percentile_score', 'residual_score']].replace(
+        [np.inf, -np.inf], np.nan).mean(axis=1)
+
+    deals = scored['deal_score'] >= DEAL_SCORE_THRESHOLD
+    market = (((1 - scored['price'] / scored['market_price']) * 100).round().astype('Int64').astype(str)
+              + f"% under the {DEAL_WINDOW_DAYS}-day average of " + _dollars(scored['market_price'])
+              + ", cheaper than " + ((1 - scored['percentile']) * 100).round().astype('Int64').astype(str)
+              + "% of its listings")
+    model = (((1 - scored['price'] / scored['predicted_price']) * 100).round().astype('Int64').astype(str)
+             + f"% under the {DEAL_MODEL} estimate of " + _dollars(scored['predicted_price']))
+    scored['reason'] = ''
+    reasons = pd.concat([market.where(deals & scored['z_score'].notna()),
+                         model.where(deals & scored['residual_score'].notna())], axis=1)
+    scored.loc[deals, 'reason'] = reasons[deals].apply(lambda parts: '; '.join(parts.dropna()), axis=1)
+    return scored
+
+
+def score_deals(conn, rescore=False):
+    """
+    Scores the listings loaded since the last scoring (the last window's when
+    rescore=True) and stores the deals in chrono.deal_scores. Commits and returns
+    the numbers of listings scored and deals stored.
+    """
+    with conn.cursor() as cursor:
+        scored_load = _ensure_tables(cursor)
+        # Concurrent ETL runs would score the same listings twice
+        cursor.execute("LOCK TABLE chrono.deal_score_loads IN EXCLUSIVE MODE")
+        scored_load = None if rescore else scored_load
+        cursor.execute(LATEST_LOAD_QUERY)
+        load_id = cursor.fetchone()[0]
+        if load_id is None:
+            conn.commit()
+            return 0, 0
+        load = watermarks(cursor, load_id)
+
+        batch = _read_batch(cursor, scored_load, load)
+        deals = pd.DataFrame(columns=DEAL_COLUMNS)
+        if not batch.empty:
+            moments, sketches = _market(cursor, batch)
+            predicted, rmse = _predictions(batch)
+            scored = score_listings(batch, moments, sketches, predicted, rmse)
+            deals = scored[scored['deal_score'] >= DEAL_SCORE_THRESHOLD].assign(load_id=load_id)[DEAL_COLUMNS]
+
+        # A listing scored again replaces its previous score, deals older than the window expire
+        cursor.execute("""
+            DELETE FROM chrono.deal_scores
+            WHERE listing_id = ANY(%(listing_ids)s::varchar[]) OR date_gathered <= %(end)s::date - %(window)s
+        """, {'listing_ids': batch['listing_id'].tolist(), 'window': DEAL_WINDOW_DAYS,
+              'end': batch['date_gathered'].max() if not batch.empty else None})
+        rows = deals.astype(object).where(deals.notna(), None).itertuples(index=False, name=None)
+        execute_values(cursor, sql.SQL("INSERT INTO chrono.deal_scores ({}) VALUES %s").format(
+            sql.SQL(', ').join(map(sql.Identifier, DEAL_COLUMNS))).as_string(cursor), list(rows), page_size=1000)
+        cursor.execute("""
+            INSERT INTO chrono.deal_score_loads (load_id, listings, deals) VALUES (%s, %s, %s)
+            ON CONFLICT (load_id) DO UPDATE SET scored_at = now(), listings = EXCLUDED.listings, deals = EXCLUDED.deals
+        """, (load_id, len(batch), len(deals)))
+    conn.commit()
+    return len(batch), len(deals)
+
+
+def score_after_load():
+    """
+    Called at the end of ETL runs, before the models are retrained, unless SCORE_DEALS=0.
+    """
+    if os.getenv('SCORE_DEALS', '1') == '0':
+        return
+    from src.db_pool import get_pool
+
+    try:
+        start_time = time.time()
+        with get_pool().connection() as conn:
+            listings, deals = score_deals(conn)
+        print(f"Scored {listings} listings, {deals} deals, in {time.time() - start_time:.2f} seconds")
+    except Exception as e:
+        print(f"Error scoring deals: {e}")
+
+
+if __name__ == "__main__":
+    from src.db_pool import get_pool
+
+    start_time = time.time()
+    with get_pool().connection() as conn:
+        listings, deals = score_deals(conn, rescore=True)
+    print(f"Rescored {listings} listings of the last {DEAL_WINDOW_DAYS} days, {deals} deals, "
+          f"in {time.time() - start_time:.2f} seconds")
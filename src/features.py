@@ -0,0 +1,155 @@
+"""
+Feature encodings for the price models.
+
+The features are read from chrono.listing_features (src/listing_features.py),
+which adds the parsed details of each listing to its price row. The
+low-cardinality columns (certification status, condition, badge, delivery scope)
+are one-hot encoded, missing numbers (shipping price, production year, case
+diameter, merchant rating) are imputed with the mean. merchant_name and model
+(the listing title) have thousands to tens of thousands of distinct values, so
+one-hot encoding them makes a column per merchant and title. ENCODINGS offers
+narrower alternatives for those two:
+
+    onehot         a column per value, the previous encoding
+    min_frequency  a column per value seen at least MIN_FREQUENCY times, one for the rest
+    hashing        values hashed into HASHED_FEATURES columns, stateless so new
+                   merchants and titles need no refit
+    frequency      one column per feature, the share of listings with the value
+    target         one column per feature, the cross-fitted mean price of the value
+
+build_preprocessor() returns a ColumnTransformer whose output is a scipy sparse
+matrix whenever most of it is zeros (one-hot and hashed columns), which random
+forests, gradient boosting, SVR and linear models take without densifying it.
+The narrow frequency and target encodings come out dense.
+python -m benchmarks.bench_features compares the encodings.
+"""
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+from sklearn.base import BaseEstimator, TransformerMixin
+from sklearn.compose import ColumnTransformer
+from sklearn.feature_extraction import FeatureHasher
+from sklearn.impute import SimpleImputer
+from sklearn.pipeline import Pipeline
+from sklearn.preprocessing import OneHotEncoder, StandardScaler, TargetEncoder
+
+CATEGORICAL_FEATURES = ['certification_status', 'condition', 'badge', 'delivery_scope']
+HIGH_CARDINALITY_FEATURES = ['merchant_name', 'model']
+NUMERICAL_FEATURES = ['shipping_price', 'production_year', 'case_diameter_mm', 'merchant_rating']
+FEATURE_COLUMNS = CATEGORICAL_FEATURES + HIGH_CARDINALITY_FEATURES + NUMERICAL_FEATURES
+
+ENCODINGS = ['onehot', 'min_frequency', 'hashing', 'frequency', 'target']
+DEFAULT_ENCODING = 'min_frequency'
+
+# Values seen fewer times than this share one infrequent column
+MIN_FREQUENCY = 20
+HASHED_FEATURES = 2 ** 12
+
+
+def _strings(X):
+    # Missing values become their own category, as with the imputer of the one-hot path
+    return pd.DataFrame(X).astype(object).where(pd.notna(X), 'missing').astype(str)
+
+
+class HashingEncoder(BaseEstimator, TransformerMixin):
+    """
+    Hashes 'column=value' strings into n_features sparse columns.
+    """
+    def __init__(self, n_features=HASHED_FEATURES):
+        self.n_features = n_features
+
+    def fit(self, X, y=None):
+        self.n_features_in_ = X.shape[1]
+        return self
+
+    def transform(self, X):
+        values = _strings(X)
+        hasher = FeatureHasher(n_features=self.n_features, input_type='string', alternate_sign=False)
+        # Each distinct value is hashed once, rows take the column of their value
+        columns = []
+        for column in values.columns:
+            codes, uniques = pd.factorize(values[column])
+            hashed = hasher.transform([[f'{column}={value}'] for value in uniques])
+            columns.append(hashed.indices[codes])
+        indices = np.column_stack(columns).ravel() if columns else np.empty(0, dtype='int32')
+        indptr = np.arange(0, len(indices) + 1, max(len(columns), 1))
+        matrix = sp.csr_matrix((np.ones(len(indices)), indices, indptr), shape=(len(values), self.n_features))
+        # Values of different columns hashed to the same column add up, as with FeatureHasher
+        matrix.sum_duplicates()
+        return matrix
+
+    def get_feature_names_out(self, input_features=None):
+        return np.array([f'hash_{index}' for index in range(self.n_features)], dtype=object)
+
+
+class FrequencyEncoder(BaseEstimator, TransformerMixin):
+    """
+    Replaces each value with the share of training rows holding it, 0 for unseen values.
+    """
+    def fit(self, X, y=None):
+        values = _strings(X)
+        self.feature_names_in_ = np.array(values.columns.astype(str), dtype=object)
+        self.frequencies_ = [values[column].value_counts(normalize=True) for column in values.columns]
+        return self
+
+    def transform(self, X):
+        values = _strings(X)
+        return np.column_stack([
+            values[column].map(frequencies).fillna(0.0).to_numpy(dtype='float64')
+            for column, frequencies in zip(values.columns, self.frequencies_)
+        ])
+
+    def get_feature_names_out(self, input_features=None):
+        return np.array([f'{name}_frequency' for name in self.feature_names_in_], dtype=object)
+
+
+def high_cardinality_encoder(encoding=DEFAULT_ENCODING):
+    if encoding == 'onehot':
+        return Pipeline(steps=[
+            ('imputer', SimpleImputer(strategy='constant', fill_value='missing')),
+            ('onehot', OneHotEncoder(handle_unknown='ignore'))
+        ])
+    if encoding == 'min_frequency':
+        return Pipeline(steps=[
+            ('imputer', SimpleImputer(strategy='constant', fill_value='missing')),
+            ('onehot', OneHotEncoder(handle_unknown='infrequent_if_exist', min_frequency=MIN_FREQUENCY))
+        ])
+    if encoding == 'hashing':
+        return HashingEncoder()
+    if encoding == 'frequency':
+        return FrequencyEncoder()
+    if encoding == 'target':
+        return Pipeline(steps=[
+            ('imputer', SimpleImputer(strategy='constant', fill_value='missing')),
+            ('target', TargetEncoder(target_type='continuous', random_state=42))
+        ])
+    raise ValueError(f"Unknown encoding {encoding!r}, expected one of {ENCODINGS}")
+
+
+def build_preprocessor(encoding=DEFAULT_ENCODING, scale=False):
+    """
+    Imputes and encodes FEATURE_COLUMNS, merchant_name and model with encoding.
+    scale=True standardizes NUMERICAL_FEATURES, for SVR.
+    """
+    categorical_transformer = Pipeline(steps=[
+        ('imputer', SimpleImputer(strategy='constant', fill_value='missing')),
+        ('onehot', OneHotEncoder(handle_unknown='ignore'))
+    ])
+    numerical_transformer = Pipeline(steps=[
+        ('imputer', SimpleImputer(strategy='mean')),
+        ('scaler', StandardScaler()) if scale else ('passthrough', 'passthrough')
+    ])
+    return ColumnTransformer(transformers=[
+        ('num', numerical_transformer, NUMERICAL_FEATURES),
+        ('cat', categorical_transformer, CATEGORICAL_FEATURES),
+        ('high', high_cardinality_encoder(encoding), HIGH_CARDINALITY_FEATURES)
+    ], verbose_feature_names_out=False)
+
+
+def matrix_bytes(matrix):
+    """
+    Memory held by a dense array or a scipy sparse matrix.
+    """
+    if hasattr(matrix, 'indptr'):
+        return matrix.data.nbytes + matrix.indices.nbytes + matrix.indptr.nbytes
+    return np.asarray(matrix).nbytes
@@ -0,0 +1,63 @@
+"""
+In-process DataFrame cache for the dashboard, keyed on the ETL load version.
+
+FrameCache keeps query slices in an LRU bounded by their memory size. It is
+shared by every session and hands out views: with pandas copy-on-write enabled
+these are shallow copies, so a caller adding or overwriting columns copies what
+it touches instead of writing into the cache. Without copy-on-write callers get
+deep copies.
+"""
+import collections
+import threading
+
+import pandas as pd
+
+
+def _view(frame):
+    return frame.copy(deep=not pd.get_option('mode.copy_on_write'))
+
+
+class FrameCache:
+    def __init__(self, max_bytes):
+        """
+        Keeps the most recently used frames until their memory size passes max_bytes.
+        """
+        self.max_bytes = max_bytes
+        self._entries = collections.OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.stats = {'hits': 0, 'misses': 0, 'evictions': 0}
+
+    def get(self, key, version, load):
+        """
+        Returns a view of the frame cached under key, calling load() when it is
+        missing or was read at another version.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and entry[0] == version:
+                self._entries.move_to_end(key)
+                self.stats['hits'] += 1
+                return _view(entry[1])
+            self.stats['misses'] += 1
+
+        # Reading outside the lock lets other slices be served meanwhile
+        frame = load()
+        size = int(frame.memory_usage(deep=True).sum())
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old:
+                self._bytes -= old[2]
+            # A frame larger than the whole budget is returned without being cached
+            if size <= self.max_bytes:
+                self._entries[key] = (version, frame, size)
+                self._bytes += size
+                while self._bytes > self.max_bytes:
+                    _, (_, _, evicted_size) = self._entries.popitem(last=False)
+                    self._bytes -= evicted_size
+                    self.stats['evictions'] += 1
+        return _view(frame)
+
+    @property
+    def size_bytes(self):
+        return self._bytes
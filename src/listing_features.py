@@ -0,0 +1,183 @@
+"""
+Typed listing features for the price models and the ML page.
+
+chrono.listing_features holds one row per chrono.watch_prices row: its price,
+the listing columns the models use, and the latest chrono.watch_details row of
+its listing with the numbers parsed out of the text, production_year and
+merchant_reviews as integers, case_diameter_mm ('41 x 41 mm' is 41.0) and
+merchant_rating as floats. They are parsed in PostgreSQL with the patterns
+normalize_listings() parses scraped listings with (src/normalize.py).
+
+Each refresh of the daily aggregates upserts the rows of the days and brands just
+loaded, and every row of the listings whose details were gathered on those days,
+in the transaction that records the load. Rows are deleted with their
+chrono.watch_prices row through an ON DELETE CASCADE foreign key, whichever
+statement deletes it. Training, deal scoring and the ML page read this one
+narrow, indexed table instead of joining the details at request time.
+python -m src.listing_features rebuilds it.
+"""
+import time
+
+import pyarrow as pa
+from psycopg2 import sql
+
+from src.normalize import NUMERIC_FIELDS
+
+# Feature column -> (watch_details column, src/normalize.py field it is parsed as)
+PARSED_DETAILS = {
+    'production_year': ('production_year', 'production_year_value'),
+    'case_diameter_mm': ('case_diameter', 'case_diameter_mm'),
+    'merchant_rating': ('merchant_rating', 'merchant_rating'),
+    'merchant_reviews': ('merchant_reviews', 'merchant_reviews'),
+}
+
+CREATE_QUERY = """
+    CREATE TABLE IF NOT EXISTS chrono.listing_features (
+        id integer PRIMARY KEY REFERENCES chrono.watch_prices (id) ON DELETE CASCADE,
+        listing_id varchar,
+        date_gathered date,
+        brand varchar,
+        model text,
+        reference_family varchar,
+        price double precision,
+        shipping_price double precision,
+        certification_status varchar,
+        condition varchar,
+        badge varchar,
+        merchant_name varchar,
+        delivery_scope text,
+        production_year integer,
+        case_diameter_mm double precision,
+        merchant_rating double precision,
+        merchant_reviews integer
+    )
+"""
+# Index name -> what it indexes
+INDEXES = {
+    'listing_features_brand_model_idx': 'chrono.listing_features (brand, model, date_gathered)',
+    'listing_features_date_gathered_idx': 'chrono.listing_features (date_gathered)',
+    # The latest details of a listing, and the listings detailed on a day
+    'watch_details_listing_id_idx': 'chrono.watch_details (listing_id, date_gathered, id)',
+    'watch_details_date_gathered_idx': 'chrono.watch_details (date_gathered)',
+}
+
+LISTING_COLUMNS = ['id', 'listing_id', 'date_gathered', 'brand', 'model', 'reference_family', 'price',
+                   'shipping_price', 'certification_status', 'condition', 'badge', 'merchant_name']
+FEATURE_TABLE_COLUMNS = LISTING_COLUMNS + ['delivery_scope'] + list(PARSED_DETAILS)
+
+UPSERT_QUERY = """
+    WITH listings AS (
+        SELECT * FROM chrono.watch_prices WHERE {scope}
+    ), details AS (
+        SELECT DISTINCT ON (listing_id) * FROM chrono.watch_details
+        WHERE listing_id IN (SELECT listing_id FROM listings)
+        ORDER BY listing_id, date_gathered DESC, id DESC
+    )
+    INSERT INTO chrono.listing_features AS features ({columns})
+    SELECT {listing_columns}, details.delivery_scope, {parsed}
+    FROM listings LEFT JOIN details USING (listing_id)
+    ON CONFLICT (id) DO UPDATE SET ({updated}) = ROW({excluded})
+        WHERE ({current}) IS DISTINCT FROM ({excluded})
+"""
+
+FOREIGN_KEY = 'listing_features_id_fkey'
+FOREIGN_KEY_EXISTS_QUERY = "SELECT EXISTS (SELECT 1 FROM pg_constraint " \
+                           "WHERE conrelid = 'chrono.listing_features'::regclass AND conname = %s)"
+ADD_FOREIGN_KEY_QUERY = """
+    ALTER TABLE chrono.listing_features ADD CONSTRAINT {}
+    FOREIGN KEY (id) REFERENCES chrono.watch_prices (id) ON DELETE CASCADE
+"""
+# Rows whose listing was deleted from chrono.watch_prices before the foreign key was added
+DELETE_QUERY = """
+    DELETE FROM chrono.listing_features AS features
+    WHERE NOT EXISTS (SELECT 1 FROM chrono.watch_prices WHERE id = features.id)
+"""
+
+
+def _parsed_number(column, field):
+    """
+    SQL expression parsing a watch_details text column like normalize_listings() parses field.
+    """
+    _, pattern, thousands, value_type = NUMERIC_FIELDS[field]
+    # PostgreSQL has no named groups and spells word boundaries \y
+    pattern = pattern.replace('(?P<n>', '(').replace(r'\b', r'\y')
+    # Cast to text, as merchant_rating and merchant_reviews are numbers where the details were uploaded as floats
+    number = sql.SQL("replace(substring(btrim(details.{}::text) from {}), {}, {})::float8").format(
+        sql.Identifier(column), sql.Literal(pattern), sql.Literal(thousands or ','),
+        sql.Literal('' if thousands else '.'))
+    if pa.types.is_integer(value_type):
+        # Arrow's unsafe cast truncates
+        number = sql.SQL("trunc({})::integer").format(number)
+    return number
+
+
+def _listing_column(column):
+    if column in ('price', 'shipping_price'):
+        return sql.SQL("listings.{}::float8").format(sql.Identifier(column))
+    return sql.SQL("listings.{}").format(sql.Identifier(column))
+
+
+def _ensure_table(cursor):
+    """
+    Creates the feature table and its indexes, and the foreign key of tables created
+    without it. Returns True when the table did not exist yet.
+    """
+    cursor.execute("SELECT to_regclass('chrono.listing_features') IS NULL")
+    missing = cursor.fetchone()[0]
+    cursor.execute(CREATE_QUERY)
+    # CREATE INDEX IF NOT EXISTS would share-lock watch_details until commit, blocking the details loader
+    cursor.execute("SELECT name FROM unnest(%s::text[]) AS name WHERE to_regclass('chrono.' || name) IS NULL",
+                   (list(INDEXES),))
+    for (name,) in cursor.fetchall():
+        cursor.execute(sql.SQL("CREATE INDEX {} ON {}").format(sql.Identifier(name), sql.SQL(INDEXES[name])))
+    cursor.execute(FOREIGN_KEY_EXISTS_QUERY, (FOREIGN_KEY,))
+    if not cursor.fetchone()[0]:
+        cursor.execute(DELETE_QUERY)
+        print(f"Deleted {cursor.rowcount} listing feature rows of deleted listings, adding their foreign key")
+        cursor.execute(sql.SQL(ADD_FOREIGN_KEY_QUERY).format(sql.Identifier(FOREIGN_KEY)))
+    return missing
+
+
+def refresh_listing_features(cursor, dates=None, brands=None):
+    """
+    Upserts the features of the listings of dates ('YYYY-MM-DD' strings) and
+    brands, and of every listing detailed on dates, in the caller's transaction.
+    Both None, and the first refresh after the table is created, rebuild every
+    row. Returns the number of rows written.
+    """
+    if _ensure_table(cursor):
+        print("Created chrono.listing_features, filling it for the full history")
+        dates = brands = None
+    conditions = [sql.SQL("TRUE")]
+    if dates is not None:
+        conditions.append(sql.SQL("date_gathered = ANY(%(dates)s::date[])"))
+    if brands is not None:
+        conditions.append(sql.SQL("brand = ANY(%(brands)s)"))
+    scope = sql.SQL(' AND ').join(conditions)
+    if dates is not None:
+        # New details change every row of their listing, whatever its day
+        scope = sql.SQL("({}) OR listing_id IN (SELECT listing_id FROM chrono.watch_details "
+                        "WHERE date_gathered = ANY(%(dates)s::date[]))").format(scope)
+
+    updated = [column for column in FEATURE_TABLE_COLUMNS if column != 'id']
+    cursor.execute(sql.SQL(UPSERT_QUERY).format(
+        scope=scope,
+        columns=sql.SQL(', ').join(map(sql.Identifier, FEATURE_TABLE_COLUMNS)),
+        listing_columns=sql.SQL(', ').join(map(_listing_column, LISTING_COLUMNS)),
+        parsed=sql.SQL(', ').join(_parsed_number(column, field) for column, field in PARSED_DETAILS.values()),
+        updated=sql.SQL(', ').join(map(sql.Identifier, updated)),
+        current=sql.SQL(', ').join(sql.SQL("features.{}").format(sql.Identifier(column)) for column in updated),
+        excluded=sql.SQL(', ').join(sql.SQL("EXCLUDED.{}").format(sql.Identifier(column)) for column in updated),
+    ), {'dates': list(dates or []), 'brands': list(brands or [])})
+    return cursor.rowcount
+
+
+if __name__ == "__main__":
+    from src.db_pool import get_pool
+
+    start_time = time.time()
+    with get_pool().connection() as conn:
+        with conn.cursor() as cursor:
+            rows = refresh_listing_features(cursor)
+        conn.commit()
+    print(f"Rebuilt {rows} listing feature rows in {time.time() - start_time:.2f} seconds")
@@ -0,0 +1,70 @@
+"""
+In-memory index of listing_ids already stored in chrono.watch_prices.
+
+Known ids are loaded once into a sorted int64 array (8 bytes per listing) and
+probed with a binary search. Ids added during a run go to a small set that is
+folded into the array once it grows past a threshold.
+"""
+import sys
+import time
+
+import numpy as np
+
+KNOWN_LISTINGS_QUERY = "SELECT DISTINCT listing_id FROM chrono.watch_prices WHERE listing_id IS NOT NULL"
+
+
+class ListingIndex:
+    def __init__(self, listing_ids=(), compact_threshold=50000):
+        self._sorted = np.unique(np.asarray(listing_ids, dtype=np.int64))
+        self._added = set()
+        self.compact_threshold = compact_threshold
+        self.load_seconds = 0.0
+
+    @classmethod
+    def from_database(cls, conn, fetch_size=100000):
+        """
+        Builds the index from the listing_ids in chrono.watch_prices using a server-side cursor.
+        """
+        start_time = time.perf_counter()
+        with conn.cursor(name='listing_index_load') as cursor:
+            cursor.itersize = fetch_size
+            cursor.execute(KNOWN_LISTINGS_QUERY)
+            listing_ids = np.fromiter((int(row[0]) for row in cursor), dtype=np.int64)
+        conn.commit()
+
+        index = cls(listing_ids)
+        index.load_seconds = time.perf_counter() - start_time
+        return index
+
+    def __contains__(self, listing_id):
+        listing_id = int(listing_id)
+        if listing_id in self._added:
+            return True
+        position = np.searchsorted(self._sorted, listing_id)
+        return position < len(self._sorted) and self._sorted[position] == listing_id
+
+    def __len__(self):
+        return len(self._sorted) + len(self._added)
+
+    def add(self, listing_id):
+        self._added.add(int(listing_id))
+        if len(self._added) >= self.compact_threshold:
+            self.compact()
+
+    def compact(self):
+        """
+        Folds the ids added since the last compaction into the sorted array.
+        """
+        if self._added:
+            added = np.fromiter(self._added, dtype=np.int64, count=len(self._added))
+            self._sorted = np.union1d(self._sorted, added)
+            self._added.clear()
+
+    @property
+    def memory_bytes(self):
+        # The set holds one int object per added id on top of its own table
+        return self._sorted.nbytes + sys.getsizeof(self._added) + len(self._added) * sys.getsizeof(2 ** 40)
+
+    def summary(self):
+        return (f"{len(self)} known listings, {self.memory_bytes / 1024 ** 2:.2f} MB, "
+                f"loaded in {self.load_seconds:.2f} seconds")
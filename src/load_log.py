@@ -0,0 +1,111 @@
+"""
+Log of ETL loads into chrono.watch_prices, the version the dashboard caches are keyed on.
+
+Every load appends a row with the dates it wrote once its rows are committed.
+load_id only grows, so the app compares the load_id its data was read at with
+the latest one, a primary-key lookup, and the derived tables refresh only what
+changed since. A NULL
+dates array means any date may have changed, e.g. after a full rebuild.
+
+Each load also records two high-water marks: the largest watch_prices.id and the
+largest change_id of chrono.watch_price_changes, which a trigger fills with every
+price update (the same-day repricing done by chrono_db_update). Rows above the
+previous load's marks and up to this load's are exactly what the load added or
+repriced, so readers never see half of a run that is still writing.
+"""
+
+CREATE_QUERIES = [
+    """
+    CREATE TABLE IF NOT EXISTS chrono.etl_loads (
+        load_id bigserial PRIMARY KEY,
+        loaded_at timestamptz NOT NULL DEFAULT now(),
+        dates date[]
+    )
+    """,
+    "ALTER TABLE chrono.etl_loads ADD COLUMN IF NOT EXISTS max_row_id bigint",
+    "ALTER TABLE chrono.etl_loads ADD COLUMN IF NOT EXISTS max_change_id bigint",
+    """
+    CREATE TABLE IF NOT EXISTS chrono.watch_price_changes (
+        change_id bigserial PRIMARY KEY,
+        id integer NOT NULL,
+        price numeric
+    )
+    """,
+    """
+    CREATE OR REPLACE FUNCTION chrono.log_watch_price_change() RETURNS trigger LANGUAGE plpgsql AS $$
+    BEGIN
+        INSERT INTO chrono.watch_price_changes (id, price) VALUES (NEW.id, NEW.price);
+        RETURN NULL;
+    END
+    $$
+    """,
+]
+
+CHANGE_TRIGGER = 'watch_prices_log_price_change'
+
+CREATE_TRIGGER_QUERY = f"""
+    CREATE TRIGGER {CHANGE_TRIGGER} AFTER UPDATE OF price ON chrono.watch_prices
+    FOR EACH ROW WHEN (OLD.price IS DISTINCT FROM NEW.price)
+    EXECUTE FUNCTION chrono.log_watch_price_change()
+"""
+
+RECORD_QUERY = """
+    INSERT INTO chrono.etl_loads (dates, max_row_id, max_change_id)
+    SELECT %s::date[], (SELECT max(id) FROM chrono.watch_prices),
+           (SELECT max(change_id) FROM chrono.watch_price_changes)
+    RETURNING load_id
+"""
+
+LATEST_LOAD_QUERY = "SELECT max(load_id) FROM chrono.etl_loads"
+
+# SELECT * so that loads recorded before the marks were added read them as missing
+WATERMARKS_QUERY = "SELECT * FROM chrono.etl_loads WHERE load_id = %(load_id)s"
+
+# WHERE clause of the chrono.watch_prices rows added, or repriced, between two loads' marks
+CHANGED_ROWS_SCOPE = """
+    (id > %(low)s AND id <= %(high)s) OR id IN (
+        SELECT id FROM chrono.watch_price_changes WHERE change_id > %(low_change)s AND change_id <= %(high_change)s)
+"""
+
+
+def _ensure_tables(cursor):
+    """
+    Creates the load log, the price change log and its trigger. Returns True when
+    the trigger did not exist yet, i.e. earlier price updates were not logged.
+    """
+    for query in CREATE_QUERIES:
+        cursor.execute(query)
+    cursor.execute("SELECT NOT EXISTS (SELECT 1 FROM pg_trigger WHERE tgname = %s)", (CHANGE_TRIGGER,))
+    missing = cursor.fetchone()[0]
+    if missing:
+        cursor.execute(CREATE_TRIGGER_QUERY)
+    return missing
+
+
+def watermarks(cursor, load_id):
+    """
+    The chrono.etl_loads row of load_id as a dict, None when there is none.
+    """
+    cursor.execute(WATERMARKS_QUERY, {'load_id': load_id})
+    row = cursor.fetchone()
+    return dict(zip([column.name for column in cursor.description], row)) if row else None
+
+
+def changed_rows_params(previous, load):
+    """
+    Parameters of CHANGED_ROWS_SCOPE between the watermarks of two loads.
+    """
+    return {'low': previous['max_row_id'] or 0, 'high': load['max_row_id'] or 0,
+            'low_change': previous['max_change_id'] or 0, 'high_change': load['max_change_id'] or 0}
+
+
+def record_load(cursor, dates=None):
+    """
+    Appends a load of dates ('YYYY-MM-DD' strings, None for every date) with the
+    current high-water marks in the caller's transaction and returns its load_id.
+    """
+    if _ensure_tables(cursor):
+        # Readers cannot tell what was repriced before the change log existed
+        dates = None
+    cursor.execute(RECORD_QUERY, (sorted(dates) if dates is not None else None,))
+    return cursor.fetchone()[0]
@@ -0,0 +1,483 @@
+"""
+Registry of fitted price models for the ML Price Outlook page.
+
+Models are trained offline, after an ETL load when TRAIN_MODELS=1 or with
+python -m src.model_registry, and stored with joblib under MODEL_DIR, one file
+per model, hyperparameters and ETL load version:
+
+    MODEL_DIR/<model>-<hash of the hyperparameters>/<load_id>.joblib
+
+Each file holds the fitted pipeline with its test error and feature importance,
+so the page loads the latest file instead of fitting on every click. When the
+same model was trained for an earlier load, estimators that support warm_start
+(random forest and both gradient boostings) add estimators fitted on only the rows
+inserted since, through the preprocessing fitted then, in proportion to how much
+the data grew. Other estimators, models whose data has doubled since their last
+full fit, models fitted on other FEATURE_COLUMNS, and models whose rows were
+since repriced (chrono.watch_price_changes, see src/load_log.py) or removed, are
+refit on every row. A warm-started version is evaluated on held-out new rows only,
+its entry says so in test_scope.
+Listings and their details are read from chrono.listing_features, maintained by
+the ETL (src/listing_features.py).
+
+Full fits on more than LARGE_DATA_ROWS training listings use the large-data mode:
+the model is fitted on a sample stratified by brand, starting at
+SAMPLE_START_ROWS listings and doubled while the fit time, extrapolated from the
+previous sizes, stays within TRAINING_BUDGET_SECONDS. Exact SVR is replaced by
+ridge regression on a Nystroem approximation of its RBF kernel. The entry keeps
+the test error and fit time of every size tried, the page shows that trade-off.
+"""
+import hashlib
+import json
+import math
+import os
+import time
+import uuid
+
+import joblib
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+from sklearn.base import BaseEstimator, RegressorMixin
+from sklearn.ensemble import GradientBoostingRegressor, HistGradientBoostingRegressor, RandomForestRegressor
+from sklearn.kernel_approximation import Nystroem
+from sklearn.metrics import mean_squared_error
+from sklearn.model_selection import train_test_split
+from sklearn.pipeline import Pipeline
+from sklearn.svm import SVR
+
+from src.features import DEFAULT_ENCODING, FEATURE_COLUMNS, build_preprocessor
+from src.load_log import LATEST_LOAD_QUERY, WATERMARKS_QUERY
+from src.paths import MODEL_DIR
+
+
+class BinnedHistGradientBoosting(HistGradientBoostingRegressor):
+    """
+    HistGradientBoostingRegressor whose warm starts keep the bins of its first fit.
+    scikit-learn bins the training rows anew on every fit, so iterations added on
+    only the new rows would sum the predictions of the earlier trees over bins they
+    were not split on. Relies on the private binning steps of scikit-learn 1.5, a
+    release without them makes keeps_bins False and the registry refits in full.
+    """
+
+    @property
+    def keeps_bins(self):
+        """
+        Whether a warm start reuses the bins of the fitted model.
+        """
+        return (callable(getattr(HistGradientBoostingRegressor, '_bin_data', None))
+                and callable(getattr(self, '_is_fitted', None)) and hasattr(self, '_bin_mapper'))
+
+    def fit(self, X, y, sample_weight=None):
+        keep = self.warm_start and self.keeps_bins and self._is_fitted()
+        self._fitted_bin_mapper = self._bin_mapper if keep else None
+        try:
+            return super().fit(X, y, sample_weight)
+        finally:
+            del self._fitted_bin_mapper
+
+    def _bin_data(self, X, is_training_data):
+        if is_training_data and self._fitted_bin_mapper is not None:
+            self._bin_mapper = self._fitted_bin_mapper
+            return self._bin_mapper.transform(X)
+        return super()._bin_data(X, is_training_data)
+
+
+# Model name shown on the page -> (estimator, default hyperparameters). encoding is
+# the src/features.py encoding of merchant_name and model, the rest go to the estimator.
+MODELS = {
+    'Random Forest': (RandomForestRegressor, {'n_estimators': 100, 'random_state': 42, 'n_jobs': -1,
+                                              'encoding': DEFAULT_ENCODING}),
+    'Gradient Boosting': (GradientBoostingRegressor, {'n_estimators': 100, 'random_state': 42,
+                                                      'encoding': DEFAULT_ENCODING}),
+    'Support Vector Regressor': (SVR, {'kernel': 'rbf', 'C': 1.0, 'epsilon': 0.2, 'encoding': DEFAULT_ENCODING}),
+    # Takes dense input only, so the encodings with one column per feature
+    'Histogram Gradient Boosting': (BinnedHistGradientBoosting, {'max_iter': 200, 'random_state': 42,
+                                                                 'encoding': 'target'}),
+}
+# Warm-startable models -> their hyperparameter counting estimators
+WARM_START_MODELS = {'Random Forest': 'n_estimators', 'Gradient Boosting': 'n_estimators',
+                     'Histogram Gradient Boosting': 'max_iter'}
+
+# Hyperparameters that do not change the fitted model, left out of its key
+EXECUTION_PARAMS = {'n_jobs'}
+
+# Full fits of forests and gradient boosting add their estimators in this many steps to report progress
+FIT_STEPS = 10
+
+# Models trained after ETL loads, SVR is trained on request
+TRAINED_MODELS = [name.strip() for name in
+                  os.getenv('TRAINED_MODELS', 'Random Forest,Gradient Boosting,Histogram Gradient Boosting').split(',')
+                  if name.strip()]
+
+# Full fits on more training listings than this use the large-data mode
+LARGE_DATA_ROWS = int(os.getenv('LARGE_DATA_ROWS', '50000'))
+# Seconds a large-data fit may take, sample sizes are doubled until the next would exceed it
+TRAINING_BUDGET_SECONDS = float(os.getenv('TRAINING_BUDGET_SECONDS', '120'))
+SAMPLE_START_ROWS = 5000
+# Held-out listings each sample size is evaluated on, the kept model is evaluated on all
+EVALUATION_ROWS = 20000
+# Listings kept of every brand, all of those with fewer
+MIN_BRAND_ROWS = 20
+
+# Fitted versions kept per model and hyperparameters, older files are deleted
+KEEP_VERSIONS = 3
+
+# Rows with a price, as on the page; prices that could not be parsed are stored as NULL.
+# chrono.listing_features holds the watch_prices rows with their typed details, ids are shared
+TRAINING_QUERY = f"""
+    SELECT id, price, brand, {', '.join(FEATURE_COLUMNS)}
+    FROM chrono.listing_features
+    WHERE id > %(low)s AND id <= %(high)s AND price IS NOT NULL
+"""
+
+# Whether the rows a version was fitted on are still those of the table: as many, none repriced since
+UNCHANGED_ROWS_QUERY = """
+    SELECT (SELECT count(*) FROM chrono.listing_features WHERE id <= %(low)s AND price IS NOT NULL) = %(rows)s
+       AND NOT EXISTS (SELECT 1 FROM chrono.watch_price_changes
+                       WHERE change_id > %(low_change)s AND change_id <= %(high_change)s AND id <= %(low)s)
+"""
+
+
+class NystroemRidge(BaseEstimator, RegressorMixin):
+    """
+    Ridge regression on a Nystroem approximation of the RBF kernel, the large-data
+    stand-in for exact SVR. Fits in time linear in the rows, accumulating the
+    normal equations chunk by chunk so the n_components-wide features of all rows
+    are never held at once. gamma='scale' picks the kernel width as SVR does.
+    """
+    chunk_rows = 20000
+
+    def __init__(self, n_components=500, gamma='scale', alpha=1.0, random_state=None):
+        self.n_components = n_components
+        self.gamma = gamma
+        self.alpha = alpha
+        self.random_state = random_state
+
+    def _features(self, X):
+        for start in range(0, X.shape[0], self.chunk_rows):
+            yield start, self.nystroem_.transform(X[start:start + self.chunk_rows])
+
+    def fit(self, X, y):
+        y = np.asarray(y, dtype='float64')
+        gamma = self.gamma
+        if gamma == 'scale':
+            variance = X.multiply(X).mean() - X.mean() ** 2 if sp.issparse(X) else np.asarray(X).var()
+            gamma = 1.0 / (X.shape[1] * variance) if variance > 0 else 1.0
+        self.nystroem_ = Nystroem(kernel='rbf', gamma=gamma, n_components=min(self.n_components, X.shape[0]),
+                                  random_state=self.random_state).fit(X)
+        width = self.nystroem_.components_.shape[0] + 1
+        gram, moments = np.zeros((width, width)), np.zeros(width)
+        for start, features in self._features(X):
+            # Last column for the intercept, which is not penalized
+            features = np.hstack([features, np.ones((len(features), 1))])
+            gram += features.T @ features
+            moments += features.T @ y[start:start + len(features)]
+        gram[np.arange(width - 1), np.arange(width - 1)] += self.alpha
+        solution = np.linalg.lstsq(gram, moments, rcond=None)[0]
+        self.coef_, self.intercept_ = solution[:-1], solution[-1]
+        return self
+
+    def predict(self, X):
+        return np.concatenate([features @ self.coef_ + self.intercept_ for _, features in self._features(X)]
+                              or [np.empty(0)])
+
+
+def _fitted_estimators(regressor):
+    # Early stopping can leave a gradient boosting with fewer iterations than max_iter
+    return regressor.n_iter_ if hasattr(regressor, 'n_iter_') else len(regressor.estimators_)
+
+
+def build_pipeline(model_name, params=None, large_data=False):
+    """
+    Preprocessing and estimator of model_name, with params overriding its defaults.
+    large_data=True replaces exact SVR with NystroemRidge.
+    """
+    estimator, defaults = MODELS[model_name]
+    params = {**defaults, **(params or {})}
+    encoding = params.pop('encoding')
+    if estimator is SVR and large_data:
+        regressor = NystroemRidge(gamma=params.get('gamma', 'scale'), alpha=1.0 / params['C'], random_state=42)
+    else:
+        regressor = estimator(**params)
+    return Pipeline(steps=[
+        # Scaling only for SVR
+        ('preprocessor', build_preprocessor(encoding, scale=estimator is SVR)),
+        ('regressor', regressor)
+    ])
+
+
+def stratified_sample(brands, rows, seed=42):
+    """
+    Positions of about rows of the listings, drawn at random within each brand in
+    proportion to its listings but at least MIN_BRAND_ROWS of it, so that rare
+    brands stay in the sample. Samples of growing rows contain the smaller ones.
+    """
+    brands = pd.Series(brands).fillna('').reset_index(drop=True)
+    counts = brands.value_counts()
+    quotas = np.minimum(counts, np.maximum(MIN_BRAND_ROWS, np.round(counts * rows / len(brands))))
+    ranks = pd.Series(np.random.default_rng(seed).random(len(brands))).groupby(brands).rank(method='first')
+    return np.flatnonzero(ranks.to_numpy() <= brands.map(quotas).to_numpy())
+
+
+def model_key(model_name, params=None):
+    """
+    Directory name of a model and its hyperparameters, e.g. random-forest-3f2a9c01d4.
+    """
+    params = {name: value for name, value in {**MODELS[model_name][1], **(params or {})}.items()
+              if name not in EXECUTION_PARAMS}
+    digest = hashlib.sha1(json.dumps(params, sort_keys=True).encode()).hexdigest()[:10]
+    return f"{model_name.lower().replace(' ', '-')}-{digest}"
+
+
+def _feature_importance(pipeline):
+    regressor = pipeline.named_steps['regressor']
+    if not hasattr(regressor, 'feature_importances_'):
+        return None
+    return pd.DataFrame({
+        'feature': pipeline.named_steps['preprocessor'].get_feature_names_out(),
+        'importance': regressor.feature_importances_
+    }).sort_values(by='importance', ascending=False)
+
+
+def _no_progress(fraction, message):
+    pass
+
+
+def _fit_regressor(pipeline, X, y, model_name, progress):
+    """
+    pipeline.fit(X, y), adding the estimators of forests and gradient boosting in FIT_STEPS
+    steps so that progress(fraction, message) can follow the fit.
+    """
+    # Early stopping would stop a histogram gradient boosting fitted in steps at another iteration
+    if WARM_START_MODELS.get(model_name) != 'n_estimators':
+        progress(0.2, f"Fitting {model_name} on {len(X):,} listings")
+        pipeline.fit(X, y)
+        return
+    features = pipeline.named_steps['preprocessor'].fit_transform(X, y)
+    regressor = pipeline.named_steps['regressor']
+    n_estimators = regressor.n_estimators
+    for step in range(1, FIT_STEPS + 1):
+        regressor.set_params(warm_start=True, n_estimators=math.ceil(n_estimators * step / FIT_STEPS))
+        regressor.fit(features, y)
+        progress(0.2 + 0.7 * step / FIT_STEPS, f"Fitted {regressor.n_estimators} of {n_estimators} estimators")
+    regressor.set_params(warm_start=False)
+
+
+class ModelRegistry:
+    def __init__(self, root=MODEL_DIR):
+        self.root = root
+
+    def _versions(self, key):
+        directory = os.path.join(self.root, key)
+        if not os.path.isdir(directory):
+            return []
+        return sorted(int(name.split('.')[0]) for name in os.listdir(directory)
+                      if name.endswith('.joblib') and name.split('.')[0].isdigit())
+
+    def path(self, key, version):
+        return os.path.join(self.root, key, f'{version}.joblib')
+
+    def latest_path(self, model_name, params=None):
+        """
+        Path of the most recent fitted version of the model, None when it was never trained.
+        """
+        key = model_key(model_name, params)
+        versions = self._versions(key)
+        return self.path(key, versions[-1]) if versions else None
+
+    def load(self, path):
+        return joblib.load(path)
+
+    def save(self, entry):
+        key = model_key(entry['model'], entry['params'])
+        path = self.path(key, entry['version'])
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Written aside and renamed, so the page never loads a partly written file
+        temporary_path = os.path.join(os.path.dirname(path), f'.{uuid.uuid4().hex[:8]}.tmp')
+        joblib.dump(entry, temporary_path)
+        os.replace(temporary_path, path)
+        for version in self._versions(key)[:-KEEP_VERSIONS]:
+            os.remove(self.path(key, version))
+        return path
+
+    def train(self, engine, model_name, params=None, version=None, progress=_no_progress):
+        """
+        Fits the model on chrono.watch_prices as of the ETL load version (the latest
+        when None) and saves it. Warm-starts from the previous version when possible,
+        returns the saved entry, or the existing one when this version is already
+        trained. progress(fraction, message) is called as training advances.
+        """
+        progress(0.0, "Reading the load version")
+        with engine.connect() as conn:
+            if version is None:
+                version = conn.exec_driver_sql(LATEST_LOAD_QUERY).scalar() or 0
+            load = conn.exec_driver_sql(WATERMARKS_QUERY, {'load_id': version}).mappings().one_or_none() or {}
+            max_row_id = load.get('max_row_id') or conn.exec_driver_sql("SELECT max(id) FROM chrono.watch_prices").scalar() or 0
+            # NULL while no price was ever changed, None without a load log (and its change log)
+            max_change_id = (load.get('max_change_id') or 0) if load else None
+
+        key = model_key(model_name, params)
+        versions = self._versions(key)
+        if version in versions:
+            progress(1.0, f"{model_name} is already trained for load {version}")
+            return self.load(self.path(key, version))
+        previous = self.load(self.path(key, versions[-1])) if versions and versions[-1] < version else None
+
+        start_time = time.time()
+        if (previous and model_name in WARM_START_MODELS and previous['max_row_id'] < max_row_id
+                and previous['rows'] < 2 * previous['full_fit_rows']
+                and list(previous['pipeline'].feature_names_in_) == FEATURE_COLUMNS
+                and type(previous['pipeline'].named_steps['regressor']) is MODELS[model_name][0]
+                and getattr(previous['pipeline'].named_steps['regressor'], 'keeps_bins', True)
+                and self._unchanged_since(engine, previous, max_change_id)):
+            entry = self._warm_start(engine, previous, max_row_id, progress)
+        else:
+            entry = self._fit(engine, model_name, params, max_row_id, progress)
+        entry.update(version=version, max_row_id=max_row_id, max_change_id=max_change_id,
+                     fit_seconds=time.time() - start_time, trained_at=pd.Timestamp.now(tz='UTC'))
+        if entry['pipeline'] is not None:
+            progress(0.95, "Saving the model")
+            self.save(entry)
+        progress(1.0, f"Trained {model_name} for load {version} ({entry['mode']})")
+        return entry
+
+    def _unchanged_since(self, engine, previous, max_change_id):
+        """
+        True when the rows previous was fitted on are all still in the table with
+        the same prices, so that fitting only the rows added since catches up.
+        """
+        if previous.get('max_change_id') is None or max_change_id is None:
+            return False
+        with engine.connect() as conn:
+            return conn.exec_driver_sql(UNCHANGED_ROWS_QUERY, {
+                'low': previous['max_row_id'], 'rows': previous['rows'],
+                'low_change': previous['max_change_id'], 'high_change': max_change_id}).scalar()
+
+    def _fit(self, engine, model_name, params, max_row_id, progress):
+        progress(0.05, "Reading listings")
+        data = pd.read_sql(TRAINING_QUERY, engine, params={'low': 0, 'high': max_row_id})
+        entry = {'model': model_name, 'params': params, 'mode': 'full fit', 'pipeline': None, 'mse': None,
+                 'rows': len(data), 'full_fit_rows': len(data), 'test_rows': 0, 'test_scope': 'held-out listings',
+                 'feature_importance': None, 'tradeoff': None}
+        if len(data) < 2:
+            return entry
+        X_train, X_test, y_train, y_test, brands, _ = train_test_split(
+            data[FEATURE_COLUMNS], data['price'], data['brand'], test_size=0.2, random_state=42)
+        if len(X_train) > LARGE_DATA_ROWS:
+            pipeline, tradeoff = self._fit_within_budget(model_name, params, X_train, y_train, brands,
+                                                         X_test, y_test, progress)
+            sampled = f"{tradeoff['rows'].iloc[-1]:,} of {len(X_train):,} training listings sampled by brand"
+            if MODELS[model_name][0] is SVR:
+                sampled += ", Nystroem kernel approximation in place of exact SVR"
+            entry.update(mode=f"large data, {sampled}, {TRAINING_BUDGET_SECONDS:.0f} s budget", tradeoff=tradeoff)
+        else:
+            pipeline = build_pipeline(model_name, params)
+            _fit_regressor(pipeline, X_train, y_train, model_name, progress)
+        progress(0.9, "Evaluating on held-out listings")
+        entry.update(pipeline=pipeline, mse=mean_squared_error(y_test, pipeline.predict(X_test)),
+                     test_rows=len(X_test), feature_importance=_feature_importance(pipeline))
+        return entry
+
+    def _fit_within_budget(self, model_name, params, X_train, y_train, brands, X_test, y_test, progress):
+        """
+        Fits the large-data pipeline on stratified samples of doubling size while
+        the next fit, extrapolated from the last two, fits in the remaining
+        TRAINING_BUDGET_SECONDS. Returns the pipeline fitted on the largest sample
+        and the rows, fit seconds and test error (on EVALUATION_ROWS held-out
+        listings) of each size.
+        """
+        start_time = time.perf_counter()
+        X_evaluated = X_test.sample(n=min(EVALUATION_ROWS, len(X_test)), random_state=42)
+        y_evaluated = y_test.loc[X_evaluated.index]
+        rows, tradeoff = min(SAMPLE_START_ROWS, len(X_train)), []
+        while True:
+            sample = stratified_sample(brands, rows)
+            progress(0.1 + 0.8 * min(1.0, (time.perf_counter() - start_time) / TRAINING_BUDGET_SECONDS),
+                     f"Fitting on {len(sample):,} of {len(X_train):,} listings")
+            step_time = time.perf_counter()
+            pipeline = build_pipeline(model_name, params, large_data=True)
+            pipeline.fit(X_train.iloc[sample], y_train.iloc[sample])
+            fit_seconds = time.perf_counter() - step_time
+            tradeoff.append({'rows': len(sample), 'fit_seconds': fit_seconds,
+                             'mse': mean_squared_error(y_evaluated, pipeline.predict(X_evaluated))})
+            if len(sample) >= len(X_train):
+                break
+            next_rows = min(2 * rows, len(X_train))
+            # Fit time grows at least linearly with the rows, faster when the last sizes showed it
+            exponent = 1.0
+            if len(tradeoff) > 1 and tradeoff[-2]['fit_seconds'] > 0 and tradeoff[-2]['rows'] < len(sample):
+                exponent = min(3.0, max(1.0, math.log(fit_seconds / tradeoff[-2]['fit_seconds'])
+                                        / math.log(len(sample) / tradeoff[-2]['rows'])))
+            step_seconds = time.perf_counter() - step_time
+            remaining = TRAINING_BUDGET_SECONDS - (time.perf_counter() - start_time)
+            if step_seconds * (next_rows / len(sample)) ** exponent > remaining:
+                break
+            rows = next_rows
+        return pipeline, pd.DataFrame(tradeoff)
+
+    def _warm_start(self, engine, previous, max_row_id, progress):
+        progress(0.05, "Reading listings added since the previous version")
+        data = pd.read_sql(TRAINING_QUERY, engine, params={'low': previous['max_row_id'], 'high': max_row_id})
+        entry = {**previous, 'mode': 'warm start', 'tradeoff': None,
+                 'test_scope': f"held-out listings added since load {previous['version']}"}
+        if len(data) < 2:
+            return entry
+        X_train, X_test, y_train, y_test = train_test_split(
+            data[FEATURE_COLUMNS], data['price'], test_size=0.2, random_state=42)
+        pipeline = previous['pipeline']
+        regressor = pipeline.named_steps['regressor']
+        # New estimators in proportion to the rows added, fitted on the new rows only
+        parameter = WARM_START_MODELS[previous['model']]
+        n_estimators = {**MODELS[previous['model']][1], **(previous['params'] or {})}[parameter]
+        added = max(1, math.ceil(n_estimators * len(data) / previous['rows']))
+        progress(0.2, f"Adding {added} estimators fitted on {len(X_train):,} new listings")
+        regressor.set_params(warm_start=True, **{parameter: _fitted_estimators(regressor) + added})
+        regressor.fit(pipeline.named_steps['preprocessor'].transform(X_train), y_train)
+        regressor.set_params(warm_start=False)
+        # The older rows were all fitted on, only the new ones are held out
+        progress(0.9, "Evaluating on held-out new listings")
+        entry.update(pipeline=pipeline, mse=mean_squared_error(y_test, pipeline.predict(X_test)),
+                     rows=previous['rows'] + len(data), test_rows=len(X_test),
+                     feature_importance=_feature_importance(pipeline))
+        return entry
+
+
+def train_models(model_names=None, engine=None, version=None, root=MODEL_DIR):
+    """
+    Trains the models (TRAINED_MODELS by default) with their default hyperparameters
+    for the load version.
+    """
+    from src.db_pool import create_pooled_engine
+
+    engine = engine or create_pooled_engine()
+    registry = ModelRegistry(root)
+    for model_name in model_names or TRAINED_MODELS:
+        entry = registry.train(engine, model_name, version=version)
+        if entry['pipeline'] is None:
+            print(f"Not enough priced listings to train {model_name}")
+        else:
+            print(f"Trained {model_name} for load {entry['version']} ({entry['mode']}, {entry['rows']} rows) "
+                  f"in {entry['fit_seconds']:.2f} seconds, MSE {entry['mse']:.0f} on {entry['test_rows']:,} "
+                  f"{entry.get('test_scope', 'held-out listings')}")
+
+
+def train_after_load():
+    """
+    Called at the end of ETL runs, trains the models when TRAIN_MODELS=1.
+    """
+    if os.getenv('TRAIN_MODELS', '0') != '1':
+        return
+    try:
+        train_models()
+    except Exception as e:
+        print(f"Error training price models: {e}")
+
+
+if __name__ == "__main__":
+    import sys
+    # Through the importable module, so that saved pipelines holding NystroemRidge load in the app
+    from src.model_registry import train_models as train
+
+    # e.g. python -m src.model_registry "Support Vector Regressor"
+    train(sys.argv[1:])
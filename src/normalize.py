@@ -0,0 +1,173 @@
+"""
+Batch normalization of raw chrono24 listing dicts.
+
+normalize_listings() turns a chunk of search or search_detail results into an
+Arrow table holding the columns of chrono.watch_prices and chrono.watch_details.
+Prices, shipping prices, merchant ratings and reviews, production years and case
+diameters are parsed with Arrow compute kernels over the dictionary of distinct
+values in each column, instead of a float() per listing inside try/except. A
+value that is present but cannot be parsed becomes NULL and its field is named
+in the parse_errors column rather than being written as 0.0.
+"""
+import pyarrow as pa
+import pyarrow.compute as pc
+
+# chrono24 reports missing values as the string 'null'
+MISSING_VALUES = pa.array(['', 'null', 'Unknown', 'None'])
+
+# Text columns copied from the listing: column -> (source key, default when the key is absent)
+TEXT_FIELDS = {
+    'brand': ('manufacturer', 'Unknown'),
+    'model': ('title', 'Unknown'),
+    'certification_status': ('certification_status', 'Unknown'),
+    'description': ('description', 'No description available'),
+    'url': ('url', ''),
+    'merchant_name': ('merchant_name', 'Unknown'),
+    'location': ('location', 'Unknown'),
+    'badge': ('badge', 'Unknown'),
+    'production_year': ('year_of_production', 'Unknown'),
+    'delivery_scope': ('scope_of_delivery', 'Unknown'),
+    'availability': ('availability', 'Unknown'),
+    'case_diameter': ('case_diameter', 'Unknown'),
+    'bracelet_color': ('bracelet_color', 'Unknown'),
+    'anticipated_delivery': ('anticipated_delivery', 'Unknown'),
+}
+
+# Parsed columns: column -> (source key, pattern with a group named n, thousands separator, type)
+# Without a thousands separator a comma is a decimal comma, e.g. '4,8' or '40,5 mm'
+NUMERIC_FIELDS = {
+    'price': ('price', r'(?P<n>-?\d[\d,]*(?:\.\d+)?)', ',', pa.float64()),
+    'shipping_price': ('shipping_price', r'(?P<n>-?\d[\d,]*(?:\.\d+)?)', ',', pa.float64()),
+    'merchant_rating': ('merchant_rating', r'(?P<n>\d+(?:[.,]\d+)?)', None, pa.float64()),
+    'merchant_reviews': ('merchant_reviews', r'(?P<n>\d[\d,]*)', ',', pa.int64()),
+    'production_year_value': ('year_of_production', r'\b(?P<n>1[89]\d{2}|20\d{2})\b', None, pa.int32()),
+    'case_diameter_mm': ('case_diameter', r'(?P<n>\d+(?:[.,]\d+)?)\s*(?:x\s*\d+(?:[.,]\d+)?\s*)?mm', None, pa.float64()),
+}
+
+# Missing values have always been stored as 0, unparseable ones become NULL
+MISSING_DEFAULTS = {'price': 0.0, 'shipping_price': 0.0, 'merchant_rating': 0.0, 'merchant_reviews': 0}
+
+# Only these keys are converted from the listing dicts
+_SOURCE_SCHEMA = pa.schema(
+    [('id', pa.string()), ('image_urls', pa.list_(pa.string()))]
+    + [(key, pa.string()) for key in dict.fromkeys(
+        [key for key, _ in TEXT_FIELDS.values()] + [field[0] for field in NUMERIC_FIELDS.values()])]
+)
+
+
+def _source_table(watch_data):
+    # listing ids come back from chrono24 as ints or strings
+    records = [{**watch, 'id': str(watch.get('id', '0'))} for watch in watch_data]
+    return pa.Table.from_pylist(records, schema=_SOURCE_SCHEMA)
+
+
+def _parse_numbers(values, pattern, thousands, value_type, default=None):
+    """
+    Returns the parsed numbers and a mask of values that were present but unparseable.
+    Missing values become default. Only the distinct strings of the column are parsed.
+    """
+    encoded = pc.dictionary_encode(values.combine_chunks())
+    text = pc.utf8_trim_whitespace(encoded.dictionary)
+    missing = pc.is_in(text, value_set=MISSING_VALUES)
+
+    number = pc.struct_field(pc.extract_regex(text, pattern), [0])
+    number = pc.replace_substring(number, thousands or ',', '' if thousands else '.')
+    number = pc.cast(pc.cast(number, pa.float64()), value_type, safe=False)
+    failed = pc.and_(pc.is_null(number), pc.invert(missing))
+    if default is not None:
+        number = pc.if_else(missing, pa.scalar(default, value_type), number)
+
+    # Rows without the key at all are missing too
+    indices = encoded.indices
+    numbers = pc.take(number, indices)
+    if default is not None:
+        numbers = pc.if_else(pc.is_null(indices), pa.scalar(default, value_type), numbers)
+    return numbers, pc.fill_null(pc.take(failed, indices), False)
+
+
+def normalize_listings(watch_data, category=None, current_date=None):
+    """
+    Builds one normalized row per listing with the columns of chrono.watch_prices
+    and chrono.watch_details, the parsed production_year_value and case_diameter_mm,
+    and parse_errors (comma-separated field names, empty when every field parsed).
+    """
+    source = _source_table(watch_data)
+    length = source.num_rows
+    columns = {
+        'listing_id': source['id'],
+        'category': pa.repeat(pa.scalar(category, pa.string()), length),
+    }
+    for column, (key, default) in TEXT_FIELDS.items():
+        columns[column] = pc.fill_null(source[key], default)
+    columns['currency'] = pa.repeat(pa.scalar('USD'), length)
+    columns['condition'] = pa.repeat(pa.scalar('Unknown'), length)
+    # Just the first image, list_element rejects empty lists so those are nulled first
+    image_urls = source['image_urls']
+    has_image = pc.fill_null(pc.greater(pc.list_value_length(image_urls), 0), False)
+    image_urls = pc.if_else(has_image, image_urls, pa.nulls(length, image_urls.type))
+    columns['image_url'] = pc.fill_null(pc.list_element(image_urls, 0), '')
+
+    error_flags = []
+    for column, (key, pattern, thousands, value_type) in NUMERIC_FIELDS.items():
+        columns[column], failed = _parse_numbers(source[key], pattern, thousands, value_type,
+                                                 MISSING_DEFAULTS.get(column))
+        error_flags.append(pc.if_else(failed, f'{column},', ''))
+    columns['date_gathered'] = pa.repeat(pa.scalar(current_date, pa.string()), length)
+    columns['parse_errors'] = pc.utf8_rtrim(pc.binary_join_element_wise(*error_flags, ''), characters=',')
+    return pa.table(columns)
+
+
+def parse_column(values, column):
+    """
+    Parses stored text values the way normalize_listings() parses column, e.g.
+    case_diameter_mm from chrono.watch_details.case_diameter. Missing and
+    unparseable values become NULL.
+    """
+    _, pattern, thousands, value_type = NUMERIC_FIELDS[column]
+    values = pa.chunked_array([pa.array(values, pa.string(), from_pandas=True)])
+    return _parse_numbers(values, pattern, thousands, value_type)[0]
+
+
+def _python_values(column):
+    # Much faster than to_pylist(), which builds an Arrow scalar per value
+    values = column.to_numpy(zero_copy_only=False)
+    if not column.null_count or values.dtype == object:
+        return values.tolist()
+    # Numeric NULLs come back as NaN, and integers with NULLs as floats
+    nulls = pc.is_null(column).to_numpy(zero_copy_only=False)
+    convert = int if pa.types.is_integer(column.type) else float
+    return [None if null else convert(value) for value, null in zip(values.tolist(), nulls.tolist())]
+
+
+def to_rows(listings, columns):
+    """
+    Returns the columns of a normalized table as a list of tuples, NULLs as None.
+    """
+    return list(zip(*(_python_values(listings[column]) for column in columns)))
+
+
+def with_price(listings):
+    """
+    Keeps the listings with a positive price.
+    """
+    return listings.filter(pc.fill_null(pc.greater(listings['price'], 0), False))
+
+
+def parse_error_summary(listings):
+    """
+    Counts parse failures per field, e.g. {'price': 3}.
+    """
+    errors = pc.split_pattern(listings['parse_errors'], ',')
+    counts = pc.value_counts(pc.list_flatten(errors))
+    return {item['values'].as_py(): item['counts'].as_py() for item in counts if item['values'].as_py()}
+
+
+def normalize_chunk(watch_data, category=None, current_date=None):
+    """
+    normalize_listings() for a chunk about to be written, reporting the fields that failed to parse.
+    """
+    listings = normalize_listings(watch_data, category, current_date)
+    parse_errors = parse_error_summary(listings)
+    if parse_errors:
+        print(f"Unparseable values in {category or 'chunk'} by field: {parse_errors}")
+    return listings
@@ -0,0 +1,21 @@
+import os
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Local state kept between runs; point DATA_DIR at persistent storage when deployed
+DATA_DIR = os.getenv('DATA_DIR', os.path.join(ROOT_DIR, 'data'))
+
+CHANGE_CACHE_PATH = os.path.join(DATA_DIR, 'change_cache.sqlite')
+
+# Date-partitioned Parquet snapshot of chrono.watch_prices read by the dashboard;
+# the ETL and the app both need to reach it
+SNAPSHOT_DIR = os.getenv('SNAPSHOT_DIR', os.path.join(DATA_DIR, 'snapshots', 'watch_prices'))
+
+# Fitted price models trained after ETL loads and read by the ML page (see src/model_registry.py)
+MODEL_DIR = os.getenv('MODEL_DIR', os.path.join(DATA_DIR, 'models'))
+
+# Nearest-neighbour index of the listing catalog, updated after ETL loads (see src/comparables.py)
+COMPARABLES_DIR = os.getenv('COMPARABLES_DIR', os.path.join(DATA_DIR, 'comparables'))
+
+# Queue of training requests from the ML page, run by src/training_jobs.py
+TRAINING_JOBS_PATH = os.path.join(DATA_DIR, 'training_jobs.sqlite')
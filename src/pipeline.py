@@ -0,0 +1,85 @@
+"""
+Bounded producer/consumer pipeline from a chrono24 listing generator to a DB writer.
+
+A background thread pulls listings from the generator and hands them over in
+fixed-size chunks through a bounded queue. The writer consumes chunks as they
+arrive, so rows land in the database while scraping is still in progress, and
+the producer blocks once max_pending_chunks are waiting. At most
+(max_pending_chunks + 2) * chunk_size listings are held in memory regardless of
+how many results the search returns.
+"""
+import queue
+import threading
+
+CHUNK_SIZE = 500
+MAX_PENDING_CHUNKS = 4
+
+_END = object()
+
+
+class _ProducerError:
+    def __init__(self, error):
+        self.error = error
+
+
+def _produce(listings, chunk_size, chunks, stop):
+    def put(item):
+        # Give up when the consumer has stopped instead of blocking forever on a full queue
+        while not stop.is_set():
+            try:
+                chunks.put(item, timeout=0.5)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    try:
+        chunk = []
+        for listing in listings:
+            chunk.append(listing)
+            if len(chunk) >= chunk_size:
+                if not put(chunk):
+                    return
+                chunk = []
+        if chunk and not put(chunk):
+            return
+    except Exception as e:
+        put(_ProducerError(e))
+        return
+    put(_END)
+
+
+def iter_chunks(listings, chunk_size=CHUNK_SIZE, max_pending_chunks=MAX_PENDING_CHUNKS):
+    """
+    Yields lists of up to chunk_size listings, scraped ahead on a background thread.
+    An exception raised by the listing generator is re-raised here after the
+    chunks produced before it.
+    """
+    chunks = queue.Queue(maxsize=max_pending_chunks)
+    stop = threading.Event()
+    producer = threading.Thread(target=_produce, args=(listings, chunk_size, chunks, stop), daemon=True)
+    producer.start()
+
+    try:
+        while True:
+            chunk = chunks.get()
+            if chunk is _END:
+                producer.join()
+                return
+            if isinstance(chunk, _ProducerError):
+                raise chunk.error
+            yield chunk
+    finally:
+        # Lets a producer stuck on a full queue exit if the writer failed
+        stop.set()
+
+
+def run_pipeline(listings, write_chunk, chunk_size=CHUNK_SIZE, max_pending_chunks=MAX_PENDING_CHUNKS):
+    """
+    Streams listings into write_chunk(chunk) and returns the number of listings written.
+    """
+    written = 0
+    for chunk in iter_chunks(listings, chunk_size, max_pending_chunks):
+        write_chunk(chunk)
+        written += len(chunk)
+    return written
@@ -0,0 +1,86 @@
+"""
+Mergeable quantile sketches of listing prices.
+
+A sketch counts prices in logarithmic buckets: bucket i holds the prices in
+(GAMMA**(i-1), GAMMA**i], with GAMMA = (1 + RELATIVE_ACCURACY) / (1 - RELATIVE_ACCURACY).
+Counts are exact, so the bucket holding the price at any rank is known, and
+every price in a bucket is within RELATIVE_ACCURACY of the bucket's
+representative value 2 * GAMMA**i / (GAMMA + 1). A quantile read from a sketch is
+therefore within RELATIVE_ACCURACY (1%) of the exact quantile, interpolated
+between ranks as pandas' Series.quantile() does, however many sketches were
+merged. Merging adds up the counts of equal buckets.
+
+The ETL keeps one sketch per day and brand, per day and reference family, and
+per day and model, in chrono.daily_brand_price_sketches,
+chrono.daily_family_price_sketches and chrono.daily_model_price_sketches (see
+src/daily_stats.py), one row per non-empty bucket. A model whose prices span a
+factor of 6 fills about 90 buckets a day. The percentiles of any date range are
+read by summing a few hundred rows, not sorting every listing.
+"""
+import math
+
+import numpy as np
+
+# Changing it requires rebuilding the sketch tables: python -m src.daily_stats
+RELATIVE_ACCURACY = 0.01
+GAMMA = (1 + RELATIVE_ACCURACY) / (1 - RELATIVE_ACCURACY)
+LOG_GAMMA = math.log(GAMMA)
+
+
+def bucket_of(prices):
+    """
+    Bucket of each positive price, the same as the ETL computes in SQL.
+    """
+    return np.ceil(np.log(np.asarray(prices, dtype='float64')) / LOG_GAMMA).astype('int64')
+
+
+def _combine(buckets, counts):
+    buckets, positions = np.unique(np.asarray(buckets, dtype='int64'), return_inverse=True)
+    counts = np.bincount(positions, weights=np.asarray(counts, dtype='float64'), minlength=len(buckets))
+    return buckets, counts.astype('int64')
+
+
+class PriceSketch:
+    def __init__(self, buckets=(), counts=()):
+        """
+        buckets and counts are matching sequences, a bucket may repeat.
+        """
+        self.buckets, self.counts = _combine(buckets, counts)
+
+    @classmethod
+    def from_prices(cls, prices):
+        """
+        Sketch of the positive prices, others are left out as in the aggregates.
+        """
+        prices = np.asarray(prices, dtype='float64')
+        prices = prices[prices > 0]
+        return cls(bucket_of(prices), np.ones(len(prices), dtype='int64'))
+
+    @property
+    def count(self):
+        return int(self.counts.sum())
+
+    def merge(self, other):
+        return PriceSketch(np.concatenate([self.buckets, other.buckets]), np.concatenate([self.counts, other.counts]))
+
+    def _value_at(self, ranks):
+        # The price at a 0-based rank lies in the first bucket whose cumulative count exceeds it
+        positions = np.searchsorted(np.cumsum(self.counts), ranks, side='right')
+        return 2 * GAMMA ** self.buckets[positions].astype('float64') / (GAMMA + 1)
+
+    def quantile(self, q):
+        """
+        Approximate quantile(s) q in [0, 1], within RELATIVE_ACCURACY of the exact
+        value. NaN for an empty sketch.
+        """
+        q = np.asarray(q, dtype='float64')
+        if not self.count:
+            return np.full(q.shape, np.nan)[()]
+        ranks = q * (self.count - 1)
+        lower, upper = np.floor(ranks), np.ceil(ranks)
+        low, high = self._value_at(lower), self._value_at(upper)
+        return (low + (ranks - lower) * (high - low))[()]
+
+    def __repr__(self):
+        return f"PriceSketch(count={self.count}, buckets={len(self.buckets)})"
+
@@ -0,0 +1,159 @@
+"""
+Mergeable price statistics for the dashboard's outlier analysis.
+
+PriceMoments holds the count, mean and M2 (the sum of squared deviations from
+the mean) of a set of prices. Two sets merge exactly with Chan et al.'s parallel
+formula, so the moments of a model over any date range are merged from the
+per-day rows of chrono.daily_model_prices (see src/daily_stats.py) in time that
+grows with the number of days, not with the number of listings.
+
+group_price_stats() and price_outliers() score the listings of every brand and
+model at once: the rows are factorized into group codes and sorted once by code
+and price, means and deviations are bincount reductions over the codes, and
+medians, quartiles and MADs are read at computed positions of the sorted
+segments. Neither modifies the frame it is given.
+"""
+import math
+
+import numpy as np
+import pandas as pd
+
+GROUP_KEYS = ('brand', 'model')
+
+# Scales the MAD to the standard deviation of normally distributed prices
+MAD_SCALE = 0.6745
+
+
+class PriceMoments:
+    def __init__(self, count=0, mean=0.0, m2=0.0):
+        self.count = int(count)
+        self.mean = float(mean)
+        self.m2 = float(m2)
+
+    @classmethod
+    def from_prices(cls, prices):
+        prices = np.asarray(prices, dtype='float64')
+        if not len(prices):
+            return cls()
+        mean = prices.mean()
+        return cls(len(prices), mean, ((prices - mean) ** 2).sum())
+
+    @classmethod
+    def from_daily(cls, stats):
+        """
+        Merges the rows of a daily aggregate frame (listings, mean_price, m2_price columns).
+        """
+        stats = stats[stats['listings'] > 0]
+        counts = stats['listings'].to_numpy(dtype='float64')
+        if not counts.sum():
+            return cls()
+        means = stats['mean_price'].to_numpy(dtype='float64')
+        mean = (counts * means).sum() / counts.sum()
+        # Equivalent to merging the days pairwise, in one pass
+        m2 = stats['m2_price'].to_numpy(dtype='float64').sum() + (counts * (means - mean) ** 2).sum()
+        return cls(counts.sum(), mean, m2)
+
+    def merge(self, other):
+        """
+        Returns the moments of both sets of prices together.
+        """
+        count = self.count + other.count
+        if not count:
+            return PriceMoments()
+        delta = other.mean - self.mean
+        mean = self.mean + delta * other.count / count
+        m2 = self.m2 + other.m2 + delta ** 2 * self.count * other.count / count
+        return PriceMoments(count, mean, m2)
+
+    @property
+    def std(self):
+        """
+        Sample standard deviation, as pandas' Series.std(), NaN for fewer than two prices.
+        """
+        return math.sqrt(self.m2 / (self.count - 1)) if self.count > 1 else math.nan
+
+    def z_score(self, price):
+        return (price - self.mean) / self.std
+
+    def __repr__(self):
+        return f"PriceMoments(count={self.count}, mean={self.mean:.2f}, std={self.std:.2f})"
+
+
+def _segment_quantile(sorted_values, starts, counts, q):
+    """
+    The q quantile of each segment of sorted_values, interpolated between ranks
+    as pandas' Series.quantile() does.
+    """
+    position = starts + q * (counts - 1)
+    low = np.floor(position).astype('int64')
+    high = np.ceil(position).astype('int64')
+    return sorted_values[low] + (sorted_values[high] - sorted_values[low]) * (position - low)
+
+
+def _sorted_segments(codes, values, groups):
+    # Sorting by value, then stably by code, is faster than np.lexsort
+    order = np.argsort(values)
+    order = order[np.argsort(codes[order], kind='stable')]
+    counts = np.bincount(codes, minlength=groups)
+    starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+    return values[order], starts, counts
+
+
+def group_price_stats(df, keys=GROUP_KEYS):
+    """
+    Count, mean, standard deviation, median, MAD and quartiles of the price of
+    each group of keys in df, rows with a missing key or price left out. Returns
+    the group code of every row (-1 when left out) and a frame of the groups in
+    code order.
+    """
+    codes = df.groupby(list(keys), sort=False, observed=True).ngroup().fillna(-1).to_numpy(dtype='int64')
+    # Groups are numbered in order of appearance, their first rows give the keys
+    first_rows = np.flatnonzero(codes > np.maximum.accumulate(np.concatenate([[-1], codes]))[:-1])
+    groups = pd.MultiIndex.from_frame(df[list(keys)].iloc[first_rows])
+    prices = df['price'].to_numpy(dtype='float64')
+    codes = np.where(np.isnan(prices), -1, codes)
+    kept = codes >= 0
+    kept_codes, kept_prices = codes[kept], prices[kept]
+
+    counts = np.bincount(kept_codes, minlength=len(groups))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        means = np.bincount(kept_codes, weights=kept_prices, minlength=len(groups)) / counts
+        m2 = np.bincount(kept_codes, weights=(kept_prices - means[kept_codes]) ** 2, minlength=len(groups))
+        stds = np.where(counts > 1, np.sqrt(m2 / (counts - 1)), np.nan)
+
+    stats = pd.DataFrame({'listings': counts, 'mean_price': means, 'std_price': stds}, index=groups)
+    present = counts > 0
+    sorted_prices, starts, _ = _sorted_segments(kept_codes, kept_prices, len(groups))
+    for column, q in [('p25_price', 0.25), ('median_price', 0.5), ('p75_price', 0.75)]:
+        stats[column] = np.nan
+        stats.loc[present, column] = _segment_quantile(sorted_prices, starts[present], counts[present], q)
+    deviations = np.abs(kept_prices - stats['median_price'].to_numpy()[kept_codes])
+    sorted_deviations, _, _ = _sorted_segments(kept_codes, deviations, len(groups))
+    stats['mad_price'] = np.nan
+    stats.loc[present, 'mad_price'] = _segment_quantile(sorted_deviations, starts[present], counts[present], 0.5)
+    return codes, stats
+
+
+def price_outliers(df, keys=GROUP_KEYS, z_threshold=-2.0, mad_threshold=-3.5, iqr_factor=1.5):
+    """
+    The rows of df priced below their group's market by any of three measures,
+    as a new frame of their keys and price with the original index:
+
+        z_score    standard deviations from the group's mean, at most z_threshold
+        mad_score  MAD_SCALE * (price - median) / MAD, at most mad_threshold
+        below_iqr  price under the first quartile minus iqr_factor interquartile ranges
+    """
+    codes, stats = group_price_stats(df, keys)
+    kept = codes >= 0
+    rows = codes[kept]
+    prices = df['price'].to_numpy(dtype='float64')[kept]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        z_scores = (prices - stats['mean_price'].to_numpy()[rows]) / stats['std_price'].to_numpy()[rows]
+        mads = stats['mad_price'].to_numpy()[rows]
+        mad_scores = np.where(mads > 0, MAD_SCALE * (prices - stats['median_price'].to_numpy()[rows]) / mads, np.nan)
+    p25, p75 = stats['p25_price'].to_numpy()[rows], stats['p75_price'].to_numpy()[rows]
+    below_iqr = prices < p25 - iqr_factor * (p75 - p25)
+    flagged = (z_scores <= z_threshold) | (mad_scores <= mad_threshold) | below_iqr
+    positions = np.flatnonzero(kept)[flagged]
+    return df.iloc[positions][[*keys, 'price']].assign(
+        z_score=z_scores[flagged], mad_score=mad_scores[flagged], below_iqr=below_iqr[flagged])
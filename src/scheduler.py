@@ -0,0 +1,109 @@
+"""
+Concurrent scheduling of scrape-and-load jobs across categories.
+
+All jobs share one requests-per-second budget, enforced by a token bucket that
+is charged before every chrono24 page or listing request, instead of sleeping a
+fixed time between categories. A bounded number of fetch workers run jobs at
+once and a separate limit caps how many chunks are written to the database
+concurrently, so loading overlaps with fetching without exhausting connections.
+"""
+import concurrent.futures
+import threading
+import time
+
+import chrono24
+
+# Requests chrono24.query() makes before the first page: the search redirect and the result count
+SETUP_REQUESTS = 2
+
+
+class TokenBucket:
+    def __init__(self, rate, capacity=None):
+        """
+        rate is the number of tokens added per second, capacity the largest burst allowed.
+        """
+        if rate <= 0:
+            raise ValueError("rate must be positive")
+        self.rate = rate
+        self.capacity = capacity or max(rate, SETUP_REQUESTS + 2)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+        self.waited_seconds = 0.0
+
+    def acquire(self, tokens=1):
+        """
+        Blocks until tokens are available and takes them.
+        """
+        tokens = min(tokens, self.capacity)
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= tokens:
+                    self._tokens -= tokens
+                    return
+                wait = (tokens - self._tokens) / self.rate
+                self.waited_seconds += wait
+            time.sleep(wait)
+
+
+def throttled(listings, bucket, requests_per_listing=0, page_size=chrono24.query.page_size):
+    """
+    Wraps a chrono24 listing generator so every request it makes is paid for from
+    bucket: the query setup, one request per results page and requests_per_listing
+    for every listing (1 for search_detail, which fetches each listing page).
+    """
+    iterator = iter(listings)
+    position = 0
+    while True:
+        cost = requests_per_listing
+        if position == 0:
+            cost += SETUP_REQUESTS
+        if position % page_size == 0:
+            cost += 1
+        bucket.acquire(cost)
+        try:
+            listing = next(iterator)
+        except StopIteration:
+            return
+        yield listing
+        position += 1
+
+
+class CategoryScheduler:
+    def __init__(self, fetch_workers=4, load_workers=2, requests_per_second=2.0, burst=None):
+        self.fetch_workers = fetch_workers
+        self.bucket = TokenBucket(requests_per_second, burst)
+        # Held while a chunk is written, caps concurrent database loads
+        self.load_slots = threading.BoundedSemaphore(load_workers)
+
+    def throttle(self, listings, requests_per_listing=0):
+        return throttled(listings, self.bucket, requests_per_listing)
+
+    def run(self, jobs):
+        """
+        Runs (name, callable) jobs on the fetch workers and returns {name: result}.
+        A failing job is reported and does not stop the others.
+        """
+        results = {}
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.fetch_workers) as executor:
+            futures = {executor.submit(self._timed, name, job): name for name, job in jobs}
+            for future in concurrent.futures.as_completed(futures):
+                name = futures[future]
+                try:
+                    results[name] = future.result()
+                except Exception as e:
+                    print(f"Error running {name}: {e}")
+                    results[name] = None
+
+        print(f"Waited {self.bucket.waited_seconds:.2f} seconds in total for the request budget")
+        return results
+
+    @staticmethod
+    def _timed(name, job):
+        start_time = time.time()
+        result = job()
+        print(f"Finished {name} in {time.time() - start_time:.2f} seconds")
+        return result
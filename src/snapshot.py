@@ -0,0 +1,285 @@
+"""
+Date-partitioned Parquet snapshot of chrono.watch_prices for the dashboard.
+
+The ETL writes the analytic columns of every chunk it loads next to the database
+rows, one file per brand and run under SNAPSHOT_DIR/date_gathered=YYYY-MM-DD/.
+description and image_url are left out, url is only read for selected listings,
+and low-cardinality strings such as brand and model are stored dictionary-encoded.
+The app reads only the columns and rows it asks for, memory-mapped, into
+categoricals instead of pulling the whole table through pd.read_sql.
+
+reference_family is matched from the title as a file is written, with the index
+the ETL fills the database column with (src/title_index.py). Files written
+before it was added, or before the vocabulary changed, keep no or older families
+until the snapshot is rebuilt: python -m src.snapshot into an empty SNAPSHOT_DIR.
+"""
+import glob
+import os
+import re
+import time
+import uuid
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+from src.paths import SNAPSHOT_DIR
+from src.title_index import default_index
+
+_DICTIONARY = pa.dictionary(pa.int32(), pa.string())
+
+# Columns of chrono.watch_prices kept in the snapshot, date_gathered is the partition key
+SNAPSHOT_SCHEMA = pa.schema([
+    ('listing_id', pa.string()),
+    ('category', _DICTIONARY),
+    ('brand', _DICTIONARY),
+    ('model', _DICTIONARY),
+    ('reference_family', _DICTIONARY),
+    ('price', pa.float64()),
+    ('shipping_price', pa.float64()),
+    ('certification_status', _DICTIONARY),
+    ('currency', _DICTIONARY),
+    ('condition', _DICTIONARY),
+    ('merchant_name', _DICTIONARY),
+    ('location', _DICTIONARY),
+    ('badge', _DICTIONARY),
+    ('url', pa.string()),
+])
+SNAPSHOT_COLUMNS = SNAPSHOT_SCHEMA.names + ['date_gathered']
+# Everything but the per-listing url, for reads of many rows
+ANALYTIC_COLUMNS = [column for column in SNAPSHOT_COLUMNS if column != 'url']
+
+PARTITIONING = ds.partitioning(pa.schema([('date_gathered', pa.date32())]), flavor='hive')
+# Files written before a column was added read it as NULL
+_DATASET_SCHEMA = SNAPSHOT_SCHEMA.append(pa.field('date_gathered', pa.date32()))
+
+BACKFILL_QUERY = "SELECT {columns} FROM chrono.watch_prices ORDER BY date_gathered"
+# Set from the title vocabulary as the snapshot is written, like the ETL sets it in the database
+DERIVED_COLUMNS = ['reference_family']
+
+
+def _partition_dir(root, current_date):
+    return os.path.join(root, f'date_gathered={current_date}')
+
+
+def _file_stem(category):
+    return re.sub(r'[^a-z0-9]+', '_', str(category or 'all').lower()).strip('_')
+
+
+def _snapshot_table(listings):
+    columns = []
+    for field in SNAPSHOT_SCHEMA:
+        if field.name == 'reference_family' and field.name not in listings.column_names:
+            column = pa.array(default_index().families_of(listings['brand'].to_pylist(), listings['model'].to_pylist()),
+                              pa.string())
+        else:
+            column = listings[field.name]
+        if pa.types.is_dictionary(field.type):
+            column = pc.cast(column, pa.string())
+        columns.append(pc.cast(column, field.type))
+    return pa.Table.from_arrays(columns, schema=SNAPSHOT_SCHEMA)
+
+
+class SnapshotWriter:
+    """
+    Writes the chunks of one brand's run into a single Parquet file, one row group
+    per chunk. The file is written under a hidden name and moved into place on close,
+    so readers never see a partial file.
+    With replace=True the file is named after the brand and is merged with that
+    brand's file from an earlier run on the same day the way the same-day upserts
+    of full scrapes merge the database rows: new listings are added, listings seen
+    again keep their first row with the latest price, and listings only the earlier
+    run returned are kept. With replace=False every run adds a file, matching plain
+    inserts.
+    Chunks are written after they are committed, so a run that fails keeps the rows
+    it committed. When writing the snapshot itself fails, the file is discarded and
+    the previous snapshot is left as it was.
+    """
+
+    def __init__(self, category, current_date, root=SNAPSHOT_DIR, replace=True):
+        directory = _partition_dir(root, current_date)
+        os.makedirs(directory, exist_ok=True)
+        stem = _file_stem(category)
+        if not replace:
+            stem = f"{stem}-{time.strftime('%H%M%S')}-{uuid.uuid4().hex[:8]}"
+        self.path = os.path.join(directory, f'{stem}.parquet')
+        self.replace = replace
+        self._temporary_path = os.path.join(directory, f'.{stem}.{uuid.uuid4().hex[:8]}.tmp')
+        self._writer = None
+        self._failed = False
+        self.rows = 0
+
+    def write(self, listings):
+        """
+        Appends a normalized Arrow table (see src.normalize) to the snapshot.
+        """
+        if not listings.num_rows:
+            return
+        try:
+            if self._writer is None:
+                self._writer = pq.ParquetWriter(self._temporary_path, SNAPSHOT_SCHEMA, compression='zstd')
+            self._writer.write_table(_snapshot_table(listings))
+        except Exception:
+            self._failed = True
+            raise
+        self.rows += listings.num_rows
+
+    def close(self):
+        if self._writer is None:
+            return
+        try:
+            self._writer.close()
+            self._writer = None
+            if self._failed:
+                raise OSError(f"Writing {self._temporary_path} failed")
+            if self.replace and os.path.exists(self.path):
+                merged = merge_upserted(pq.read_table(self.path, schema=SNAPSHOT_SCHEMA),
+                                        pq.read_table(self._temporary_path, schema=SNAPSHOT_SCHEMA))
+                pq.write_table(merged, self._temporary_path, compression='zstd')
+            os.replace(self._temporary_path, self.path)
+        except Exception:
+            self.discard()
+            raise
+
+    def discard(self):
+        """
+        Drops the rows written so far, the previous snapshot file is left as it was.
+        """
+        if self._writer is not None:
+            try:
+                self._writer.close()
+            except Exception:
+                pass
+            self._writer = None
+        if os.path.exists(self._temporary_path):
+            os.remove(self._temporary_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        # Rows of a failed run were committed up to the failure, they are kept unless the snapshot itself failed
+        if self._failed:
+            self.discard()
+        else:
+            self.close()
+
+
+def merge_upserted(earlier, later):
+    """
+    Rows of a day's snapshot after later rows were upserted into earlier ones on
+    listing_id as chrono.watch_prices is: the first row of every listing, with the
+    price of its last row. Rows without a listing_id are all kept. Rows of files
+    written before reference_family was added get their family, as the ETL fills
+    the NULL families of the database.
+    """
+    combined = pa.concat_tables([earlier, later.cast(earlier.schema)])
+    listing_ids = combined['listing_id'].to_pandas()
+    prices = combined['price'].to_pandas()
+    last = ~listing_ids.duplicated(keep='last') & listing_ids.notna()
+    latest_prices = pd.Series(prices[last].to_numpy(), index=listing_ids[last])
+    first = ~listing_ids.duplicated(keep='first') | listing_ids.isna()
+    merged = combined.filter(pa.array(first.to_numpy()))
+    prices = listing_ids[first].map(latest_prices).fillna(prices[first])
+    merged = merged.set_column(merged.schema.get_field_index('price'), 'price',
+                               pa.array(prices.to_numpy(), pa.float64(), from_pandas=True))
+    families = pc.cast(merged['reference_family'], pa.string())
+    if families.null_count:
+        matched = pa.array(default_index().families_of(pc.cast(merged['brand'], pa.string()).to_pylist(),
+                                                       pc.cast(merged['model'], pa.string()).to_pylist()), pa.string())
+        families = pc.coalesce(families, matched)
+        merged = merged.set_column(merged.schema.get_field_index('reference_family'), 'reference_family',
+                                   pc.cast(families, merged.schema.field('reference_family').type))
+    return merged
+
+
+class _NoSnapshot:
+    rows = 0
+
+    def write(self, listings):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+def snapshot_enabled():
+    return os.getenv('PARQUET_SNAPSHOT', '1') == '1'
+
+
+def snapshot_writer(category, current_date, replace=True):
+    """
+    Returns a SnapshotWriter, or a no-op writer when PARQUET_SNAPSHOT=0.
+    """
+    if not snapshot_enabled():
+        return _NoSnapshot()
+    return SnapshotWriter(category, current_date, replace=replace)
+
+
+def snapshot_dates(root=SNAPSHOT_DIR):
+    return {os.path.basename(os.path.dirname(path)).split('=', 1)[1]
+            for path in glob.glob(os.path.join(root, 'date_gathered=*', '*.parquet'))}
+
+
+def snapshot_available(root=SNAPSHOT_DIR):
+    return bool(snapshot_dates(root))
+
+
+def read_snapshot(columns=None, filters=None, root=SNAPSHOT_DIR):
+    """
+    Reads the snapshot into a DataFrame, memory-mapped and limited to columns.
+    filters are pyarrow filter tuples, e.g. [('brand', '=', 'Rolex')], and skip whole
+    date partitions and row groups. Dictionary columns come back as pandas categoricals.
+    """
+    table = pq.read_table(root, columns=columns, filters=filters or None, memory_map=True,
+                          partitioning=PARTITIONING, schema=_DATASET_SCHEMA)
+    return table.to_pandas()
+
+
+def backfill(conn, root=SNAPSHOT_DIR, batch_size=100000):
+    """
+    Exports the history of chrono.watch_prices into the snapshot, one backfill file
+    per date. Dates the snapshot already has are skipped, so it is safe to rerun.
+    Returns the number of rows written.
+    """
+    columns = [column for column in SNAPSHOT_COLUMNS if column not in DERIVED_COLUMNS]
+    query = BACKFILL_QUERY.format(columns=', '.join(columns))
+    existing = snapshot_dates(root)
+    writer, writer_date, rows = None, None, 0
+    with conn.cursor(name='snapshot_backfill') as cursor:
+        cursor.itersize = batch_size
+        cursor.execute(query)
+        while True:
+            batch = cursor.fetchmany(batch_size)
+            if not batch:
+                break
+            table = pa.Table.from_pylist([dict(zip(columns, row)) for row in batch])
+            dates = pc.cast(table['date_gathered'], pa.string())
+            for current_date in pc.unique(dates).to_pylist():
+                if current_date in existing:
+                    continue
+                if current_date != writer_date:
+                    if writer:
+                        writer.close()
+                    writer, writer_date = SnapshotWriter('backfill', current_date, root), current_date
+                selected = table.filter(pc.equal(dates, current_date))
+                writer.write(selected)
+                rows += selected.num_rows
+    if writer:
+        writer.close()
+    conn.commit()
+    return rows
+
+
+if __name__ == "__main__":
+    from src.db_pool import get_pool
+
+    start_time = time.time()
+    with get_pool().connection() as conn:
+        written = backfill(conn)
+    print(f"Wrote {written} rows to {SNAPSHOT_DIR} in {time.time() - start_time:.2f} seconds")
@@ -0,0 +1,270 @@
+"""
+Reference families of listing titles.
+
+chrono24 titles are free text ('Rolex Submariner Date 126610LN', 'ROLEX
+submariner date, 126610 LN 2021'), so nearly every title is a model of its own.
+notebooks/watch_type_titles.json names the reference families of each brand as
+chrono24 lists them, e.g. 'Rolex Submariner Date' or 'Patek Philippe Nautilus'.
+TitleIndex builds one word-level Aho-Corasick automaton per brand from those
+names, without the brand and normalized like titles are: lowercased, accents and
+punctuation dropped, letters and digits split ('Day-Date' is 'day date', 'RM011'
+is 'rm 011'). A title is scanned once, in time linear in its words however many
+families its brand has, and maps to the longest family name it contains, the
+leftmost of equally long ones. Titles without a match map to the brand's
+catch-all family (the bare brand name), titles of other brands to NULL.
+
+The ETL stores the family of every listing in chrono.watch_prices.reference_family,
+indexed with brand and model. Each refresh of the daily aggregates fills it for the
+day and brands just loaded, matching every distinct brand and title once;
+python -m src.title_index fills the full history. The column's comment records a
+digest of the vocabulary it was matched with. When the vocabulary changes, the
+next refresh matches every title again and rebuilds the aggregates.
+python -m benchmarks.bench_title_index measures titles per second.
+"""
+import functools
+import hashlib
+import json
+import os
+import re
+import time
+import unicodedata
+from collections import deque
+
+from psycopg2 import sql
+
+VOCABULARY_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                               'notebooks', 'watch_type_titles.json')
+
+FAMILY_INDEX = 'watch_prices_brand_reference_family_idx'
+
+ADD_COLUMN_QUERY = "ALTER TABLE chrono.watch_prices ADD COLUMN reference_family varchar"
+CREATE_INDEX_QUERY = "CREATE INDEX {} ON chrono.watch_prices (brand, reference_family, model)"
+
+COLUMN_EXISTS_QUERY = """
+    SELECT EXISTS (SELECT 1 FROM information_schema.columns
+                   WHERE table_schema = 'chrono' AND table_name = 'watch_prices' AND column_name = 'reference_family')
+"""
+
+VOCABULARY_QUERY = "SELECT col_description('chrono.watch_prices'::regclass, attnum) FROM pg_attribute " \
+                   "WHERE attrelid = 'chrono.watch_prices'::regclass AND attname = 'reference_family'"
+RECORD_VOCABULARY_QUERY = "COMMENT ON COLUMN chrono.watch_prices.reference_family IS %s"
+
+UNMATCHED_TITLES_QUERY = """
+    SELECT DISTINCT brand, model FROM chrono.watch_prices
+    WHERE {unmatched} AND brand IS NOT NULL AND model IS NOT NULL AND {scope}
+"""
+
+# Only titles of brands in the vocabulary get a family, the others stay NULL
+FILL_QUERY = """
+    UPDATE chrono.watch_prices AS wp SET reference_family = matched.family
+    FROM unnest(%(pair_brands)s::varchar[], %(pair_models)s::varchar[], %(families)s::varchar[])
+         AS matched (listing_brand, title, family)
+    WHERE wp.brand = matched.listing_brand AND wp.model = matched.title
+      AND wp.reference_family IS DISTINCT FROM matched.family AND {scope}
+"""
+
+_SEPARATORS = re.compile(r'[^0-9a-z]+')
+_LETTERS_AND_DIGITS = re.compile(r'(?<=[a-z])(?=[0-9])|(?<=[0-9])(?=[a-z])')
+
+
+def title_words(text):
+    """
+    Splits a title into normalized words, e.g. 'GMT-Master II 116710LN' -> ['gmt', 'master', 'ii', '116710', 'ln'].
+    """
+    text = unicodedata.normalize('NFKD', text).encode('ascii', 'ignore').decode().lower()
+    return _SEPARATORS.sub(' ', _LETTERS_AND_DIGITS.sub(' ', text)).split()
+
+
+class _Automaton:
+    """
+    Aho-Corasick automaton over words. Node 0 is the root, each node keeps its
+    children, its failure link and the longest pattern ending at it or at any
+    node its failure links lead to, as (number of words, value).
+    """
+    def __init__(self, patterns):
+        self.children = [{}]
+        self.failure = [0]
+        self.output = [None]
+        for words, value in patterns:
+            node = 0
+            for word in words:
+                if word not in self.children[node]:
+                    self.children.append({})
+                    self.failure.append(0)
+                    self.output.append(None)
+                    self.children[node][word] = len(self.children) - 1
+                node = self.children[node][word]
+            # The first of two families with the same words wins
+            if self.output[node] is None:
+                self.output[node] = (len(words), value)
+
+        # Breadth first, so failure links always point at nodes already linked
+        queue = deque(self.children[0].values())
+        while queue:
+            node = queue.popleft()
+            for word, child in self.children[node].items():
+                fallback = self.failure[node]
+                while fallback and word not in self.children[fallback]:
+                    fallback = self.failure[fallback]
+                self.failure[child] = self.children[fallback].get(word, 0)
+                # A pattern ending at child is longer than any ending at its failure node
+                if self.output[child] is None:
+                    self.output[child] = self.output[self.failure[child]]
+                queue.append(child)
+
+    def longest_match(self, words):
+        """
+        Value of the longest pattern in words, the leftmost of equally long ones, or None.
+        """
+        node, best = 0, None
+        for word in words:
+            while node and word not in self.children[node]:
+                node = self.failure[node]
+            node = self.children[node].get(word, 0)
+            found = self.output[node]
+            # Equally long matches ending later start later too
+            if found is not None and (best is None or found[0] > best[0]):
+                best = found
+        return best[1] if best is not None else None
+
+
+class TitleIndex:
+    def __init__(self, vocabulary):
+        """
+        vocabulary maps each brand to the names of its reference families, each
+        starting with the brand as in watch_type_titles.json.
+        """
+        self._automata = {}
+        self._catch_all = {}
+        for brand, families in vocabulary.items():
+            brand_words = title_words(brand)
+            patterns = []
+            for family in families:
+                words = title_words(family)
+                if words[:len(brand_words)] == brand_words:
+                    words = words[len(brand_words):]
+                if words:
+                    patterns.append((words, family))
+                else:
+                    self._catch_all.setdefault(' '.join(brand_words), family)
+            self._automata[' '.join(brand_words)] = _Automaton(patterns)
+        self.families = sum(len(families) for families in vocabulary.values())
+        self.digest = hashlib.sha1(json.dumps(vocabulary, sort_keys=True).encode()).hexdigest()
+
+    @classmethod
+    def from_file(cls, path=VOCABULARY_PATH):
+        with open(path, encoding='utf-8') as vocabulary:
+            return cls(json.load(vocabulary))
+
+    def family(self, brand, title):
+        """
+        Reference family of a listing title, None when its brand has no families.
+        """
+        brand_key = ' '.join(title_words(brand or ''))
+        automaton = self._automata.get(brand_key)
+        if automaton is None:
+            return None
+        found = automaton.longest_match(title_words(title or ''))
+        return found if found is not None else self._catch_all.get(brand_key)
+
+    def families_of(self, brands, titles):
+        """
+        Reference families of parallel sequences of brands and titles, each
+        distinct pair matched once.
+        """
+        matched = {}
+        families = []
+        for pair in zip(brands, titles):
+            family = matched.get(pair, matched)
+            if family is matched:
+                family = matched[pair] = self.family(*pair)
+            families.append(family)
+        return families
+
+
+@functools.lru_cache(maxsize=1)
+def default_index():
+    """
+    TitleIndex of notebooks/watch_type_titles.json, built once per process.
+    """
+    return TitleIndex.from_file()
+
+
+def _ensure_column(cursor):
+    """
+    Adds the reference_family column and its index. Returns True when the column did not exist yet.
+    """
+    cursor.execute(COLUMN_EXISTS_QUERY)
+    missing = not cursor.fetchone()[0]
+    if missing:
+        cursor.execute(ADD_COLUMN_QUERY)
+    # Checked first, CREATE INDEX IF NOT EXISTS would share-lock watch_prices until commit
+    cursor.execute("SELECT to_regclass(%s) IS NULL", (f'chrono.{FAMILY_INDEX}',))
+    if cursor.fetchone()[0]:
+        cursor.execute(sql.SQL(CREATE_INDEX_QUERY).format(sql.Identifier(FAMILY_INDEX)))
+    return missing
+
+
+def _vocabulary_label(index):
+    return f"Reference family matched with title vocabulary {index.digest}"
+
+
+def families_outdated(cursor, index=None):
+    """
+    True when reference_family does not exist yet or was matched with another vocabulary than index's.
+    """
+    cursor.execute(VOCABULARY_QUERY)
+    row = cursor.fetchone()
+    return row is None or row[0] != _vocabulary_label(index or default_index())
+
+
+def fill_reference_families(cursor, dates=None, brands=None, index=None):
+    """
+    Sets reference_family on the listings of dates ('YYYY-MM-DD' strings) and brands
+    that have none yet, every listing when both are None, in the caller's transaction.
+    Returns (distinct titles matched, rows updated). Adds the column on first use
+    and then fills the full history, and matches every title again when the
+    vocabulary changed since the column was filled.
+    """
+    index = index or default_index()
+    outdated = families_outdated(cursor, index)
+    if _ensure_column(cursor):
+        print("Added chrono.watch_prices.reference_family, filling it for the full history")
+        dates = brands = None
+    elif outdated:
+        print("The title vocabulary changed, matching the reference family of the full history again")
+        dates = brands = None
+    conditions = [sql.SQL("TRUE")]
+    if dates is not None:
+        conditions.append(sql.SQL("date_gathered = ANY(%(dates)s::date[])"))
+    if brands is not None:
+        conditions.append(sql.SQL("brand = ANY(%(brands)s)"))
+    scope = sql.SQL(' AND ').join(conditions)
+    params = {'dates': list(dates or []), 'brands': list(brands or [])}
+
+    unmatched = sql.SQL("TRUE" if outdated else "reference_family IS NULL")
+    cursor.execute(sql.SQL(UNMATCHED_TITLES_QUERY).format(unmatched=unmatched, scope=scope), params)
+    pairs = cursor.fetchall()
+    rows = 0
+    if pairs:
+        pair_brands, pair_models = (list(values) for values in zip(*pairs))
+        families = index.families_of(pair_brands, pair_models)
+        cursor.execute(sql.SQL(FILL_QUERY).format(scope=scope),
+                       {**params, 'pair_brands': pair_brands, 'pair_models': pair_models, 'families': families})
+        rows = cursor.rowcount
+    if outdated:
+        # Commenting locks the table, only done when the vocabulary changed
+        cursor.execute(RECORD_VOCABULARY_QUERY, (_vocabulary_label(index),))
+    return len(pairs), rows
+
+
+if __name__ == "__main__":
+    from src.db_pool import get_pool
+
+    start_time = time.time()
+    with get_pool().connection() as conn:
+        with conn.cursor() as cursor:
+            titles, rows = fill_reference_families(cursor)
+        conn.commit()
+    print(f"Matched {titles} titles and set the reference family of {rows} listings "
+          f"in {time.time() - start_time:.2f} seconds")
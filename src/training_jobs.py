@@ -0,0 +1,252 @@
+"""
+Background training of the ML page's price models.
+
+The page queues training requests in a SQLite job table instead of fitting in
+the Streamlit script thread. A TrainingWorker claims queued jobs and runs them in
+a process pool, where ModelRegistry.train() records its progress in the job row.
+The page polls the row and loads the model from the registry once it is done.
+Requesting a model, hyperparameters and load version that are already queued or
+running returns the job in flight instead of queueing another.
+
+The app starts a worker in its own process, python -m src.training_jobs runs a
+standalone one. Workers on the same machine can share the table, each job is
+claimed by one of them.
+"""
+import concurrent.futures
+import functools
+import json
+import multiprocessing
+import os
+import sqlite3
+import threading
+import time
+
+from src.paths import MODEL_DIR, TRAINING_JOBS_PATH
+
+# Jobs trained at the same time, each fits on its share of the cores
+TRAINING_WORKERS = int(os.getenv('TRAINING_WORKERS', '2'))
+POLL_SECONDS = 1.0
+
+CREATE_QUERIES = [
+    """
+    CREATE TABLE IF NOT EXISTS jobs (
+        job_id INTEGER PRIMARY KEY,
+        model TEXT NOT NULL,
+        params TEXT NOT NULL,
+        version INTEGER,
+        status TEXT NOT NULL DEFAULT 'queued',
+        progress REAL NOT NULL DEFAULT 0,
+        message TEXT NOT NULL DEFAULT 'Queued',
+        worker_pid INTEGER,
+        submitted_at REAL NOT NULL,
+        finished_at REAL
+    )
+    """,
+    # At most one queued or running job per model, hyperparameters and version
+    """
+    CREATE UNIQUE INDEX IF NOT EXISTS jobs_in_flight ON jobs (model, params, coalesce(version, -1))
+    WHERE status IN ('queued', 'running')
+    """,
+]
+
+CLAIM_QUERY = """
+    UPDATE jobs SET status = 'running', worker_pid = ?, message = 'Starting'
+    WHERE job_id = (SELECT job_id FROM jobs WHERE status = 'queued' ORDER BY job_id LIMIT 1)
+    RETURNING job_id, model, params, version
+"""
+
+
+def _connect(path=TRAINING_JOBS_PATH):
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    conn = sqlite3.connect(path, timeout=30)
+    conn.row_factory = sqlite3.Row
+    # Readers polling the table do not block the worker's progress updates
+    conn.execute("PRAGMA journal_mode=WAL")
+    with conn:
+        for query in CREATE_QUERIES:
+            conn.execute(query)
+    return conn
+
+
+def submit(model_name, params=None, version=None, path=TRAINING_JOBS_PATH):
+    """
+    Queues training of model_name for the ETL load version and returns the job id,
+    the id of the job in flight when the same request is already queued or running.
+    """
+    params = json.dumps(params or {}, sort_keys=True)
+    conn = _connect(path)
+    try:
+        with conn:
+            cursor = conn.execute(
+                "INSERT INTO jobs (model, params, version, submitted_at) VALUES (?, ?, ?, ?) ON CONFLICT DO NOTHING",
+                (model_name, params, version, time.time()))
+            if cursor.rowcount:
+                return cursor.lastrowid
+            return conn.execute("""
+                SELECT job_id FROM jobs WHERE model = ? AND params = ? AND coalesce(version, -1) = coalesce(?, -1)
+                AND status IN ('queued', 'running')
+            """, (model_name, params, version)).fetchone()['job_id']
+    finally:
+        conn.close()
+
+
+def latest_job(model_name, params=None, path=TRAINING_JOBS_PATH):
+    """
+    The most recently submitted job of model_name as a dict, None when there is none.
+    """
+    conn = _connect(path)
+    try:
+        row = conn.execute("SELECT * FROM jobs WHERE model = ? AND params = ? ORDER BY job_id DESC LIMIT 1",
+                           (model_name, json.dumps(params or {}, sort_keys=True))).fetchone()
+        return dict(row) if row else None
+    finally:
+        conn.close()
+
+
+def _finish(conn, job_id, status, message):
+    with conn:
+        conn.execute("""
+            UPDATE jobs SET status = ?, message = ?, finished_at = ?, progress = CASE WHEN ? = 'done' THEN 1 ELSE progress END
+            WHERE job_id = ? AND status = 'running'
+        """, (status, message, time.time(), status, job_id))
+
+
+def job_cores(max_workers=TRAINING_WORKERS):
+    """
+    Cores each of max_workers concurrent jobs may use.
+    """
+    return max(1, (os.cpu_count() or 1) // max(1, max_workers))
+
+
+def _run_job(job_id, model_name, params, version, path, model_root, cores):
+    """
+    Trains one claimed job on at most cores cores, runs in a pool process.
+    """
+    from threadpoolctl import threadpool_limits
+
+    from src.db_pool import create_pooled_engine
+    from src.model_registry import MODELS, ModelRegistry
+
+    conn = _connect(path)
+    engine = create_pooled_engine(min_size=1, max_size=1)
+    params = json.loads(params) or None
+    # n_jobs=-1 in every concurrent job would oversubscribe the cores, it does not change the model's key
+    if 'n_jobs' in MODELS[model_name][1]:
+        requested = {**MODELS[model_name][1], **(params or {})}['n_jobs']
+        params = {**(params or {}), 'n_jobs': cores if requested < 1 else min(requested, cores)}
+
+    def progress(fraction, message):
+        with conn:
+            conn.execute("UPDATE jobs SET progress = ?, message = ? WHERE job_id = ?", (fraction, message, job_id))
+
+    try:
+        # OpenMP and BLAS threads, e.g. of histogram gradient boosting
+        with threadpool_limits(cores):
+            entry = ModelRegistry(model_root).train(engine, model_name, params, version, progress)
+        if entry['pipeline'] is None:
+            _finish(conn, job_id, 'failed', "Not enough priced listings to train on")
+        else:
+            _finish(conn, job_id, 'done', f"Trained for load {entry['version']} ({entry['mode']}) "
+                                          f"in {entry['fit_seconds']:.1f} seconds")
+    except Exception as e:
+        _finish(conn, job_id, 'failed', f"Error training {model_name}: {e}")
+    finally:
+        engine.dispose()
+        conn.close()
+
+
+def _process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class TrainingWorker:
+    def __init__(self, max_workers=TRAINING_WORKERS, path=TRAINING_JOBS_PATH, model_root=MODEL_DIR):
+        self.max_workers = max_workers
+        self.path = path
+        self.model_root = model_root
+        self._executor = self._new_executor()
+        self._slots = threading.Semaphore(max_workers)
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _new_executor(self):
+        # Spawned rather than forked, the app process runs server threads
+        return concurrent.futures.ProcessPoolExecutor(self.max_workers, mp_context=multiprocessing.get_context('spawn'))
+
+    def start(self):
+        conn = _connect(self.path)
+        try:
+            # Jobs left running by a worker process that has exited never finish
+            for row in conn.execute("SELECT job_id, worker_pid FROM jobs WHERE status = 'running'").fetchall():
+                if row['worker_pid'] is None or not _process_alive(row['worker_pid']):
+                    _finish(conn, row['job_id'], 'failed', "The worker stopped before the job finished")
+        finally:
+            conn.close()
+        self._thread = threading.Thread(target=self._dispatch, name='training-worker', daemon=True)
+        self._thread.start()
+        return self
+
+    def _dispatch(self):
+        conn = _connect(self.path)
+        while not self._stop.is_set():
+            if not self._slots.acquire(timeout=POLL_SECONDS):
+                continue
+            with conn:
+                claimed = conn.execute(CLAIM_QUERY, (os.getpid(),)).fetchall()
+            job = claimed[0] if claimed else None
+            if job is None:
+                self._slots.release()
+                self._stop.wait(POLL_SECONDS)
+                continue
+            try:
+                future = self._submit(job)
+            except Exception as e:
+                _finish(conn, job['job_id'], 'failed', f"The training process pool failed: {e}")
+                self._slots.release()
+                continue
+            future.add_done_callback(functools.partial(self._finished, job['job_id']))
+        conn.close()
+
+    def _submit(self, job):
+        args = (_run_job, job['job_id'], job['model'], job['params'], job['version'],
+                self.path, self.model_root, job_cores(self.max_workers))
+        try:
+            return self._executor.submit(*args)
+        except Exception:
+            # A pool process that died, e.g. out of memory, breaks the pool for every
+            # later job. The claimed job never ran, so it goes to a fresh pool
+            self._executor.shutdown(wait=False)
+            self._executor = self._new_executor()
+            return self._executor.submit(*args)
+
+    def _finished(self, job_id, future):
+        self._slots.release()
+        # _run_job records its own outcome, unless its process died
+        if future.exception() is not None:
+            conn = _connect(self.path)
+            try:
+                _finish(conn, job_id, 'failed', f"The training process failed: {future.exception()}")
+            finally:
+                conn.close()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+        self._executor.shutdown(wait=True)
+
+
+if __name__ == "__main__":
+    worker = TrainingWorker().start()
+    print(f"Training worker running {worker.max_workers} jobs at a time from {worker.path}, Ctrl+C to stop")
+    try:
+        while True:
+            time.sleep(60)
+    except KeyboardInterrupt:
+        worker.stop()
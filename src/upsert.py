@@ -0,0 +1,83 @@
+"""
+Set-based merge of a batch of listings into chrono.watch_prices.
+
+The batch is bulk loaded into a temporary staging table and applied with a single
+INSERT ... ON CONFLICT statement keyed on (listing_id, date_gathered), instead of a
+SELECT followed by an UPDATE or INSERT per listing.
+"""
+from psycopg2 import sql
+
+from src.bulk_loader import BulkLoader, WATCH_PRICES_COLUMNS
+from src.load_log import record_load
+
+STAGE_TABLE = 'watch_prices_stage'
+UNIQUE_INDEX = 'watch_prices_listing_id_date_gathered_key'
+
+# Keeps the newest row of every (listing_id, date_gathered) pair
+DEDUPE_QUERY = """
+    DELETE FROM chrono.watch_prices older
+    USING chrono.watch_prices newer
+    WHERE older.listing_id = newer.listing_id
+      AND older.date_gathered = newer.date_gathered
+      AND older.id < newer.id
+"""
+
+MERGE_QUERY = """
+    WITH merged AS (
+        INSERT INTO chrono.watch_prices AS wp ({columns})
+        SELECT {columns} FROM {stage}
+        ON CONFLICT (listing_id, date_gathered) DO UPDATE
+            SET price = EXCLUDED.price
+            WHERE wp.price IS DISTINCT FROM EXCLUDED.price
+        RETURNING (xmax = 0) AS inserted
+    )
+    SELECT count(*) FILTER (WHERE inserted), count(*) FILTER (WHERE NOT inserted)
+    FROM merged
+"""
+
+
+def ensure_unique_index(conn, dedupe=False):
+    """
+    Creates the unique (listing_id, date_gathered) index the merge relies on.
+    Index creation fails while duplicate pairs exist; pass dedupe=True to delete
+    all but the newest row of each pair first.
+    """
+    with conn.cursor() as cursor:
+        if dedupe:
+            cursor.execute(DEDUPE_QUERY)
+            print(f"Removed {cursor.rowcount} duplicate listing rows")
+            if cursor.rowcount:
+                # Rows were deleted, the dashboard has to read everything again
+                record_load(cursor)
+        cursor.execute(sql.SQL("CREATE UNIQUE INDEX IF NOT EXISTS {} ON chrono.watch_prices (listing_id, date_gathered)")
+                       .format(sql.Identifier(UNIQUE_INDEX)))
+    conn.commit()
+
+
+def merge_watch_prices(conn, rows, loader=None):
+    """
+    Applies rows (ordered like WATCH_PRICES_COLUMNS) to chrono.watch_prices: new
+    listings are inserted and listings whose price changed for the same day are
+    updated. Returns a dict of inserted, updated and unchanged counts.
+    The caller owns the transaction and is expected to commit.
+    """
+    loader = loader or BulkLoader()
+
+    # A listing seen twice in one batch keeps its last price, as the per-row update did
+    listing_idx = WATCH_PRICES_COLUMNS.index('listing_id')
+    date_idx = WATCH_PRICES_COLUMNS.index('date_gathered')
+    batch = list({(row[listing_idx], str(row[date_idx])): row for row in rows}.values())
+    if not batch:
+        return {'inserted': 0, 'updated': 0, 'unchanged': 0}
+
+    columns = sql.SQL(', ').join(map(sql.Identifier, WATCH_PRICES_COLUMNS))
+    stage = sql.Identifier(STAGE_TABLE)
+    with conn.cursor() as cursor:
+        cursor.execute(sql.SQL("DROP TABLE IF EXISTS {}").format(stage))
+        cursor.execute(sql.SQL("CREATE TEMP TABLE {} ON COMMIT DROP AS SELECT {} FROM chrono.watch_prices WITH NO DATA")
+                       .format(stage, columns))
+        loader.load(conn, STAGE_TABLE, WATCH_PRICES_COLUMNS, batch)
+        cursor.execute(sql.SQL(MERGE_QUERY).format(columns=columns, stage=stage))
+        inserted, updated = cursor.fetchone()
+
+    return {'inserted': inserted, 'updated': updated, 'unchanged': len(batch) - inserted - updated}
@@ -0,0 +1,43 @@
+import numpy as np
+import pandas as pd
+
+from src.deal_scores import score_listings
+from src.price_sketch import PriceSketch, bucket_of
+from src.price_stats import PriceMoments
+
+
+def _market(prices):
+    moments = PriceMoments.from_prices(prices)
+    sketch = PriceSketch.from_prices(prices)
+    sketches = pd.DataFrame({'brand': 'Rolex', 'model': 'Datejust', 'bucket': sketch.buckets,
+                             'bucket_listings': sketch.counts})
+    sketches = sketches.assign(sketch_bucket=sketches['bucket'], through=sketches['bucket_listings'].cumsum())
+    return pd.DataFrame({'brand': ['Rolex'], 'model': ['Datejust'], 'market_listings': [moments.count],
+                         'market_price': [moments.mean], 'market_m2': [moments.m2]}), sketch, sketches
+
+
+def test_listing_is_left_out_of_its_market():
+    prices = np.random.default_rng(0).normal(12_000, 1_500, 2_000).round()
+    moments, _, sketches = _market(prices)
+    batch = pd.DataFrame({'brand': 'Rolex', 'model': 'Datejust', 'price': prices[:50]})
+    scored = score_listings(batch, moments, sketches)
+    for position, row in scored.iterrows():
+        others = pd.Series(np.delete(prices, position))
+        assert np.isclose(row['market_price'], others.mean())
+        assert np.isclose(row['z_score'], (row['price'] - others.mean()) / others.std())
+
+
+def test_percentile_within_its_bucket_share():
+    prices = np.random.default_rng(1).normal(12_000, 600, 20_000).round(-1)
+    moments, sketch, sketches = _market(prices)
+    batch = pd.DataFrame({'brand': 'Rolex', 'model': 'Datejust', 'price': prices})
+    scored = score_listings(batch, moments, sketches)
+    ordered = np.sort(prices)
+    below = np.searchsorted(ordered, prices, 'left')
+    ties = np.searchsorted(ordered, prices, 'right') - below - 1
+    exact = (below + ties / 2) / (len(prices) - 1)
+    share = sketch.counts[np.searchsorted(sketch.buckets, bucket_of(prices))] / len(prices)
+    assert np.all(np.abs(scored['percentile'] - exact) <= share)
+    assert np.abs(scored['percentile'] - exact).max() < 0.03
+    # The cheapest listings score as deals on every signal available
+    assert scored.loc[np.argmin(prices), 'deal_score'] > 2
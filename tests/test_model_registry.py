@@ -0,0 +1,42 @@
+import numpy as np
+
+from src.model_registry import BinnedHistGradientBoosting
+
+
+def _rows(seed, low, high, size=500):
+    rng = np.random.default_rng(seed)
+    X = rng.uniform(low, high, (size, 3))
+    return X, X @ [3.0, -2.0, 1.0] + rng.normal(0, 0.1, size)
+
+
+def _thresholds(model):
+    return [thresholds.copy() for thresholds in model._bin_mapper.bin_thresholds_]
+
+
+def test_warm_start_keeps_the_first_bins():
+    X, y = _rows(0, 0, 10)
+    model = BinnedHistGradientBoosting(max_iter=20, early_stopping=False, random_state=0).fit(X, y)
+    assert model.keeps_bins
+    thresholds = _thresholds(model)
+    predictions = model.predict(X)
+
+    # New rows over a wider range would move every threshold of a fresh binning
+    X_new, y_new = _rows(1, -5, 15)
+    model.set_params(warm_start=True, max_iter=30).fit(X_new, y_new)
+    assert model.n_iter_ == 30
+    for kept, first in zip(_thresholds(model), thresholds):
+        np.testing.assert_array_equal(kept, first)
+    # The first 20 trees still score the unchanged rows as before
+    np.testing.assert_array_equal(list(model.staged_predict(X))[19], predictions)
+
+
+def test_warm_start_without_new_iterations_predicts_the_same():
+    X, y = _rows(0, 0, 10)
+    model = BinnedHistGradientBoosting(max_iter=20, early_stopping=False, random_state=0).fit(X, y)
+    predictions = model.predict(X)
+    model.set_params(warm_start=True).fit(X, y)
+    np.testing.assert_array_equal(model.predict(X), predictions)
+
+
+def test_unfitted_model_has_no_bins_to_keep():
+    assert not BinnedHistGradientBoosting().keeps_bins
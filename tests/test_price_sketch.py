@@ -0,0 +1,51 @@
+import numpy as np
+import pandas as pd
+
+from src.price_sketch import RELATIVE_ACCURACY, PriceSketch, bucket_of
+
+QUANTILES = [0, 0.01, 0.1, 0.25, 0.5, 0.75, 0.9, 0.99, 1]
+
+
+def _prices(seed, size):
+    return np.random.default_rng(seed).lognormal(mean=9, sigma=0.8, size=size).round(0)
+
+
+def _relative_errors(sketch, prices):
+    exact = pd.Series(prices).quantile(QUANTILES).to_numpy()
+    return np.abs(sketch.quantile(QUANTILES) - exact) / exact
+
+
+def test_quantiles_within_relative_accuracy():
+    prices = _prices(0, 50_000)
+    assert _relative_errors(PriceSketch.from_prices(prices), prices).max() <= RELATIVE_ACCURACY
+
+
+def test_bucket_bounds():
+    prices = _prices(1, 1_000)
+    gamma = (1 + RELATIVE_ACCURACY) / (1 - RELATIVE_ACCURACY)
+    buckets = bucket_of(prices)
+    assert np.all(gamma ** (buckets - 1) < prices)
+    assert np.all(prices <= gamma ** buckets * (1 + 1e-12))
+
+
+def test_merge_equals_sketch_of_all_prices():
+    days = [_prices(seed, size) for seed, size in [(2, 3_000), (3, 10), (4, 20_000)]]
+    merged = PriceSketch()
+    for prices in days:
+        merged = merged.merge(PriceSketch.from_prices(prices))
+    whole = PriceSketch.from_prices(np.concatenate(days))
+    assert merged.count == whole.count == sum(map(len, days))
+    assert np.array_equal(merged.buckets, whole.buckets)
+    assert np.array_equal(merged.counts, whole.counts)
+    assert _relative_errors(merged, np.concatenate(days)).max() <= RELATIVE_ACCURACY
+
+
+def test_repeated_buckets_are_combined():
+    sketch = PriceSketch([5, 3, 5], [1, 2, 4])
+    assert sketch.buckets.tolist() == [3, 5]
+    assert sketch.counts.tolist() == [2, 5]
+
+
+def test_non_positive_prices_and_empty_sketch():
+    assert PriceSketch.from_prices([0, -10, 250]).count == 1
+    assert np.isnan(PriceSketch().quantile(0.5))
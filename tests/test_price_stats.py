@@ -0,0 +1,45 @@
+import math
+
+import numpy as np
+import pandas as pd
+
+from src.price_stats import PriceMoments
+
+
+def _days():
+    rng = np.random.default_rng(0)
+    return [rng.normal(12_000, 3_000, size) for size in (1, 250, 4_000, 2)]
+
+
+def test_merge_matches_pandas():
+    days = _days()
+    merged = PriceMoments()
+    for prices in days:
+        merged = merged.merge(PriceMoments.from_prices(prices))
+    prices = pd.Series(np.concatenate(days))
+    assert merged.count == len(prices)
+    assert math.isclose(merged.mean, prices.mean(), rel_tol=1e-12)
+    assert math.isclose(merged.std, prices.std(), rel_tol=1e-9)
+    assert math.isclose(merged.z_score(5_000), (5_000 - prices.mean()) / prices.std(), rel_tol=1e-9)
+
+
+def test_from_daily_matches_pairwise_merge():
+    days = _days()
+    stats = pd.DataFrame({
+        'listings': [len(prices) for prices in days] + [0],
+        'mean_price': [prices.mean() for prices in days] + [np.nan],
+        'm2_price': [((prices - prices.mean()) ** 2).sum() for prices in days] + [np.nan],
+    })
+    merged = PriceMoments()
+    for prices in days:
+        merged = merged.merge(PriceMoments.from_prices(prices))
+    from_daily = PriceMoments.from_daily(stats)
+    assert from_daily.count == merged.count
+    assert math.isclose(from_daily.mean, merged.mean, rel_tol=1e-12)
+    assert math.isclose(from_daily.m2, merged.m2, rel_tol=1e-9)
+
+
+def test_empty_moments():
+    assert PriceMoments().merge(PriceMoments()).count == 0
+    assert PriceMoments.from_prices([]).count == 0
+    assert math.isnan(PriceMoments.from_prices([100.0]).std)
@@ -0,0 +1,55 @@
+from src.title_index import TitleIndex, _Automaton, default_index, title_words
+
+VOCABULARY = {
+    'Rolex': ['Rolex Datejust 36', 'Rolex Datejust', 'Rolex Day-Date 40', 'Rolex GMT-Master II'],
+    'Patek Philippe': ['Patek Philippe', 'Patek Philippe Calatrava', 'Patek Philippe Annual Calendar Chronograph'],
+}
+
+
+def test_title_words():
+    assert title_words('GMT-Master II 116710LN') == ['gmt', 'master', 'ii', '116710', 'ln']
+    assert title_words('Genève') == ['geneve']
+
+
+def test_longest_family_wins():
+    index = TitleIndex(VOCABULARY)
+    assert index.family('Rolex', 'Rolex Datejust 36 126234 Jubilee') == 'Rolex Datejust 36'
+    assert index.family('Rolex', 'Datejust 41 Wimbledon') == 'Rolex Datejust'
+    assert index.family('Rolex', 'Day-Date 40 Platinum') == 'Rolex Day-Date 40'
+    assert index.family('Rolex', 'GMT Master II Batman') == 'Rolex GMT-Master II'
+
+
+def test_catch_all_and_unknown_brands():
+    index = TitleIndex(VOCABULARY)
+    assert index.family('Patek Philippe', 'Calatrava 5196G') == 'Patek Philippe Calatrava'
+    assert index.family('Patek Philippe', 'Nautilus 5711') == 'Patek Philippe'
+    assert index.family('Rolex', 'Submariner Date') is None
+    assert index.family('Seiko', 'Seiko 5') is None
+    assert index.family(None, None) is None
+
+
+def test_matches_through_failure_links():
+    automaton = _Automaton([(['a', 'b', 'c', 'd'], 'abcd'), (['b', 'c'], 'bc'), (['c'], 'c')])
+    # 'a b c' fails at 'x' and must still report 'b c' found on the way
+    assert automaton.longest_match(['a', 'b', 'c', 'x']) == 'bc'
+    assert automaton.longest_match(['x', 'c']) == 'c'
+    assert automaton.longest_match(['a', 'b', 'c', 'd']) == 'abcd'
+    assert automaton.longest_match(['d']) is None
+
+
+def test_leftmost_of_equally_long_matches():
+    automaton = _Automaton([(['b', 'c'], 'bc'), (['d', 'e'], 'de')])
+    assert automaton.longest_match(['d', 'e', 'b', 'c']) == 'de'
+
+
+def test_families_of_matches_each_title():
+    index = TitleIndex(VOCABULARY)
+    brands = ['Rolex', 'Rolex', 'Patek Philippe', 'Rolex']
+    titles = ['Datejust 36', 'Submariner', 'Calatrava', 'Datejust 36']
+    assert index.families_of(brands, titles) == [index.family(*pair) for pair in zip(brands, titles)]
+
+
+def test_default_vocabulary_loads():
+    index = default_index()
+    assert index.families > 0
+    assert index.family('Rolex', 'Rolex Datejust 36 Steel') == 'Rolex Datejust 36'